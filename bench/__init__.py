@@ -0,0 +1,35 @@
+""" Benchmarks of the sensor, logging and plotting paths
+
+Run with python -m bench, see bench/__main__.py for the options. Sensors
+are read from a sensors.fakebus bus so no hardware is needed, databases of
+the sizes asked for are built in the work directory and kept there so
+later runs can reuse them.
+"""
+
+import time
+from collections import namedtuple
+
+Result = namedtuple('Result', 'name ops seconds')
+
+def measure(name, func, ops=1, repeat=3, clock=time.time):
+    ''' Time func(), which does ops operations, repeat times
+
+    Returns a Result of the fastest run, the others are mostly noise from
+    the rest of the system.
+    '''
+
+    best = None
+    for i in range(repeat):
+        start = clock()
+        func()
+        elapsed = clock() - start
+        if best is None or elapsed < best: best = elapsed
+    return Result(name, ops, best)
+
+def report(result):
+    ''' Print a Result as one line of the results table '''
+
+    per_op = result.seconds / result.ops if result.ops else 0.0
+    rate = result.ops / result.seconds if result.seconds else float('inf')
+    print '{r.name:<40} {r.ops:>9} ops {ms:>12.3f} ms/op {rate:>12.1f} ops/s'.format(
+        r=result, ms=per_op * 1000, rate=rate)
@@ -0,0 +1,75 @@
+import os, sys, shutil, tempfile
+from optparse import OptionParser
+
+CASES = ('sensors', 'detect', 'log', 'json', 'plot', 'archive', 'ingest')
+
+parser = OptionParser(usage='python -m bench [options] [case ...]\n\n'
+                      'Cases: %s, all by default' % ', '.join(CASES))
+parser.add_option('-w', '--workdir', default=None, dest='workdir',
+			help='Directory for the fake bus and databases, kept '
+			'between runs, a temporary one is used by default')
+parser.add_option('-n', '--devices', default=8, dest='devices', type='int',
+			help='Number of sensors on the fake bus')
+parser.add_option('--latency', default=0.0, dest='latency', type='float',
+			help='Seconds each sensor read takes')
+parser.add_option('--crc', default=0.0, dest='crc', type='float',
+			help='Probability a sensor read fails its CRC')
+parser.add_option('--glitch', default=0.0, dest='glitch', type='float',
+			help='Probability a sensor read is the 85C reset value')
+parser.add_option('--bulk', default=False, dest='bulk', action='store_true',
+			help='Give the fake bus master therm_bulk_read')
+parser.add_option('-r', '--reads', default=1000, dest='reads', type='int',
+			help='Sensor reads and device scans timed')
+parser.add_option('-i', '--intervals', default=1440, dest='intervals',
+			type='int', help='Log intervals timed, up to a day of them')
+parser.add_option('-s', '--sizes', default='1,30,365,1825', dest='sizes',
+			help='Comma separated database sizes in days')
+parser.add_option('--interval', default=60, dest='interval', type='int',
+			help='Seconds between readings in the databases')
+parser.add_option('-p', '--points', default=1000, dest='points', type='int',
+			help='Plot points used to choose the rollup resolution')
+parser.add_option('-b', '--batch', default=10, dest='batch', type='int',
+			help='Readings committed to the database at once')
+parser.add_option('--commit', default=300.0, dest='commit', type='float',
+			help='Longest time in seconds a reading waits to be committed')
+parser.add_option('--nodes', default=24, dest='nodes', type='int',
+			help='Nodes shipping batches to the collector, each with as '
+			'many sensors as the fake bus')
+
+if __name__ == '__main__':
+    (options, args) = parser.parse_args()
+    for case in args:
+        if case not in CASES: parser.error('Unknown case %s' % case)
+    selected = args or CASES
+    workdir = options.workdir or tempfile.mkdtemp(prefix='pimms-bench-')
+    if not os.path.isdir(os.path.join(workdir, 'json')):
+        os.makedirs(os.path.join(workdir, 'json'))
+    # The sensors package reads the bus location when first imported
+    os.environ['PIMMS_W1'] = os.path.join(workdir, 'w1')
+    from bench import cases, report
+    from sensors.fakebus import FakeBus
+    bus = FakeBus(os.environ['PIMMS_W1'], options.devices, options.latency,
+                  options.crc, options.glitch, bulk=options.bulk)
+    intervals = min(max(options.intervals, 1), 86400 // 60)
+    runs = {'sensors': lambda: cases.sensor_reads(bus, options.reads),
+            'detect': lambda: cases.detection(bus, options.reads),
+            'log': lambda: cases.log_path(workdir, intervals, options.batch,
+                                          options.commit),
+            'json': lambda: cases.json_add(workdir, intervals),
+            'plot': lambda: cases.plot_queries(
+                workdir, [int(s) for s in options.sizes.split(',')],
+                options.interval, options.points),
+            'archive': lambda: cases.archive_reads(
+                workdir, [int(s) for s in options.sizes.split(',')],
+                options.interval),
+            'ingest': lambda: cases.ingest_batches(workdir, options.nodes,
+                                                   options.devices)}
+    try:
+        for case in CASES:
+            if case not in selected: continue
+            for result in runs[case]():
+                report(result)
+                sys.stdout.flush()
+    finally:
+        bus.close()
+        if options.workdir is None: shutil.rmtree(workdir)
@@ -0,0 +1,237 @@
+""" The benchmarks run by python -m bench
+
+Each case is a generator of bench.Result. The sensors package reads the
+bus location when it is first imported so PIMMS_W1 must be set before
+this module is imported.
+"""
+
+import os, time, math, random, shutil
+import sqlite3 as sqlite
+import datefuncs.dt as dt
+import monitor
+from bench import measure
+from sensors.fakebus import FakeBus
+from sensors.therm import Thermal
+from sensors.w1 import Wire
+from sensors.hotplug import Hotplug
+from db.schema import DB
+from db.writer import Writer
+from db.spool import Spool
+from db import rollup, archive, ingest
+from www.appjson import JSONTemps
+
+def sensor_reads(bus, reads):
+    ''' Thermal.read of one sensor and Wire.read of the whole bus '''
+
+    sensor = Thermal(bus.devices[0], FakeBus.FAMILY)
+    def read_one():
+        for i in xrange(reads): sensor.read()
+    yield measure('Thermal.read', read_one, reads)
+    wire = Wire(bulk=False)
+    rounds = max(1, reads // len(wire.devices))
+    for c in sorted(set([1, len(wire.devices)])):
+        wire.concurrency = c
+        def read_all():
+            for i in xrange(rounds): wire.read()
+        yield measure('Wire.read concurrency %d' % c, read_all,
+                      rounds * len(wire.devices))
+    wire.close()
+    wire = Wire()
+    if wire.bulk:
+        def read_bulk():
+            for i in xrange(rounds): wire.read()
+        yield measure('Wire.read bulk', read_bulk, rounds * len(wire.devices))
+
+def detection(bus, rounds):
+    ''' Finding the devices on the bus, with and without changes '''
+
+    wire = Wire()
+    def unchanged():
+        for i in xrange(rounds): wire.detect_devices()
+    yield measure('Wire.detect_devices unchanged', unchanged, rounds)
+    hotplug = Hotplug(bus.path, poll=0)
+    def check():
+        for i in xrange(rounds): hotplug.check()
+    yield measure('Hotplug.check unchanged (%s)' % hotplug.method, check,
+                  rounds)
+    hotplug.close()
+    changes = max(1, rounds // 10)
+    def churn():
+        for i in xrange(changes):
+            dev = bus.add_device()
+            wire.detect_devices()
+            bus.remove_device(dev)
+            wire.detect_devices()
+    yield measure('Wire.detect_devices add/remove', churn, changes * 2)
+
+def log_path(workdir, intervals, batch, commit):
+    ''' The monitor work at the end of each log interval, average and per
+    sensor means to the database and the average to today's json, through
+    the spool and waiting for its thread to write them
+    '''
+
+    db = DB(db=os.path.join(workdir, 'logpath.db'))
+    wire = Wire()
+    means = dict([(d.device, 20000) for d in wire.devices])
+    jsonf = JSONTemps(os.path.join(workdir, 'json', 'today.json'), db.db,
+                      JSONTemps.DELTA)
+    writer = Writer(db.db, batch, commit)
+    start = dt.timestamp_day(dt.now()).start
+    step = 86400 // intervals
+    def run():
+        spool = Spool(writer, os.path.join(workdir, 'logpath.spool'), jsonf)
+        for i in xrange(intervals):
+            t = start + i * step
+            monitor.log_avg(20000, t, spool)
+            monitor.log_sensors(means, t, spool, wire)
+            spool.add_json(t, 20.0, dict([(d, v / 1000.0)
+                                          for d, v in means.iteritems()]))
+        spool.close()
+    yield measure('monitor log path, %d sensors' % len(means), run,
+                  intervals)
+
+def json_add(workdir, points):
+    ''' JSONTemps.add_val for a day of points in each mode '''
+
+    start = dt.timestamp_day(dt.now()).start
+    step = 86400 // points
+    for mode in JSONTemps.MODES:
+        filename = os.path.join(workdir, 'json', '%s.json' % mode)
+        def run():
+            jsonf = JSONTemps(filename, None, mode)
+            for i in xrange(points): jsonf.add_val(start + i * step, 20.0)
+        yield measure('JSONTemps.add_val %s' % mode, run, points)
+
+def build_db(path, days, interval, end):
+    ''' Create a database of days of average readings every interval
+    seconds up to end, with its rollups. An existing one is reused.
+    '''
+
+    if os.path.exists(path): return DB(db=path)
+    db = DB(db=path)
+    first = int(end) - days * 86400
+    rnd = random.Random(days)
+    def rows():
+        for t in xrange(first, int(end), interval):
+            daily = math.sin((t % 86400) * 2 * math.pi / 86400)
+            yield (DB.AVG_SENSOR, t,
+                   int(20000 + 3000 * daily + rnd.gauss(0, 200)))
+    with sqlite.connect(path) as con:
+        con.executemany("INSERT INTO readings(sensor_id, timestamp, reading) "
+                        "VALUES (?, ?, ?);", rows())
+    con = sqlite.connect(path)
+    try:
+        rollup.backfill(con)
+    finally:
+        con.close()
+    return db
+
+def plot_queries(workdir, sizes, interval, points):
+    ''' www.web.get_readings for each plot view over databases of sizes
+    days, at the resolution the plot page would use
+    '''
+
+    try:
+        from www import web
+    except ImportError as e:
+        print 'Skipping get_readings, the web app can not be imported: %s' % e
+        return
+    today = dt.date_now()
+    end = dt.timestamp_day(dt.now()).end
+    for days in sizes:
+        path = os.path.join(workdir, 'readings-%dd-%ds.db' % (days, interval))
+        yield measure('build %d day database' % days,
+                      lambda: build_db(path, days, interval, end), 1, 1)
+        os.environ['PIMMS_DB'] = os.path.abspath(path)
+        for view in sorted(web.VIEWS, key=lambda v: web.VIEWS[v].days):
+            if web.VIEWS[view].days > days: continue
+            span = web.view_span(today, view)
+            seconds = (time.mktime(span.end.timetuple()) -
+                       time.mktime(span.start.timetuple()))
+            resolutions = [rollup.resolution_for(seconds, points)]
+            if view == web.DEFAULT_VIEW and rollup.RAW not in resolutions:
+                resolutions.append(rollup.RAW)
+            for res in resolutions:
+                yield measure('get_readings %dd db %s (%s)' % (days, view, res),
+                              lambda: web.get_readings(span, resolution=res), 1)
+
+def _size(path):
+    if os.path.isfile(path): return os.path.getsize(path)
+    return sum([os.path.getsize(os.path.join(path, f))
+                for f in os.listdir(path)])
+
+def archive_reads(workdir, sizes, interval, after=archive.AFTER):
+    ''' db.archive.Archive.move of the readings older than after days of
+    copies of the databases of sizes days, then a day of raw readings read
+    from the archive and from the database
+    '''
+
+    end = dt.timestamp_day(dt.now()).end
+    for days in sizes:
+        if days <= after: continue
+        path = os.path.join(workdir, 'readings-%dd-%ds.db' % (days, interval))
+        build_db(path, days, interval, end)
+        copy = os.path.join(workdir, 'archive-%dd-%ds.db' % (days, interval))
+        shutil.copy(path, copy)
+        store = archive.Archive(archive.directory(copy), after)
+        if os.path.isdir(store.path): shutil.rmtree(store.path)
+        con = sqlite.connect(copy)
+        try:
+            moved = [0]
+            def move():
+                moved[0] = store.move(con, end - after * 86400, pause=0)
+            yield measure('Archive.move %dd db' % days, move, 1, 1)
+            con.execute("VACUUM;")
+        finally:
+            con.close()
+        print '{n} readings archived in {a} bytes, {r} bytes in the database'.format(
+            n=moved[0], a=_size(store.path),
+            r=_size(path) - _size(copy))
+        day = end - (after + 1) * 86400
+        yield measure('Archive.read day %dd db' % days,
+                      lambda: store.read(DB.AVG_SENSOR, day, day + 86399), 1)
+        con = sqlite.connect(path)
+        try:
+            yield measure('readings day %dd db' % days,
+                          lambda: con.execute(
+                              "SELECT timestamp, reading FROM readings "
+                              "WHERE sensor_id = ? AND timestamp "
+                              "BETWEEN ? AND ? ORDER BY timestamp ASC;",
+                              (DB.AVG_SENSOR, day, day + 86399)).fetchall(), 1)
+        finally:
+            con.close()
+
+def ingest_batches(workdir, nodes, sensors, seconds=10, batches=30):
+    ''' db.ingest.store of batches from nodes each with sensors read every
+    second, as a collector gets them from nodes shipping every seconds,
+    then the same batches again as duplicates
+    '''
+
+    path = os.path.join(workdir, 'collector.db')
+    if os.path.exists(path): os.remove(path)
+    DB(db=path)
+    start = int(time.time()) - batches * seconds
+    data = []
+    for b in xrange(batches):
+        t = start + b * seconds
+        for n in xrange(nodes):
+            data.append(ingest.encode('node-%d' % n, [
+                ('28-%012x' % s, 'DS18B20',
+                 [(t + i, 20000 + 37 * ((i + s) % 50)) for i in xrange(seconds)])
+                for s in xrange(sensors)]))
+    readings = len(data) * sensors * seconds
+    print '{n} batches of {b} bytes on average'.format(
+        n=len(data), b=sum([len(d) for d in data]) // len(data))
+    yield measure('ingest.decode', lambda: [ingest.decode(d) for d in data],
+                  readings)
+    decoded = [ingest.decode(d) for d in data]
+    con = sqlite.connect(path)
+    con.execute("PRAGMA journal_mode=WAL;")
+    try:
+        ids = {}
+        for name in ('ingest.store', 'ingest.store duplicates'):
+            yield measure(name, lambda: [ingest.store(con, node, s, ids)
+                                         for node, s in decoded],
+                          readings, 1)
+    finally:
+        con.close()
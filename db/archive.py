@@ -0,0 +1,383 @@
+""" Compressed columnar storage of the raw readings of completed days
+
+Raw readings older than a number of days are moved out of the readings
+table into a file per month in a directory beside the database. A month
+file holds a block for each sensor and UTC day, indexed at the start of
+the file:
+
+    'PCA1', number of blocks
+    (sensor id, day, offset, length, count) for each block
+    blocks
+
+A block is two columns, the timestamps as the first one, the first
+difference and then the differences of the differences, and the values
+(milli degrees as Reading.val gives) as the first one and then the
+differences, all as zigzag varints. Readings a regular interval apart take
+a byte for the timestamp and usually one for the value, against the 20 or
+so bytes of a readings row and its index.
+
+Month files are replaced whole, written a block at a time and synced to
+disk before the readings they hold are deleted. Readings are moved a day
+at a time, each day in a transaction of its own, so the database write
+lock is never held for long even on the first move of a large database.
+Readers map the files and decode only the blocks of the sensor and days
+asked for.
+
+>>> store = Archive(directory('templog.db'))
+>>> store.move(con, before=time.time() - 7 * 86400)  # days older than a week
+>>> store.read(sensor, start, end)   # [(timestamp, reading)] as readings
+"""
+
+import os, mmap, time, calendar, struct, threading
+from db import extents
+
+DAY = 86400
+AFTER = 7       # days readings stay in the readings table by default
+PAUSE = 0.05    # seconds between moving each day
+
+MAGIC = 'PCA1'
+HEADER = struct.Struct('<4sI')
+ENTRY = struct.Struct('<iIIII')  # sensor id, day, offset, length, count
+SUFFIX = '.pca'
+
+def directory(db):
+    ''' The archive directory of the database file db '''
+
+    return db + '.archive'
+
+def _zigzag(n):
+    return n << 1 if n >= 0 else ((-n) << 1) - 1
+
+def _put(out, n):
+    ''' Append n >= 0 to the bytearray out as a varint '''
+
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def encode(rows):
+    ''' Return the block of (timestamp, reading) rows in time order '''
+
+    out = bytearray()
+    _put(out, len(rows))
+    if not rows: return str(out)
+    prev_t = int(rows[0][0])
+    _put(out, _zigzag(prev_t))
+    delta = 0
+    for t, v in rows[1:]:
+        t = int(t)
+        _put(out, _zigzag(t - prev_t - delta))
+        delta = t - prev_t
+        prev_t = t
+    prev_v = 0
+    for t, v in rows:
+        _put(out, _zigzag(v - prev_v))
+        prev_v = v
+    return str(out)
+
+def decode(block):
+    ''' Return the (timestamp, reading) rows of a block '''
+
+    nums = []
+    n = shift = 0
+    count = None
+    for b in bytearray(block):
+        n |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+            continue
+        if count is None:
+            count = n
+            if not count: return []
+        else:
+            nums.append(n >> 1 if not n & 1 else -((n + 1) >> 1))
+        n = shift = 0
+    t = nums[0]
+    times = [t] * count
+    delta = 0
+    for j in xrange(1, count):
+        delta += nums[j]
+        t += delta
+        times[j] = t
+    v = 0
+    rows = []
+    for j in xrange(count):
+        v += nums[count + j]
+        rows.append((times[j], v))
+    return rows
+
+def _month(t):
+    ''' (year, month) of timestamp t in UTC '''
+
+    tm = time.gmtime(t)
+    return tm.tm_year, tm.tm_mon
+
+def _month_start(year, month):
+    return calendar.timegm((year, month, 1, 0, 0, 0))
+
+def _next_month(year, month):
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+class _Month(object):
+    ''' A mapped month file and its index '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.key = (st.st_ino, st.st_mtime, st.st_size)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n = HEADER.unpack_from(self.map)
+        if magic != MAGIC: raise ValueError('%s is not an archive' % path)
+        self.index = {} # sensor -> [(day, offset, length, count)] by day
+        for i in xrange(n):
+            sensor, day, offset, length, count = ENTRY.unpack_from(
+                self.map, HEADER.size + i * ENTRY.size)
+            self.index.setdefault(sensor, []).append((day, offset, length,
+                                                      count))
+        for entries in self.index.itervalues(): entries.sort()
+
+    def rows(self, sensor, start, end):
+        for day, offset, length, count in self.index.get(sensor, ()):
+            if day + DAY <= start or day > end: continue
+            block = decode(self.map[offset:offset + length])
+            if day < start or day + DAY > end:
+                block = [r for r in block if start <= r[0] <= end]
+            for r in block: yield r
+
+def _next_day(con, sensors, start, end):
+    ''' Start of the first day holding a reading of sensors from start up
+    to end, None if there is none
+    '''
+
+    first = [con.execute("SELECT MIN(timestamp) FROM readings "
+                         "WHERE sensor_id = ? AND timestamp >= ? "
+                         "AND timestamp < ?;",
+                         (sensor, start, end)).fetchone()[0]
+             for sensor in sensors]
+    first = [t for t in first if t is not None]
+    return int(min(first)) // DAY * DAY if first else None
+
+def _sync_dir(path):
+    ''' Sync the directory path so a file renamed into it stays '''
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _write_month(path, existing, new, fetch):
+    ''' Replace the month file path with the blocks of the _Month existing
+    (or None) and, for each (sensor, day) in new, the rows fetch(sensor,
+    day) returns merged into any block of that day
+
+    Blocks are written one at a time to a temporary file, the unchanged
+    ones copied from the map, and the file is synced to disk before it is
+    renamed over path and the directory synced.
+    '''
+
+    old = {} # (sensor, day) -> (offset, length, count) in existing
+    if existing is not None:
+        for sensor, entries in existing.index.iteritems():
+            for day, offset, length, count in entries:
+                old[(sensor, day)] = (offset, length, count)
+    keys = sorted(set(old) | set(new), key=lambda k: (k[1], k[0]))
+    tmp = '%s.tmp%d' % (path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            offset = HEADER.size + len(keys) * ENTRY.size
+            f.seek(offset)
+            index = []
+            for key in keys:
+                block, count = None, 0
+                if key in old:
+                    start, length, count = old[key]
+                    block = existing.map[start:start + length]
+                if key in new:
+                    rows = fetch(*key)
+                    if block is not None:
+                        merged = dict(decode(block))
+                        merged.update(rows)
+                        rows = sorted(merged.iteritems())
+                    block, count = encode(rows), len(rows)
+                f.write(block)
+                index.append(ENTRY.pack(key[0], key[1], offset, len(block),
+                                        count))
+                offset += len(block)
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, len(keys)) + ''.join(index))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+    _sync_dir(os.path.dirname(path) or '.')
+
+def decode_count(block):
+    ''' The number of readings in a block '''
+
+    n = shift = 0
+    for b in bytearray(block[:10]):
+        n |= (b & 0x7f) << shift
+        if not b & 0x80: return n
+        shift += 7
+    return n
+
+class Archive(object):
+    ''' The month files of a directory
+
+    Arguments:
+    path -- the directory, created when the first readings are moved
+    after -- days readings are kept in the readings table, None never moves
+    '''
+
+    def __init__(self, path, after=AFTER):
+        self.path = path
+        self.after = after
+        self._months = {} # file name -> _Month
+        self._lock = threading.Lock()
+
+    def _file(self, year, month):
+        return os.path.join(self.path, '%04d-%02d%s' % (year, month, SUFFIX))
+
+    def _open(self, filename):
+        ''' The _Month of filename, mapped again if the file was replaced,
+        None if there is no such file
+        '''
+
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        key = (st.st_ino, st.st_mtime, st.st_size)
+        with self._lock:
+            month = self._months.get(filename)
+            if month is None or month.key != key:
+                month = self._months[filename] = _Month(filename)
+            return month
+
+    def months(self):
+        ''' The (year, month) of each month file, oldest first '''
+
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return []
+        res = []
+        for name in names:
+            if not name.endswith(SUFFIX): continue
+            try:
+                year, month = name[:-len(SUFFIX)].split('-')
+                res.append((int(year), int(month)))
+            except ValueError:
+                pass
+        return sorted(res)
+
+    def rows(self, sensor, start, end):
+        ''' Generate the archived (timestamp, reading) rows of sensor
+        between start and end inclusive in time order, decoding a day at a
+        time
+        '''
+
+        if not os.path.isdir(self.path): return
+        year, month = _month(start)
+        while _month_start(year, month) <= end:
+            m = self._open(self._file(year, month))
+            if m is not None:
+                for r in m.rows(sensor, start, end): yield r
+            year, month = _next_month(year, month)
+
+    def read(self, sensor, start, end):
+        ''' Return the archived rows of sensor between start and end,
+        @see rows
+        '''
+
+        return list(self.rows(sensor, start, end))
+
+    def move(self, con, before=None, pause=PAUSE, sleep=time.sleep):
+        ''' Move the readings of the days before the one holding before
+        (default now less after days) from the readings table to the
+        archive. Returns the number of readings moved.
+
+        Each day is moved in its own transaction, its month file replaced
+        before its readings are deleted, readings of a day already archived
+        are merged into its block, so a move cut short is finished by the
+        next.
+        '''
+
+        if before is None:
+            if self.after is None: return 0
+            before = time.time() - self.after * DAY
+        before = int(before) // DAY * DAY
+        sensors = [r[0] for r in con.execute("SELECT id FROM sensors;")]
+        with con:
+            extents.record(con, sensors)
+        first = con.execute("SELECT MIN(timestamp) FROM readings "
+                            "WHERE timestamp < ?;", (before,)).fetchone()[0]
+        if first is None: return 0
+        if not os.path.isdir(self.path): os.makedirs(self.path)
+        moved = 0
+        day = int(first) // DAY * DAY
+        while day is not None:
+            moved += self._move_day(con, day, sensors)
+            sleep(pause)
+            day = _next_day(con, sensors, day + DAY, before)
+        return moved
+
+    def _move_day(self, con, start, sensors):
+        ''' Move the readings of the day from start to its month file in
+        one transaction holding the database write lock, so a reading
+        written meanwhile waits and is left for the next move
+        '''
+
+        end = start + DAY
+        filename = self._file(*_month(start))
+        level = con.isolation_level
+        con.isolation_level = None # the transaction is begun here
+        try:
+            con.execute("BEGIN IMMEDIATE;")
+            try:
+                # Read under the lock, another mover has finished with it
+                existing = self._open(filename)
+                new = set()
+                for sensor in sensors:
+                    new.update([(sensor, d * DAY) for (d,) in con.execute(
+                        "SELECT DISTINCT timestamp / ? FROM readings "
+                        "WHERE sensor_id = ? AND timestamp >= ? "
+                        "AND timestamp < ?;", (DAY, sensor, start, end))])
+                moved = 0
+                if new:
+                    _write_month(filename, existing, new, lambda s, day:
+                                 con.execute("SELECT timestamp, reading "
+                                             "FROM readings WHERE sensor_id "
+                                             "= ? AND timestamp >= ? AND "
+                                             "timestamp < ? ORDER BY "
+                                             "timestamp ASC;",
+                                             (s, day, day + DAY)).fetchall())
+                    for sensor in set([k[0] for k in new]):
+                        moved += con.execute("DELETE FROM readings "
+                                             "WHERE sensor_id = ? AND "
+                                             "timestamp >= ? AND "
+                                             "timestamp < ?;",
+                                             (sensor, start, end)).rowcount
+                con.execute("COMMIT;")
+            except:
+                con.execute("ROLLBACK;")
+                raise
+        finally:
+            con.isolation_level = level
+        return moved
+
+    def prune(self, before):
+        ''' Remove the month files wholly before the timestamp before,
+        returns the number removed
+        '''
+
+        removed = 0
+        for year, month in self.months():
+            if _month_start(*_next_month(year, month)) > before: break
+            os.remove(self._file(year, month))
+            removed += 1
+        return removed
@@ -0,0 +1,74 @@
+""" Earliest and latest reading timestamps per sensor kept in the sys table
+
+The writer records the extents of each sensor as it commits readings so
+they can be read with two primary key lookups instead of MIN / MAX over
+the readings. get() falls back to the readings index for a sensor that
+has no recorded extents.
+"""
+
+MIN_KEY = 'extent_min:{sensor}'
+MAX_KEY = 'extent_max:{sensor}'
+
+def update(con, rows):
+    ''' Record the extents of (sensor_id, timestamp, ...) rows just written
+
+    Call after the rows are inserted, in the same transaction. Extents not
+    recorded yet are taken from the readings index so existing readings
+    are accounted for, after that the latest is moved forward.
+    Does not commit.
+    '''
+
+    latest = {}
+    for r in rows:
+        latest[r[0]] = max(latest.get(r[0], r[1]), r[1])
+    for sensor, hi in latest.iteritems():
+        for key, agg in ((MIN_KEY, 'MIN'), (MAX_KEY, 'MAX')):
+            con.execute("INSERT OR IGNORE INTO sys(key, val) "
+                        "SELECT ?, CAST({agg}(timestamp) AS TEXT) "
+                        "FROM readings WHERE sensor_id = ?;".format(agg=agg),
+                        (key.format(sensor=sensor), sensor))
+        con.execute("UPDATE sys SET val = ? WHERE key = ? "
+                    "AND CAST(val AS INTEGER) < ?;",
+                    (str(hi), MAX_KEY.format(sensor=sensor), hi))
+
+def record(con, sensors):
+    ''' Record the extents of each sensor from the readings index, call
+    before readings are removed as the index can not find them after.
+    Does not commit.
+    '''
+
+    for sensor in sensors:
+        latest = get(con, sensor)[1]
+        if latest is not None: update(con, [(sensor, latest)])
+
+def set_min(con, sensor, timestamp):
+    ''' Record a new earliest timestamp after readings have been removed
+
+    A timestamp of None forgets the extents so they are found again.
+    Does not commit.
+    '''
+
+    if timestamp is None:
+        con.execute("DELETE FROM sys WHERE key IN (?, ?);",
+                    (MIN_KEY.format(sensor=sensor),
+                     MAX_KEY.format(sensor=sensor)))
+    else:
+        con.execute("INSERT OR REPLACE INTO sys(key, val) VALUES (?, ?);",
+                    (MIN_KEY.format(sensor=sensor), str(int(timestamp))))
+
+def get(con, sensor):
+    ''' Return (earliest, latest) timestamps for sensor, (None, None) if it
+    has no readings
+    '''
+
+    vals = dict(con.execute("SELECT key, val FROM sys WHERE key IN (?, ?);",
+                            (MIN_KEY.format(sensor=sensor),
+                             MAX_KEY.format(sensor=sensor))).fetchall())
+    if len(vals) == 2:
+        return (int(vals[MIN_KEY.format(sensor=sensor)]),
+                int(vals[MAX_KEY.format(sensor=sensor)]))
+    # Not recorded yet, each is a seek on the readings primary key
+    return con.execute("SELECT (SELECT MIN(timestamp) FROM readings "
+                       "WHERE sensor_id = ?), (SELECT MAX(timestamp) "
+                       "FROM readings WHERE sensor_id = ?);",
+                       (sensor, sensor)).fetchone()
@@ -0,0 +1,136 @@
+""" Readings collected from the monitors of other Pis
+
+A node ships its readings to a collector in batches, each a zlib
+compressed JSON object naming the node and holding the readings of each
+of its sensors:
+
+    {"node": "kitchen",
+     "sensors": [{"device": "28-000004a3b1c2", "family": "DS18B20",
+                  "readings": [[timestamp, reading], ...]}, ...]}
+
+The collector keeps them in its own database under sensors of that node
+(see DB.LOCAL_NODE), so a reading is known by (node, device, timestamp)
+and a batch sent again after a lost reply changes nothing: readings
+already held, in the readings table or moved to the archive (see
+db.archive), are counted as duplicates and left out of the rollups.
+
+>>> data = encode('kitchen', [('28-000004a3b1c2', 'DS18B20', rows)])
+>>> node, sensors = decode(data)         # on the collector
+>>> store(con, node, sensors)            # (accepted, duplicates)
+"""
+
+import json, zlib, hmac, hashlib
+from db.schema import sensor_id
+from db.rollup import Rollup
+from db import extents
+
+MAX_BATCH = 8 * 1024 * 1024 # bytes a batch may hold once decompressed
+MAX_NAME = 64               # characters in a node or device name
+LEVEL = 6                   # zlib compression level
+
+KEY_HEADER = 'X-Pimms-Key'  # shared key of the collector, @see www.web
+
+class BatchError(ValueError):
+    ''' A batch that can not be decoded or is too large '''
+
+def authorised(sent, key):
+    ''' True if the key sent with a batch is the collector's key, compared
+    in constant time
+    '''
+
+    digest = lambda k: hashlib.sha256(k.encode('utf-8') if
+                                      isinstance(k, unicode) else k).digest()
+    return hmac.compare_digest(digest(sent), digest(key))
+
+def encode(node, sensors):
+    ''' Return the batch of (device, family, [(timestamp, reading)]) for
+    each sensor of node
+    '''
+
+    return zlib.compress(json.dumps({
+        'node': node,
+        'sensors': [{'device': device, 'family': family,
+                     'readings': [[int(t), int(v)] for t, v in rows]}
+                    for device, family, rows in sensors]},
+        separators=(',', ':')), LEVEL)
+
+def _name(val, what):
+    if not isinstance(val, basestring) or not 0 < len(val) <= MAX_NAME:
+        raise BatchError('Invalid %s name' % what)
+    return val
+
+def decode(data, limit=MAX_BATCH):
+    ''' Return the node and [(device, family, [(timestamp, reading)])] of
+    a batch, raises BatchError if it is invalid or more than limit bytes
+    decompressed
+    '''
+
+    inflate = zlib.decompressobj()
+    try:
+        body = inflate.decompress(data, limit)
+        if inflate.unconsumed_tail: raise BatchError('Batch too large')
+        batch = json.loads(body)
+        node = _name(batch['node'], 'node')
+        sensors = []
+        for s in batch['sensors']:
+            family = s.get('family')
+            if family is not None: family = _name(family, 'family')
+            sensors.append((_name(s['device'], 'device'), family,
+                            [(int(t), int(v)) for t, v in s['readings']]))
+    except BatchError:
+        raise
+    except (zlib.error, ValueError, TypeError, KeyError, AttributeError) as e:
+        raise BatchError('Invalid batch: %s' % e)
+    return node, sensors
+
+def store(con, node, sensors, ids=None, archive=None):
+    ''' Write the readings of a decoded batch from node in one transaction
+
+    The transaction takes the write lock first, readings are then
+    inserted one at a time so those already held are known without a race
+    between collectors or with archive moves, only the new ones are added
+    to the rollups and extents. Readings of days already moved to archive,
+    the collector's db.archive.Archive, are looked up there. ids is a dict
+    of {(node, device): sensors table id} kept between calls.
+    Returns (readings accepted, duplicates).
+    '''
+
+    ids = {} if ids is None else ids
+    for device, family, rows in sensors:
+        if (node, device) not in ids:
+            ids[(node, device)] = sensor_id(con, device, family, node)
+    rollup = Rollup()
+    new = []
+    total = 0
+    level = con.isolation_level
+    con.isolation_level = None # the transaction is begun here
+    try:
+        con.execute("BEGIN IMMEDIATE;")
+        try:
+            cur = con.cursor()
+            for device, family, rows in sensors:
+                if not rows: continue
+                sensor = ids[(node, device)]
+                rows = sorted(rows)
+                total += len(rows)
+                archived = set()
+                if archive is not None:
+                    archived = set([r[0] for r in archive.rows(
+                        sensor, rows[0][0], rows[-1][0])])
+                for t, v in rows:
+                    if t in archived: continue
+                    cur.execute("INSERT OR IGNORE INTO readings"
+                                "(sensor_id, timestamp, reading) "
+                                "VALUES (?, ?, ?);", (sensor, t, v))
+                    if cur.rowcount == 1:
+                        new.append((sensor, t, v))
+                        rollup.add(sensor, t, v)
+            rollup.apply(con)
+            extents.update(con, new)
+            con.execute("COMMIT;")
+        except:
+            con.execute("ROLLBACK;")
+            raise
+    finally:
+        con.isolation_level = level
+    return len(new), total - len(new)
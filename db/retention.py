@@ -0,0 +1,229 @@
+""" Removal of old readings and rollups
+
+Raw readings are kept for a number of days, after that the minute, hour and
+day rollups (see db.rollup) stand in for them, each kept for its own
+number of days. A policy maps each resolution to the days it is kept, None
+keeps it forever, a resolution must be kept no longer than the ones
+coarser than it so there is always a rollup covering what was removed.
+Nothing is removed unless asked, by default everything is kept forever.
+
+Deletes are made a sensor at a time in batches of a few thousand rows,
+each batch its own short transaction with a pause after it so the monitor
+never waits long for the database. Freed pages are returned to the file
+system with incremental vacuum a few hundred pages at a time, the
+database must use auto_vacuum=INCREMENTAL (set by DB since version 2.3).
+
+The policy in use is recorded in the sys table so the web app can pick a
+resolution that still holds data for the period shown.
+
+Given a db.archive.Archive, raw readings are first moved to it once they
+are its number of days old, and the raw days kept apply to the archive.
+
+>>> con = sqlite.connect('templog.db', timeout=30)
+>>> retention.run(con, {RAW: 90, 'minute': 365, 'hour': 1825, 'day': None})
+>>> retention.start('templog.db', policy, DAY)  # daily on a daemon thread
+"""
+
+import time, threading
+import sqlite3 as sqlite
+from db import rollup, extents
+
+DAY = 86400
+DEFAULT_POLICY = dict([(res, None) for res in rollup.RESOLUTIONS])
+KEY = 'retention:{res}'
+ARCHIVED = 'archived'
+
+BATCH = 5000   # rows deleted in one transaction
+PAGES = 256    # pages freed by one incremental vacuum step
+PAUSE = 0.05   # seconds between batches and vacuum steps
+
+def check(policy):
+    ''' Raise ValueError unless each resolution is kept no longer than the
+    coarser ones
+    '''
+
+    coarser = None # days the next coarser resolution is kept, None forever
+    for res in reversed(rollup.RESOLUTIONS):
+        days = policy.get(res)
+        if days is not None and days <= 0:
+            raise ValueError('Retention of %s must be positive' % res)
+        if coarser is not None and (days is None or days > coarser):
+            raise ValueError('%s can not be kept longer than coarser '
+                             'resolutions' % res)
+        coarser = days
+    return policy
+
+def parse(specs, policy=DEFAULT_POLICY):
+    ''' Return a copy of policy changed by a list of RESOLUTION=DAYS
+    strings, 0 days keeps a resolution forever
+    '''
+
+    res = dict(policy)
+    for spec in specs:
+        name, sep, days = spec.partition('=')
+        name = name.strip()
+        if not sep or name not in rollup.RESOLUTIONS:
+            raise ValueError('Invalid retention %s' % spec)
+        try:
+            days = int(days)
+        except ValueError:
+            raise ValueError('Invalid retention %s' % spec)
+        res[name] = days if days > 0 else None
+    return check(res)
+
+def cutoffs(policy, now):
+    ''' Return {resolution: timestamp} of the oldest data kept, resolutions
+    kept forever are left out
+    '''
+
+    return dict([(res, int(now - days * DAY)) for res, days
+                 in policy.iteritems() if days is not None])
+
+def _table(res):
+    if res == rollup.RAW: return 'readings', 'timestamp'
+    return 'rollup_%s' % res, 'bucket'
+
+def prune(con, policy=DEFAULT_POLICY, now=None, batch=BATCH, pause=PAUSE,
+          sleep=time.sleep):
+    ''' Delete the data older than the policy allows
+
+    Each batch of deletes for a sensor is a range on the primary key
+    committed on its own. Returns {resolution: rows deleted}.
+    '''
+
+    check(policy)
+    now = time.time() if now is None else now
+    sensors = [r[0] for r in con.execute("SELECT id FROM sensors;")]
+    with con:
+        extents.record(con, sensors)
+    deleted = {}
+    for res, cutoff in cutoffs(policy, now).iteritems():
+        table, col = _table(res)
+        deleted[res] = 0
+        for sensor in sensors:
+            while True:
+                # The timestamp batch rows in, or the cutoff if sooner
+                row = con.execute("SELECT {c} FROM {t} WHERE sensor_id = ? "
+                                  "AND {c} < ? ORDER BY {c} ASC "
+                                  "LIMIT 1 OFFSET ?;".format(t=table, c=col),
+                                  (sensor, cutoff, batch - 1)).fetchone()
+                upto = cutoff if row is None else row[0] + 1
+                with con:
+                    n = con.execute("DELETE FROM {t} WHERE sensor_id = ? "
+                                    "AND {c} < ?;".format(t=table, c=col),
+                                    (sensor, upto)).rowcount
+                deleted[res] += n
+                if row is None: break
+                sleep(pause)
+    with con:
+        for res in rollup.RESOLUTIONS:
+            days = policy.get(res)
+            con.execute("INSERT OR REPLACE INTO sys(key, val) VALUES (?, ?);",
+                        (KEY.format(res=res),
+                         'forever' if days is None else str(days)))
+        if None not in [policy.get(res) for res in rollup.RESOLUTIONS]:
+            _move_extents(con, sensors)
+    return deleted
+
+def _move_extents(con, sensors):
+    ''' Move the earliest extent of each sensor up to the data left when
+    nothing is kept forever
+    '''
+
+    coarsest = rollup.RESOLUTIONS[-1]
+    for sensor in sensors:
+        first = con.execute("SELECT MIN(bucket) FROM rollup_%s "
+                            "WHERE sensor_id = ?;" % coarsest,
+                            (sensor,)).fetchone()[0]
+        earliest = extents.get(con, sensor)[0]
+        if first is not None and (earliest is None or first > earliest):
+            extents.set_min(con, sensor, first)
+
+def vacuum(con, pages=PAGES, pause=PAUSE, sleep=time.sleep):
+    ''' Return free pages to the file system, pages at a time
+
+    Does nothing unless the database uses incremental auto vacuum. Returns
+    the number of pages freed.
+    '''
+
+    if con.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2: return 0
+    freed = 0
+    while True:
+        free = con.execute("PRAGMA freelist_count;").fetchone()[0]
+        if not free: return freed
+        con.execute("PRAGMA incremental_vacuum(%d);" % pages).fetchall()
+        con.commit()
+        freed += min(free, pages)
+        sleep(pause)
+
+def applied(con):
+    ''' Return the policy last applied to the database, everything is kept
+    forever if none has been
+    '''
+
+    rows = dict(con.execute("SELECT key, val FROM sys WHERE key LIKE ?;",
+                            (KEY.format(res='%'),)).fetchall())
+    res = {}
+    for r in rollup.RESOLUTIONS:
+        val = rows.get(KEY.format(res=r), 'forever')
+        res[r] = None if val == 'forever' else int(val)
+    return res
+
+def available(resolution, start, policy, now=None):
+    ''' Return resolution, or the next coarser one still holding data from
+    start under policy
+    '''
+
+    now = time.time() if now is None else now
+    kept = cutoffs(policy, now)
+    i = rollup.RESOLUTIONS.index(resolution)
+    for res in rollup.RESOLUTIONS[i:]:
+        if res not in kept or kept[res] <= start: return res
+    return rollup.RESOLUTIONS[-1]
+
+def run(con, policy=DEFAULT_POLICY, now=None, pause=PAUSE, archive=None):
+    ''' Archive, prune then vacuum, returns ({resolution: rows deleted},
+    pages), rows moved to archive are counted as ARCHIVED
+    '''
+
+    now = time.time() if now is None else now
+    moved = 0
+    if archive is not None and archive.after is not None:
+        moved = archive.move(con, now - archive.after * DAY, pause)
+    deleted = prune(con, policy, now, pause=pause)
+    if archive is not None:
+        deleted[ARCHIVED] = moved
+        if policy.get(rollup.RAW) is not None:
+            archive.prune(cutoffs(policy, now)[rollup.RAW])
+    return deleted, vacuum(con, pause=pause)
+
+def report(deleted, pages):
+    if any([deleted[r] for r in rollup.RESOLUTIONS if r in deleted]) or pages:
+        print 'Retention removed {rows} ({freed} pages freed)'.format(
+            rows=', '.join(['%d %s' % (deleted[r], r)
+                            for r in rollup.RESOLUTIONS if r in deleted])
+            or 'nothing', freed=pages)
+    if deleted.get(ARCHIVED):
+        print '{n} readings archived'.format(n=deleted[ARCHIVED])
+
+def start(db, policy=DEFAULT_POLICY, interval=DAY, pause=PAUSE,
+          archive=None):
+    ''' Apply policy to db now and every interval seconds after on a daemon
+    thread with its own connection, returns the thread
+    '''
+
+    check(policy)
+    def work():
+        while True:
+            con = sqlite.connect(db, timeout=30)
+            try:
+                report(*run(con, policy, pause=pause, archive=archive))
+            except (sqlite.Error, EnvironmentError) as e:
+                print 'Retention failed: %s' % e
+            finally:
+                con.close()
+            time.sleep(interval)
+    t = threading.Thread(target=work)
+    t.daemon = True
+    t.start()
+    return t
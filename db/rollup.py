@@ -0,0 +1,179 @@
+""" Minute, hour and day aggregates of readings per sensor
+
+Each tier has a rollup_<tier> table keyed on (sensor_id, bucket) where
+bucket is the timestamp the period starts at (UTC), holding the count, min,
+max, sum and last reading in the period. Rollup collects readings as they
+are logged and apply() merges them into the tables, in the same transaction
+as the readings themselves when used by the Writer. backfill() rebuilds the
+tables from the readings table.
+"""
+
+RAW = 'raw'
+TIERS = (('minute', 60), ('hour', 3600), ('day', 86400))
+RESOLUTIONS = (RAW,) + tuple([t[0] for t in TIERS])
+SIZES = dict(TIERS)
+
+SCHEMA = """
+  CREATE TABLE IF NOT EXISTS rollup_{tier}(sensor_id INTEGER NOT NULL,
+                                          bucket INTEGER NOT NULL,
+                                          count INTEGER NOT NULL,
+                                          min int NOT NULL,
+                                          max int NOT NULL,
+                                          sum INTEGER NOT NULL,
+                                          last int NOT NULL,
+                                          PRIMARY KEY(sensor_id, bucket))
+                                          WITHOUT ROWID;
+"""
+
+def statements():
+    ''' Return the CREATE statements for all rollup tables '''
+
+    return [SCHEMA.format(tier=tier).strip().rstrip(';') for tier, s in TIERS]
+
+def bucket(timestamp, tier):
+    ''' Return the start of the tier period timestamp falls in '''
+
+    size = SIZES[tier]
+    return int(timestamp) // size * size
+
+def resolution_for(span, points):
+    ''' Pick the coarsest resolution that still gives points over span secs'''
+
+    res = RAW
+    for tier, size in TIERS:
+        if size <= float(span) / points:
+            res = tier
+    return res
+
+class Rollup(object):
+    ''' Accumulate aggregates for readings until they are applied
+
+    >>> r = Rollup()
+    >>> r.add(sensor, timestamp, val) # for each reading
+    >>> r.apply(con)                  # inside the readings transaction
+    '''
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # (tier, sensor, bucket) -> [count, min, max, sum, last]
+        self._aggs = {}
+
+    def __len__(self):
+        return len(self._aggs)
+
+    def add(self, sensor, timestamp, val):
+        ''' Add a reading, readings for a sensor must arrive in time order '''
+
+        for tier, size in TIERS:
+            key = (tier, sensor, int(timestamp) // size * size)
+            agg = self._aggs.get(key)
+            if agg is None:
+                self._aggs[key] = [1, val, val, val, val]
+            else:
+                agg[0] += 1
+                if val < agg[1]: agg[1] = val
+                if val > agg[2]: agg[2] = val
+                agg[3] += val
+                agg[4] = val
+
+    def apply(self, con):
+        ''' Merge the collected aggregates into the tables and clear them
+
+        Existing buckets are updated so readings can be applied a few at a
+        time, an empty bucket is inserted first for periods not yet seen.
+        Does not commit.
+        '''
+
+        for tier, size in TIERS:
+            rows = [(s, b) + tuple(a) for (t, s, b), a in self._aggs.iteritems()
+                    if t == tier]
+            if not rows: continue
+            con.executemany("INSERT OR IGNORE INTO rollup_{tier} VALUES "
+                            "(?, ?, 0, ?, ?, 0, ?);".format(tier=tier),
+                            [(r[0], r[1], r[3], r[4], r[6]) for r in rows])
+            con.executemany("UPDATE rollup_{tier} SET count = count + ?, "
+                            "min = MIN(min, ?), max = MAX(max, ?), "
+                            "sum = sum + ?, last = ? "
+                            "WHERE sensor_id = ? AND bucket = ?;".format(
+                                tier=tier),
+                            [r[2:] + r[:2] for r in rows])
+        self.clear()
+
+def _held(con, sensor):
+    ''' Return the start of the day the rollups of sensor can be rebuilt
+    from, that of its first reading unless the day rollup counts readings
+    removed by db.retention or moved to db.archive, then the next. None if
+    the sensor has no readings.
+    '''
+
+    first = con.execute("SELECT MIN(timestamp) FROM readings "
+                        "WHERE sensor_id = ?;", (sensor,)).fetchone()[0]
+    if first is None: return None
+    day = bucket(first, 'day')
+    counted = con.execute("SELECT count FROM rollup_day WHERE sensor_id = ? "
+                          "AND bucket = ?;", (sensor, day)).fetchone()
+    held = con.execute("SELECT COUNT(*) FROM readings WHERE sensor_id = ? "
+                       "AND timestamp >= ? AND timestamp < ?;",
+                       (sensor, day, day + SIZES['day'])).fetchone()[0]
+    if counted is not None and counted[0] > held: day += SIZES['day']
+    return day
+
+def backfill(con, chunk=10000, end=None):
+    ''' Rebuild the rollup tables from readings older than end (all)
+
+    end is rounded down to the start of its day. Readings are read a sensor
+    at a time, chunk rows at a time, and each chunk is committed so the
+    monitor is not blocked for long. Only the rollups from the first day a
+    sensor's readings are all still held are replaced, those older stand
+    in for readings since removed or archived. Run it with the monitor
+    stopped to avoid counting readings twice. Returns the number of
+    readings rolled up.
+    '''
+
+    if end is not None: end = bucket(end, 'day')
+    sensors = [r[0] for r in con.execute("SELECT id FROM sensors;")]
+    rollup = Rollup()
+    total = 0
+    for sensor in sensors:
+        start = _held(con, sensor)
+        if start is None: continue
+        with con:
+            for tier, size in TIERS:
+                con.execute("DELETE FROM rollup_{t} WHERE sensor_id = ? "
+                            "AND bucket >= ?".format(t=tier) +
+                            (" AND bucket < ?;" if end is not None else ";"),
+                            (sensor, start) + ((end,) if end is not None
+                                               else ()))
+        last = start - 1
+        while True:
+            args = (sensor, last, end) if end is not None else (sensor, last)
+            rows = con.execute("SELECT timestamp, reading FROM readings "
+                               "WHERE sensor_id = ? AND timestamp > ? " +
+                               ("AND timestamp < ? " if end is not None
+                                else "") +
+                               "ORDER BY timestamp ASC LIMIT %d;" % chunk,
+                               args).fetchall()
+            if not rows: break
+            for ts, val in rows:
+                rollup.add(sensor, ts, val)
+            with con:
+                rollup.apply(con)
+            total += len(rows)
+            last = rows[-1][0]
+    return total
+
+def query(con, sensor, start, end, tier):
+    ''' Return a cursor of (bucket, mean, min, max) rows for a sensor between
+    start and end
+
+    mean is the average reading in the period as an int, the period start
+    falls in is included.
+    '''
+
+    return con.execute("SELECT bucket, sum / count, min, max "
+                      "FROM rollup_{tier} "
+                      "WHERE sensor_id = ? AND bucket BETWEEN ? AND ? "
+                      "ORDER BY bucket ASC;".format(tier=tier),
+                      (sensor, bucket(start, tier), int(end)))
@@ -1,68 +1,249 @@
 import os
 import sqlite3 as sqlite
 from util import check_file, make_hash
+from db import rollup
 
 class DB(object):
-    LATEST_DB = 1.0
+    ''' Create the database and keep its structure up to date
 
-    SCHEMA = """ 
-      CREATE TABLE IF NOT EXISTS readings(timestamp decimal PRIMARY KEY NOT NULL,
-                                          reading int NOT NULL);
+    Creating a DB object sets PIMMS_DB in the environment, creates the
+    database with the latest schema if it does not exist and migrates
+    older databases to the latest version otherwise.
+
+    Readings are stored per sensor, keyed on (sensor_id, timestamp) in a
+    WITHOUT ROWID table so the rows for a sensor are clustered in timestamp
+    order and a range query for one sensor is a single index seek.
+    Timestamps are integer seconds since the epoch. The average of all
+    sensors logged by the monitor is stored as sensor DB.AVG_SENSOR.
+    Minute, hour and day aggregates are kept alongside, see db.rollup.
+    The hosts table is the network inventory kept by pimmsnet.inventory.
+    Sensors are named by device id within a node, the Pi they are on, this
+    one's being DB.LOCAL_NODE and others' collected by db.ingest.
+    The database uses incremental auto vacuum so the space freed by
+    db.retention can be given back a little at a time.
+    '''
+
+    LATEST_DB = 2.4
+    AVG_SENSOR = 0
+    AVG_DEVICE = 'average'
+    LOCAL_NODE = ''
+
+    SCHEMA = """
+      CREATE TABLE IF NOT EXISTS sensors(id INTEGER PRIMARY KEY NOT NULL,
+                                         node text NOT NULL DEFAULT '',
+                                         device text NOT NULL,
+                                         family text,
+                                         UNIQUE(node, device));
+      CREATE TABLE IF NOT EXISTS readings(sensor_id INTEGER NOT NULL,
+                                          timestamp INTEGER NOT NULL,
+                                          reading int NOT NULL,
+                                          PRIMARY KEY(sensor_id, timestamp))
+                                          WITHOUT ROWID;
       CREATE TABLE IF NOT EXISTS sys(key tinytext PRIMARY KEY NOT NULL,
                                      val tinytext NOT NULL);
-      CREATE TABLE IF NOT EXISTS user(id int AUTOINCREMENT NOT NULL PRIMARY KEY,
+      CREATE TABLE IF NOT EXISTS user(id INTEGER PRIMARY KEY AUTOINCREMENT,
                                       username tinytext NOT NULL UNIQUE,
                                       passhash text NOT NULL,
                                       salt text NOT NULL,
                                       email text);
+      CREATE TABLE IF NOT EXISTS hosts(ip text PRIMARY KEY NOT NULL,
+                                       mac text,
+                                       hostname text,
+                                       first_seen INTEGER NOT NULL,
+                                       last_seen INTEGER NOT NULL,
+                                       latency real,
+                                       alive int NOT NULL DEFAULT 1);
     """
 
+    # Schema changes from each version to the next, run by migrate()
+    MIGRATIONS = {}
 
     def __init__(self, **kwargs):
         self.db = 'templog.db' if 'db' not in kwargs else kwargs['db']
-        dbstat = check_file(db)
-        os.environ['PIMMS_DB'] = db
-        if dbstat == 2: self.createdb(self.db)
+        dbstat = check_file(self.db)
+        os.environ['PIMMS_DB'] = os.path.abspath(self.db)
+        if dbstat == 2: self.createdb()
+        else: self.migrate()
+
+    @staticmethod
+    def statements():
+        ''' Return the statements creating the latest schema as a list '''
 
-    
-    def cursor(self):
-        sqlite.connect(self.db) as con:
-        return con.cursor
+        return ([st.strip() for st in DB.SCHEMA.split(';') if st.strip()] +
+                rollup.statements())
+
+    def connect(self):
+        return sqlite.connect(self.db)
 
     def createdb(self):
-        with self.cursor as cur:
-            cur.executescript(DB.SCHEMA)
+        with self.connect() as con:
+            # Only takes effect before the first table is created
+            con.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+            for stmt in DB.statements():
+                con.execute(stmt)
         self.defaultData()
 
     def defaultData(self):
         self.addadmin()
+        self.addavg()
         self.adddbver()
 
     def exists(self, table, col, val):
-        with self.cursor as cur:
-            exists = cur.execute("SELECT 1 from {tablename} WHERE {colname} "
-                                 "is '{reqval}';".format(colname = col,
-                                                         tablename=table,
-                                                         reqval=val))
-            return True if len(exists.fetchall()) > 0  else False
-  
+        with self.connect() as con:
+            exists = con.execute("SELECT 1 FROM {tablename} WHERE {colname} "
+                                 "= ?;".format(colname=col, tablename=table),
+                                 (val,))
+            return exists.fetchone() is not None
+
     def addadmin(self):
         if not self.exists('user', 'username', 'admin'):
             passhash, salt = make_hash('admin')
-            with self.cursor as cur:
-                cur.execute("INSERT INTO user(username, passhash, salt) "
-                            "VALUES ({ph}, {salt});".format(ph = passhash,
-                                                            salt = salt))
-    
-    def adddbver(self):
-        exists = self.exists('sys', 'key', 'dbver'):
-        qry = ""
-        if exists:
-            qry = "UPDATE sys SET dbver='{dbv}' "
-                  "WHERE key='dbver';".format(dbv = DB.LATEST_DB)
-        else:
-            qry = "INSERT INTO sys(key, val) VALUES "
-                  "('dbver', '{dbv}');".format(dbv=DB.LATEST_DB)
-
-        with self.cursor as cur:
-            cur.execute(qry)
+            with self.connect() as con:
+                con.execute("INSERT INTO user(username, passhash, salt) "
+                            "VALUES ('admin', ?, ?);", (passhash, salt))
+
+    def addavg(self):
+        with self.connect() as con:
+            con.execute("INSERT OR IGNORE INTO sensors(id, device) "
+                        "VALUES (?, ?);", (DB.AVG_SENSOR, DB.AVG_DEVICE))
+
+    def adddbver(self, ver=None):
+        ver = str(DB.LATEST_DB if ver is None else ver)
+        with self.connect() as con:
+            con.execute("INSERT OR REPLACE INTO sys(key, val) "
+                        "VALUES ('dbver', ?);", (ver,))
+
+    def version(self):
+        ''' Return the schema version of the database as a float '''
+
+        with self.connect() as con:
+            row = con.execute("SELECT val FROM sys "
+                              "WHERE key = 'dbver';").fetchone()
+        return float(row[0]) if row else 1.0
+
+    def migrate(self, chunk=10000):
+        ''' Bring the database up to DB.LATEST_DB one version at a time '''
+
+        ver = self.version()
+        while ver < DB.LATEST_DB:
+            print 'Migrating database from version %s' % ver
+            ver = DB.MIGRATIONS[ver](self, chunk)
+            self.adddbver(ver)
+
+    def _migrate_v1(self, chunk):
+        ''' Move the single averaged readings table to per sensor readings
+
+        The old rows are streamed across chunk rows at a time as the average
+        sensor, fractional timestamps are truncated to whole seconds.
+        '''
+
+        con = self.connect()
+        con.isolation_level = None # DDL must not commit the transaction
+        try:
+            con.execute("BEGIN;")
+            con.execute("ALTER TABLE readings RENAME TO readings_v1;")
+            for stmt in DB.statements()[:2]: # sensors and readings
+                con.execute(stmt)
+            con.execute("INSERT OR IGNORE INTO sensors(id, device) "
+                        "VALUES (?, ?);", (DB.AVG_SENSOR, DB.AVG_DEVICE))
+            cur = con.execute("SELECT timestamp, reading FROM readings_v1 "
+                              "ORDER BY timestamp ASC;")
+            ins = con.cursor()
+            while True:
+                rows = cur.fetchmany(chunk)
+                if not rows: break
+                ins.executemany("INSERT OR IGNORE INTO readings"
+                                "(sensor_id, timestamp, reading) "
+                                "VALUES (?, ?, ?);",
+                                [(DB.AVG_SENSOR, int(r[0]), int(r[1]))
+                                 for r in rows])
+            con.execute("DROP TABLE readings_v1;")
+            con.execute("COMMIT;")
+        except:
+            con.execute("ROLLBACK;")
+            raise
+        finally:
+            con.close()
+        return 2.0
+
+    MIGRATIONS[1.0] = _migrate_v1
+
+    def _migrate_v2(self, chunk):
+        ''' Add the rollup tables and build them from existing readings '''
+
+        con = self.connect()
+        try:
+            with con:
+                for stmt in rollup.statements():
+                    con.execute(stmt)
+            rollup.backfill(con, chunk)
+        finally:
+            con.close()
+        return 2.1
+
+    MIGRATIONS[2.0] = _migrate_v2
+
+    def _migrate_v2_1(self, chunk):
+        ''' Add the network host inventory '''
+
+        with self.connect() as con:
+            con.execute([st for st in DB.statements() if ' hosts(' in st][0])
+        return 2.2
+
+    MIGRATIONS[2.1] = _migrate_v2_1
+
+    def _migrate_v2_2(self, chunk):
+        ''' Switch to incremental auto vacuum, the whole file is rebuilt
+        once so this needs free space the size of the database
+        '''
+
+        con = self.connect()
+        con.isolation_level = None # VACUUM can not run in a transaction
+        try:
+            con.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+            con.execute("VACUUM;")
+        finally:
+            con.close()
+        return 2.3
+
+    MIGRATIONS[2.2] = _migrate_v2_2
+
+    def _migrate_v2_3(self, chunk):
+        ''' Add the node of each sensor, device ids are unique per node so
+        the sensors table is rebuilt, its ids and the readings are kept
+        '''
+
+        con = self.connect()
+        con.isolation_level = None # DDL must not commit the transaction
+        try:
+            con.execute("BEGIN;")
+            cols = [r[1] for r in con.execute("PRAGMA table_info(sensors);")]
+            if 'node' not in cols: # a version 1 database has it already
+                con.execute("ALTER TABLE sensors RENAME TO sensors_v2;")
+                con.execute(DB.statements()[0])
+                con.execute("INSERT INTO sensors(id, device, family) "
+                            "SELECT id, device, family FROM sensors_v2;")
+                con.execute("DROP TABLE sensors_v2;")
+            con.execute("COMMIT;")
+        except:
+            con.execute("ROLLBACK;")
+            raise
+        finally:
+            con.close()
+        return 2.4
+
+    MIGRATIONS[2.3] = _migrate_v2_3
+
+def sensor_id(con, device, family=None, node=DB.LOCAL_NODE):
+    ''' Return the id of device on node in the sensors table, adding it
+    if needed
+    '''
+
+    qry = "SELECT id FROM sensors WHERE node = ? AND device = ?;"
+    row = con.execute(qry, (node, device)).fetchone()
+    if row is None:
+        with con:
+            con.execute("INSERT OR IGNORE INTO sensors(node, device, family) "
+                        "VALUES (?, ?, ?);", (node, device, family))
+        row = con.execute(qry, (node, device)).fetchone()
+    return row[0]
@@ -0,0 +1,166 @@
+""" Shipping of this Pi's readings to a collector
+
+A Shipper reads the readings committed to the local database after those
+already shipped and posts them to the /ingest endpoint of a collector (see
+db.ingest and www.web) in batches. How far each sensor has been shipped is
+kept in the sys table and moved on only when the collector has taken a
+batch, so nothing is lost while the collector or the network is down and
+a batch sent twice is dropped by the collector as duplicates.
+
+Failed posts are retried after a delay doubling from retry up to backoff
+seconds, less a random part so nodes cut off together do not all return
+at once. Only the sensors of this node are shipped, never readings it
+collected from others, and readings moved to the archive (see db.archive)
+before they were shipped are not sent.
+
+>>> shipper = Shipper('templog.db', 'http://collector/ingest', 'kitchen')
+>>> shipper.start()     # ships every interval seconds on a daemon thread
+"""
+
+import time, json, random, threading, urllib2, httplib
+import sqlite3 as sqlite
+from db.schema import DB
+from db import ingest
+from util import metrics
+
+INTERVAL = 10.0 # seconds between shipping what has been committed
+BATCH = 5000    # readings posted at once
+RETRY = 5.0     # seconds before the first retry of a failed post
+BACKOFF = 300.0 # longest seconds between retries
+TIMEOUT = 30.0  # seconds to wait for the collector
+
+KEY = 'shipped:{sensor}'
+
+SHIPPED = metrics.counter('pimms_ship_readings_total',
+                          'Readings taken by the collector', ('result',))
+FAILURES = metrics.counter('pimms_ship_failures_total',
+                           'Batches the collector did not take')
+LAG = metrics.gauge('pimms_ship_lag_seconds',
+                    'Age of the latest reading the collector has taken')
+
+class Shipper(object):
+    ''' Post the readings of the local sensors to a collector
+
+    Arguments:
+    db -- the local database
+    url -- the collector's ingest endpoint
+    node -- the name of this Pi on the collector, unique among its nodes
+    key -- the collector's ingest key
+    interval -- seconds between shipping what has been committed
+    batch -- readings posted at once
+    '''
+
+    def __init__(self, db, url, node, key=None, interval=INTERVAL,
+                 batch=BATCH, retry=RETRY, backoff=BACKOFF, timeout=TIMEOUT,
+                 clock=time.time, sleep=time.sleep):
+        if not 0 < len(node) <= ingest.MAX_NAME:
+            raise ValueError('Invalid node name %r' % node)
+        self.db = db
+        self.url = url
+        self.node = node
+        self.key = key
+        self.interval = interval
+        self.batch = max(1, int(batch))
+        self.retry = retry
+        self.backoff = backoff
+        self.timeout = timeout
+        self.failures = 0
+        self._clock = clock
+        self._sleep = sleep
+        self._thread = None
+
+    def delay(self):
+        ''' Seconds to wait before the next post, up to backoff after
+        failures
+        '''
+
+        if not self.failures: return self.interval
+        wait = min(self.backoff, self.retry * 2 ** (self.failures - 1))
+        return wait * random.uniform(0.5, 1.0)
+
+    def pending(self, con):
+        ''' Return the readings to post next as [(sensor id, device,
+        family, [(timestamp, reading)])], at most batch readings
+        '''
+
+        shipped = dict(con.execute("SELECT key, val FROM sys "
+                                   "WHERE key LIKE ?;",
+                                   (KEY.format(sensor='%'),)).fetchall())
+        res = []
+        left = self.batch
+        for sensor, device, family in con.execute(
+                "SELECT id, device, family FROM sensors WHERE node = ? "
+                "ORDER BY id;", (DB.LOCAL_NODE,)).fetchall():
+            after = int(shipped.get(KEY.format(sensor=sensor), -1))
+            rows = con.execute("SELECT timestamp, reading FROM readings "
+                               "WHERE sensor_id = ? AND timestamp > ? "
+                               "ORDER BY timestamp ASC LIMIT ?;",
+                               (sensor, after, left)).fetchall()
+            if not rows: continue
+            res.append((sensor, device, family, rows))
+            left -= len(rows)
+            if not left: break
+        return res
+
+    def post(self, data):
+        ''' Post a batch to the collector, returns its reply '''
+
+        headers = {'Content-Type': 'application/json',
+                   'Content-Encoding': 'deflate'}
+        if self.key: headers[ingest.KEY_HEADER] = self.key
+        req = urllib2.Request(self.url, data, headers)
+        return json.loads(urllib2.urlopen(req, timeout=self.timeout).read())
+
+    def ship(self, con):
+        ''' Post the next batch and record it as shipped, returns the number
+        of readings posted
+        '''
+
+        sensors = self.pending(con)
+        if not sensors: return 0
+        reply = self.post(ingest.encode(
+            self.node, [(device, family, rows)
+                        for sensor, device, family, rows in sensors]))
+        with con:
+            con.executemany("INSERT OR REPLACE INTO sys(key, val) "
+                            "VALUES (?, ?);",
+                            [(KEY.format(sensor=sensor), str(rows[-1][0]))
+                             for sensor, device, family, rows in sensors])
+        SHIPPED.inc(reply.get('accepted', 0), result='accepted')
+        SHIPPED.inc(reply.get('duplicates', 0), result='duplicate')
+        LAG.set(self._clock() - max([rows[-1][0] for s, d, f, rows
+                                     in sensors]))
+        return sum([len(s[3]) for s in sensors])
+
+    def run(self):
+        ''' Ship until the process ends, a full batch is followed by the
+        next at once so a backlog is caught up
+        '''
+
+        con = sqlite.connect(self.db, timeout=30)
+        try:
+            while True:
+                try:
+                    full = self.ship(con) >= self.batch
+                    if self.failures:
+                        print 'Shipping to {url} resumed'.format(url=self.url)
+                    self.failures = 0
+                except (EnvironmentError, httplib.HTTPException,
+                        ValueError, sqlite.Error) as e:
+                    full = False
+                    if not self.failures:
+                        print 'Shipping to {url} failed, retrying: {err}'.format(
+                            url=self.url, err=e)
+                    self.failures += 1
+                    FAILURES.inc()
+                if not full: self._sleep(self.delay())
+        finally:
+            con.close()
+
+    def start(self):
+        ''' Ship on a daemon thread, returns the thread '''
+
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self._thread
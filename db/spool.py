@@ -0,0 +1,264 @@
+""" Store and forward of readings between the monitor and the database
+
+The sampling loop hands readings to a Spool, which puts them on a bounded
+in memory queue and returns at once. A writer thread takes them off the
+queue to a db.writer.Writer, along with the today.json updates, so a
+locked database or a slow SD card never holds up sampling.
+
+When the database can not be written the readings go to an append only
+spool file instead, one JSON line each, and the writer tries the database
+again every retry seconds. The whole file is then replayed in one
+transaction and removed. Each spool file has an id on its first line that
+is recorded in the sys table by the replay, so a file left behind by a
+crash after its replay was committed is not written twice.
+
+>>> spool = Spool(Writer('templog.db'), 'templog.db.spool', jsonf)
+>>> spool.add('28-000004a3b1c2', time.time(), 21375, 'DS18B20')
+>>> spool.add_json(time.time(), 21.375)
+>>> spool.close()   # writes everything queued
+"""
+
+import os, json, time, threading, uuid, Queue
+import sqlite3 as sqlite
+from util import metrics, profiling
+
+QUEUE = 10000   # readings held in memory before new ones are dropped
+RETRY = 30.0    # seconds between attempts to write a failed database
+SYNC = 1.0      # longest seconds the writer waits before checking for work
+
+HEADER = '# pimms spool {id}\n'
+KEY = 'spool'   # sys key of the id of the last spool file replayed
+
+READING = 'reading'
+JSON = 'json'
+_STOP = ('stop',)
+
+QUEUED = metrics.gauge('pimms_spool_queued',
+                       'Readings waiting for the writer thread')
+SPOOLED = metrics.gauge('pimms_spool_file_rows',
+                        'Readings in the spool file waiting for the database')
+DROPPED = metrics.counter('pimms_spool_dropped_total',
+                          'Readings dropped with the queue full')
+REPLAYED = metrics.counter('pimms_spool_replayed_total',
+                           'Readings written to the database from the spool file')
+
+class Spool(object):
+    ''' Queue readings for a writer thread, spooling them to a file while
+    the database can not be written
+
+    Arguments:
+    writer -- db.writer.Writer owned by the writer thread from now on, it
+              must not have connected yet as a sqlite connection is only
+              used by the thread that opened it
+    path -- the spool file
+    jsonf -- www.appjson.JSONTemps for add_json, or None
+    size -- readings queued in memory, more are dropped and counted
+    retry -- seconds between attempts to write a failed database
+    profiler -- util.profiling.Profiler also profiling the writer thread
+
+    The writer thread times its database and json writes as the 'write'
+    and 'json' stages of util.profiling.
+    '''
+
+    def __init__(self, writer, path, jsonf=None, size=QUEUE, retry=RETRY,
+                 clock=time.time, profiler=None):
+        self.writer = writer
+        self.path = path
+        self.jsonf = jsonf
+        self.retry = retry
+        self.profiler = profiler
+        self._stages = profiling.Stages()
+        self.dropped = 0
+        self._clock = clock
+        self._queue = Queue.Queue(size)
+        self._failed = None # time of the last failed write
+        self._spooled = 0
+        if os.path.exists(path):
+            # Left by an earlier run, replayed by the first pass
+            self._failed = clock() - retry
+        self._thread = threading.Thread(target=self._run, name='spool')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def queued(self):
+        return self._queue.qsize()
+
+    def add(self, sensor, timestamp, val, family=None):
+        ''' Queue a reading for a sensors table id or device id
+
+        Never waits, the reading is dropped if the queue is full.
+        '''
+
+        self._put((READING, sensor, family, int(timestamp), val))
+
+    def add_json(self, timestamp, temp, sensors=None):
+        ''' Queue an update of today's json, @see JSONTemps.add_val '''
+
+        if self.jsonf is not None:
+            self._put((JSON, timestamp, temp, sensors))
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except Queue.Full:
+            if not self.dropped % 100:
+                print 'Spool queue full, readings are being dropped'
+            self.dropped += 1
+            DROPPED.inc()
+
+    def close(self):
+        ''' Write everything queued, stop the writer thread and close the
+        writer
+        '''
+
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        try:
+            self._loop()
+        finally:
+            if self.profiler is not None: self.profiler.follow()
+
+    def _loop(self):
+        while True:
+            if self.profiler is not None: self.profiler.follow()
+            try:
+                items = [self._queue.get(timeout=SYNC)]
+            except Queue.Empty:
+                items = []
+            # Take a backlog in one go so it is written in one transaction
+            while items[-1:] != [_STOP]:
+                try:
+                    items.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = items[-1:] == [_STOP]
+            if stop: items.pop()
+            QUEUED.set(self._queue.qsize())
+            self._stages.begin()
+            updates = [i[1:] for i in items if i[0] == JSON]
+            if updates:
+                with self._stages.stage('json'):
+                    self._json(updates)
+            readings = [i[1:] for i in items if i[0] == READING]
+            if readings or stop:
+                with self._stages.stage('write'):
+                    self._store(readings, stop)
+            else:
+                self._store(readings) # a replay may be due
+            self._stages.end()
+            if stop: return
+
+    def _json(self, updates):
+        for t, temp, sensors in updates:
+            try:
+                self.jsonf.add_val(t, temp, sensors)
+            except EnvironmentError as e:
+                print 'Today json not updated: {err}'.format(err=e)
+
+    def _sensor(self, sensor, family):
+        ''' The sensors table id of a device id or id '''
+
+        if isinstance(sensor, (int, long)): return sensor
+        return self.writer.sensor(sensor, family)
+
+    def _store(self, readings, closing=False):
+        ''' Write readings to the database, or to the spool file while it
+        is failing
+        '''
+
+        if self._failed is not None:
+            self._append(readings)
+            if self._clock() - self._failed >= self.retry or closing:
+                self._replay()
+            if closing: self.writer.close()
+            return
+        added = 0
+        try:
+            for sensor, family, t, val in readings:
+                self.writer.add(self._sensor(sensor, family), t, val,
+                                sync=False)
+                added += 1
+            if closing: self.writer.close()
+            else: self.writer.sync()
+        except sqlite.Error as e:
+            self._fail(e)
+            # The writer's pending rows hold table ids, the rest are
+            # spooled as they came
+            self._append([[r[0], None, r[1], r[2]] for r in self.writer.take()]
+                         + readings[added:])
+            if closing: self.writer.close()
+
+    def _fail(self, err):
+        if self._failed is None:
+            print 'Database write failed, spooling readings to {f}: {err}'.format(
+                f=self.path, err=err)
+        self._failed = self._clock()
+
+    def _append(self, rows):
+        if not rows: return
+        try:
+            new = not os.path.exists(self.path)
+            with open(self.path, 'a') as f:
+                if new: f.write(HEADER.format(id=uuid.uuid4().hex))
+                f.write(''.join([json.dumps(list(r)) + '\n' for r in rows]))
+                f.flush()
+                os.fsync(f.fileno())
+        except EnvironmentError as e:
+            print 'Spool write failed, {n} readings lost: {err}'.format(
+                n=len(rows), err=e)
+            return
+        self._spooled += len(rows)
+        SPOOLED.set(self._spooled)
+
+    def _read(self):
+        ''' Return the id and rows of the spool file '''
+
+        with open(self.path) as f:
+            header = f.readline().split()
+            rows = []
+            for line in f:
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    pass # the end of a write cut short
+        return header[-1] if header else '', rows
+
+    def _replay(self):
+        ''' Write the whole spool file in one transaction and remove it '''
+
+        try:
+            spool_id, rows = self._read()
+        except EnvironmentError:
+            # Nothing spooled since the database failed
+            self._failed = None
+            return
+        try:
+            con = self.writer.con
+            done = con.execute("SELECT val FROM sys WHERE key = ?;",
+                               (KEY,)).fetchone()
+            done = done is not None and done[0] == spool_id
+            if not done:
+                for sensor, family, t, val in rows:
+                    self.writer.add(self._sensor(sensor, family), t, val,
+                                    sync=False)
+                self.writer.flush(also=lambda con: con.execute(
+                    "INSERT OR REPLACE INTO sys(key, val) VALUES (?, ?);",
+                    (KEY, spool_id)))
+        except sqlite.Error as e:
+            self.writer.take() # still in the file
+            self._fail(e)
+            return
+        os.remove(self.path)
+        if done:
+            print 'Spool file {f} was already written, removed'.format(
+                f=self.path)
+        else:
+            print 'Database writable, {n} spooled readings written'.format(
+                n=len(rows))
+            REPLAYED.inc(len(rows))
+        self._failed = None
+        self._spooled = 0
+        SPOOLED.set(0)
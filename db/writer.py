@@ -0,0 +1,131 @@
+import time
+import sqlite3 as sqlite
+from db.schema import sensor_id
+from db.rollup import Rollup
+from db import extents
+from util import metrics
+
+COMMIT_SECONDS = metrics.histogram('pimms_db_commit_seconds',
+                                   'Time taken to commit a batch of readings')
+ROWS = metrics.counter('pimms_db_rows_total', 'Readings written')
+
+class Writer(object):
+    ''' Write readings to the database in batches over one connection
+
+    The connection is opened once and kept, the database is switched to WAL
+    journaling so readers (the web app) are not blocked while a batch is
+    committed. Rows are held until either batch rows are pending or the
+    oldest pending row has waited delay seconds, so at most delay seconds
+    of readings can be lost if the process dies. Call sync() regularly to
+    honour the delay when rows arrive slowly, and close() on the way out.
+    The rollup tables and the reading extents (see db.extents) are updated
+    in the same transaction with the readings actually inserted, a reading
+    already held for its sensor and timestamp (replayed from the spool
+    after a crash) is left as it is and not counted again.
+
+    >>> w = Writer('templog.db', batch=10, delay=300)
+    >>> w.add(w.sensor('28-000004a3b1c2'), time.time(), 21375)
+    >>> w.sync()
+    >>> w.close()
+    '''
+
+    INSERT = ("INSERT OR IGNORE INTO readings(sensor_id, timestamp, reading) "
+              "VALUES (?, ?, ?);")
+
+    def __init__(self, db, batch=10, delay=300.0, clock=time.time):
+        self.db = db
+        self.batch = max(1, int(batch))
+        self.delay = float(delay)
+        self._clock = clock
+        self._rows = []
+        self._first = None   # time the oldest pending row was added
+        self._con = None
+        self._sensors = {}   # device id -> sensors table id
+
+    @property
+    def con(self):
+        ''' The open database connection, connecting if needed '''
+
+        if self._con is None:
+            self._con = sqlite.connect(self.db, timeout=30)
+            self._con.execute("PRAGMA journal_mode=WAL;")
+        return self._con
+
+    @property
+    def pending(self):
+        return len(self._rows)
+
+    def sensor(self, device, family=None):
+        ''' Return the sensors table id of device, adding it if needed '''
+
+        if device not in self._sensors:
+            self._sensors[device] = sensor_id(self.con, device, family)
+        return self._sensors[device]
+
+    def add(self, sensor, timestamp, val, sync=True):
+        ''' Queue a reading for a sensor id and commit the batch if it is due
+
+        timestamp is truncated to whole seconds. With sync False the batch
+        is left for the next sync() or flush().
+        '''
+
+        if not self._rows: self._first = self._clock()
+        self._rows.append((sensor, int(timestamp), val))
+        if sync: self.sync()
+
+    def take(self):
+        ''' Remove and return the pending rows, for keeping elsewhere when
+        the database can not be written
+        '''
+
+        rows = self._rows
+        self._rows = []
+        self._first = None
+        return rows
+
+    def due(self):
+        ''' True if the pending rows should be committed now '''
+
+        if not self._rows: return False
+        return (len(self._rows) >= self.batch or
+                self._clock() - self._first >= self.delay)
+
+    def sync(self):
+        ''' Commit pending rows if the batch size or delay has been reached'''
+
+        if self.due(): self.flush()
+
+    def flush(self, also=None):
+        ''' Commit all pending rows in one transaction
+
+        also(connection) is called in the same transaction when given.
+        Pending rows are kept if the commit fails.
+        '''
+
+        if not self._rows: return
+        rollup = Rollup()
+        new = []
+        with COMMIT_SECONDS.time():
+            with self.con:
+                cur = self.con.cursor()
+                for row in self._rows:
+                    cur.execute(Writer.INSERT, row)
+                    if cur.rowcount == 1:
+                        new.append(row)
+                        rollup.add(*row)
+                rollup.apply(self.con)
+                extents.update(self.con, new)
+                if also is not None: also(self.con)
+        ROWS.inc(len(new))
+        self._rows = []
+        self._first = None
+
+    def close(self):
+        ''' Commit anything pending and close the connection '''
+
+        try:
+            self.flush()
+        finally:
+            if self._con is not None:
+                self._con.close()
+                self._con = None
@@ -1,11 +1,22 @@
-import os
-import sqlite3 as sqlite
+import os, sys, signal, tempfile, socket
 from optparse import OptionParser
 from sensors.w1 import Wire
+from sensors.hotplug import Hotplug
 from sensors.reading import Reading
 from datefuncs.dt import now
+from db.schema import DB
+from db.writer import Writer
+from db.spool import Spool
+from db import retention, archive, ship
+from util.sched import Scheduler
+from util import metrics, profiling, shm
 from www.appjson import JSONTemps as jsonT
 
+# Scheduler keys of the tasks that are not sensors, never a device id
+LOG_TASK = '__log__'
+HOTPLUG_TASK = '__hotplug__'
+TASKS = (LOG_TASK, HOTPLUG_TASK)
+
 parser = OptionParser()
 parser.add_option('-d', '--db', default='templog.db', dest='db',
 			help='Database location')
@@ -13,46 +24,277 @@ parser.add_option('-i', '--int', default=60, dest='logint', type='int',
 			help='Log interval')
 parser.add_option('-j', '--json', default='www/static/json/', dest='jsonf',
 			help='Location for created JSON files')
+parser.add_option('--jsonmode', default=jsonT.DELTA, dest='jsonmode',
+			choices=jsonT.MODES, help='today.json output, delta appends '
+			'each value to a separate file, full rewrites the whole day')
+parser.add_option('-s', '--sample', default=5.0, dest='sample', type='float',
+			help='Default sensor sample period in seconds')
+parser.add_option('-c', '--concurrency', default=1, dest='concurrency',
+			type='int', help='Number of sensors read at the same time')
+parser.add_option('--no-bulk', default=True, dest='bulk', action='store_false',
+			help='Convert each sensor in turn even if the kernel can '
+			'convert them all at once')
+parser.add_option('-b', '--batch', default=10, dest='batch', type='int',
+			help='Readings committed to the database at once')
+parser.add_option('--commit', default=300.0, dest='commit', type='float',
+			help='Longest time in seconds a reading waits to be committed')
+parser.add_option('--shm', default=os.environ.get('PIMMS_SHM', shm.DEFAULT),
+			dest='shm', metavar='FILE',
+			help='Shared memory file the latest reading of each sensor '
+			'is published to for the web app')
+parser.add_option('--spool', default=None, dest='spool', metavar='FILE',
+			help='Readings are kept in FILE while the database can not be '
+			'written, the database location with .spool by default')
+parser.add_option('-p', '--period', default=[], dest='periods',
+			action='append', metavar='DEVICE=SECONDS',
+			help='Sample period for a single sensor, may be repeated')
+parser.add_option('--hotplug', default=2.0, dest='hotplug', type='float',
+			help='Seconds between checks for sensors added or removed')
+parser.add_option('--metrics', default=9101, dest='metrics', type='int',
+			help='Local port serving the monitor metrics at /metrics, '
+			'0 for none')
+parser.add_option('--profile', default=None, dest='profile', metavar='FILE',
+			help='Profile from the start, writing FILE on exit. SIGUSR1 '
+			'starts and stops profiling at any time')
+parser.add_option('--profile-mode', default=profiling.CPROFILE,
+			dest='profile_mode', choices=profiling.MODES,
+			help='cprofile for every call or sample for a low overhead '
+			'statistical profile')
+parser.add_option('-k', '--keep', default=[], dest='keep', action='append',
+			metavar='RESOLUTION=DAYS',
+			help='Days readings (raw) or a rollup (minute, hour, day) are '
+			'kept, 0 for forever, may be repeated. Everything is kept '
+			'forever unless given')
+parser.add_option('--prune', default=1.0, dest='prune', type='float',
+			help='Days between removing readings older than they are '
+			'kept, 0 for never')
+parser.add_option('--archive', default=archive.AFTER, dest='archive',
+			type='int', help='Days before readings are moved to the '
+			'compressed archive, 0 for never')
+parser.add_option('--ship', default=None, dest='ship', metavar='URL',
+			help='Send the readings to the ingest endpoint of a collector, '
+			'e.g. http://collector/ingest')
+parser.add_option('--node', default=socket.gethostname(), dest='node',
+			help='Name of this Pi on the collector, the host name by '
+			'default')
+parser.add_option('--ship-key', default=os.environ.get('PIMMS_SHIP_KEY'),
+			dest='ship_key', metavar='KEY',
+			help='Ingest key of the collector, PIMMS_SHIP_KEY by default')
+parser.add_option('--ship-every', default=ship.INTERVAL, dest='ship_every',
+			type='float', help='Seconds between sending readings to the '
+			'collector')
+
+SAMPLES = metrics.gauge('pimms_interval_samples',
+                        'Valid samples in the last log interval', ('sensor',))
+OVERRUNS = metrics.counter('pimms_sample_overruns_total',
+                           'Sample deadlines missed', ('sensor',))
+
+class Window(object):
+    ''' Aggregate sensor values over one log interval
+
+    Values are kept per sensor so a sensor sampled more often than the others
+    does not dominate the average, avg() returns the mean of the per sensor
+    means.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._sums = {}
+        self._counts = {}
+
+    def add(self, vals):
+        ''' Add a dict of {device: value} to the window '''
+
+        for dev, v in vals.iteritems():
+            self._sums[dev] = self._sums.get(dev, 0) + v
+            self._counts[dev] = self._counts.get(dev, 0) + 1
+
+    def means(self):
+        ''' Return a dict of {device: mean value as int} for the window '''
+
+        return dict([(d, int(round(float(self._sums[d]) / self._counts[d])))
+                     for d in self._counts])
+
+    @property
+    def samples(self):
+        return sum(self._counts.itervalues())
+
+    def count(self, dev):
+        ''' Return the number of values added for dev '''
+
+        return self._counts.get(dev, 0)
+
+    def avg(self):
+        ''' Return the window average as an int or None if it is empty '''
+
+        if not self._counts: return None
+        means = [float(self._sums[d]) / self._counts[d] for d in self._counts]
+        return int(round(sum(means) / len(means)))
 
-def get_temps(wire):
-    ''' Retrieve the temperature values from all sensors on the wire'''
-    actvals = []
-    for dev in wire.devices:
-        v = dev.val # retrieving val calls read and updates the sensor
-        if dev.isvalid == Reading.VALID:
-            actvals.append(v) 
-    assert len(actvals) > 0
-    return sum(actvals) / len(actvals)
-
-def log_avg(temp, logtime, db):
+def sensor_periods(periods):
+    ''' Parse a list of DEVICE=SECONDS strings into a dict '''
+
+    res = {}
+    for p in periods:
+        dev, sep, secs = p.partition('=')
+        try:
+            secs = float(secs)
+        except ValueError:
+            secs = 0
+        if not sep or secs <= 0:
+            parser.error('Invalid sample period %s' % p)
+        res[dev.strip()] = secs
+    return res
+
+def schedule_devices(sched, wire, sample, periods):
+    ''' Keep the scheduler tasks in step with the devices on the wire '''
+
+    ids = set([d.device for d in wire.devices])
+    for key in [k for k in sched.stats if k not in TASKS and k not in ids]:
+        sched.remove(key)
+    for dev in ids:
+        if dev not in sched:
+            sched.add(dev, periods.get(dev, sample))
+
+def report_overruns(sched, reported):
+    ''' Print any sensors that have missed sample deadlines since last time'''
+
+    for key, stats in sched.stats.iteritems():
+        if key == HOTPLUG_TASK: continue
+        if stats.overruns > reported.get(key, 0):
+            OVERRUNS.inc(stats.overruns - reported.get(key, 0), sensor=key)
+            print 'Sample overrun {dev}: {n} missed, max jitter {j:.3f}s'.format(
+                dev=key, n=stats.overruns - reported.get(key, 0),
+                j=stats.max_jitter)
+            reported[key] = stats.overruns
+
+def report_hotplug(added, removed):
+    for dev in added: print 'Sensor added {dev}'.format(dev=dev)
+    for dev in removed: print 'Sensor removed {dev}'.format(dev=dev)
+
+def profile_file(options):
+    if options.profile: return options.profile
+    return os.path.join(tempfile.gettempdir(),
+                        'pimms-monitor-%d.prof' % os.getpid())
+
+def publish(publisher, wire):
+    ''' Publish the latest read and value of each sensor '''
+
+    current = []
+    for d in wire.devices:
+        latest = d.history.latest()
+        read, status = (d.current.time, d.isvalid) if latest is None \
+            else (latest[0], latest[2])
+        current.append((d.device, d.current.real_val, status, read,
+                        d.current.time))
+    publisher.publish(sorted(current))
+
+def get_temps(wire, devices):
+    ''' Retrieve the valid temperature values from the given sensors
+
+    Returns a dict of {device id: value}
+    '''
+    return dict([(dev, res.val) for dev, res in wire.read(devices).iteritems()
+                 if res.status == Reading.VALID])
+
+def log_avg(temp, logtime, spool):
     ''' log average temperature to the database '''
-    with sqlite.connect(db) as con:
-        cur = con.cursor()
-        cur.execute("INSERT INTO readings VALUES({timestamp}, {temp})".format(
-                timestamp = logtime, temp = temp))
+    spool.add(DB.AVG_SENSOR, logtime, temp)
+
+def log_sensors(means, logtime, spool, wire):
+    ''' log the interval mean of each sensor to the database '''
+    families = dict([(d.device, d.family) for d in wire.devices])
+    for dev, val in means.iteritems():
+        spool.add(dev, logtime, val, families.get(dev))
+
+def term_handler(signal, frame):
+    sys.exit(0)
 
 def main_func():
     print 'Monitor Running.'
     (options, args) = parser.parse_args()
-    log_int = options.logint # Log Interval
-    lastlog = 0  # Time we last logged to the db
-    wire = Wire()
-    temps = [] # current loop temperatures
+    periods = sensor_periods(options.periods)
+    try:
+        policy = retention.parse(options.keep)
+    except ValueError as e:
+        parser.error(str(e))
+    wire = Wire(options.concurrency, options.bulk)
+    hotplug = Hotplug(on_add=wire.add, on_remove=wire.remove)
+    window = Window() # current log interval temperatures
+    publisher = shm.Publisher(options.shm)
+    sched = Scheduler()
+    # A pass of the loop over the sample period falls behind the sensors
+    stages = profiling.Stages(budget=options.sample)
+    profiler = profiling.Profiler(profile_file(options), options.profile_mode)
+    profiler.install()
+    if options.profile: profiler.start()
+    overruns = {}
+    signal.signal(signal.SIGTERM, term_handler)
+    if options.metrics: metrics.serve(options.metrics)
+    if options.prune > 0:
+        retention.start(os.environ['PIMMS_DB'], policy,
+                        options.prune * retention.DAY,
+                        archive=archive.Archive(
+                            archive.directory(os.environ['PIMMS_DB']),
+                            options.archive or None))
+    if options.ship:
+        try:
+            ship.Shipper(os.environ['PIMMS_DB'], options.ship, options.node,
+                         options.ship_key, options.ship_every).start()
+        except ValueError as e:
+            parser.error(str(e))
     jsonf = jsonT(os.path.join(os.path.dirname(os.path.abspath(__file__)), 
                               options.jsonf, 'today.json'),
-                  os.environ['PIMMS_DB'])
-    while True:
-        t = now()
-        if t >= lastlog + log_int:
-            lastlog = t
-            if len(temps) > 0: 
-                temp = sum(temps) / len(temps)
-                log_avg(temp, t, os.environ['PIMMS_DB'])
-                jsonf.add_val(t, temp/1000.0)
-            temps = []
-            wire.detect_devices()
-        else:
-            temps.append(get_temps(wire))
+                  os.environ['PIMMS_DB'], options.jsonmode)
+    # Storage is written from the spool's own thread so it can not hold up
+    # sampling
+    spool = Spool(Writer(os.environ['PIMMS_DB'], options.batch,
+                         options.commit),
+                  options.spool or os.environ['PIMMS_DB'] + '.spool', jsonf,
+                  profiler=profiler)
+    sched.add(LOG_TASK, options.logint, now() + options.logint)
+    sched.add(HOTPLUG_TASK, options.hotplug)
+    schedule_devices(sched, wire, options.sample, periods)
+    try:
+        while True:
+            due = sched.wait()
+            stages.begin()
+            if LOG_TASK in due:
+                due.remove(LOG_TASK)
+                t = now()
+                temp = window.avg()
+                for dev in [d.device for d in wire.devices]:
+                    SAMPLES.set(window.count(dev), sensor=dev)
+                if temp is not None:
+                    means = window.means()
+                    with stages.stage('log'):
+                        log_avg(temp, t, spool)
+                        log_sensors(means, t, spool, wire)
+                        spool.add_json(t, temp/1000.0, dict(
+                            [(d, v/1000.0) for d, v in means.iteritems()]))
+                window.reset()
+                report_overruns(sched, overruns)
+            if HOTPLUG_TASK in due:
+                due.remove(HOTPLUG_TASK)
+                with stages.stage('detect'):
+                    added, removed = hotplug.check()
+                    if added or removed:
+                        report_hotplug(added, removed)
+                        schedule_devices(sched, wire, options.sample, periods)
+            if due:
+                with stages.stage('read'):
+                    temps = get_temps(wire, [d for d in wire.devices
+                                             if d.device in due])
+                window.add(temps)
+                publish(publisher, wire)
+            stages.end()
+    finally:
+        profiler.stop()
+        spool.close()
+        hotplug.close()
+        wire.close()
 
 if __name__ == '__main__':
     main_func()
@@ -0,0 +1,43 @@
+import time
+from optparse import OptionParser
+from pimmsnet.scan import DEFAULT_CIDR, testloc
+from pimmsnet.inventory import Inventory
+from db.schema import DB
+
+parser = OptionParser(usage='python -m pimmsnet [options] [a.b.c.d/n]')
+parser.add_option('-c', '--concurrency', default=128, dest='concurrency',
+			type='int', help='Most hosts probed at once')
+parser.add_option('-t', '--timeout', default=1.0, dest='timeout',
+			type='float', help='Seconds to wait for a host to answer')
+parser.add_option('-n', '--no-dns', default=True, dest='resolve',
+			action='store_false', help='Do not look up host names')
+parser.add_option('-p', '--port', default=80, dest='port', type='int',
+			help='TCP port probed when ICMP is not permitted')
+parser.add_option('-w', '--watch', default=False, dest='watch',
+			action='store_true',
+			help='Keep the host inventory in the database up to date')
+parser.add_option('-d', '--db', default='templog.db', dest='db',
+			help='Database location for the host inventory')
+parser.add_option('--live', default=60, dest='live', type='float',
+			help='Seconds between checks of the hosts that are up')
+parser.add_option('--sweep', default=900, dest='sweep', type='float',
+			help='Seconds between scans of the whole network')
+
+def print_change(host, up):
+    stamp = time.strftime('%Y-%m-%d %H:%M:%S')
+    if up:
+        print stamp, 'up', host.ip, host.mac, host.hostname
+    else:
+        print stamp, 'down', host
+
+if __name__ == '__main__':
+    (options, args) = parser.parse_args()
+    cidr = args[0] if args else DEFAULT_CIDR
+    scan_args = dict(concurrency=options.concurrency, timeout=options.timeout,
+                     resolve=options.resolve, port=options.port)
+    if options.watch:
+        db = DB(db=options.db)
+        Inventory(db.db, cidr, options.live, options.sweep,
+                  **scan_args).run(print_change)
+    else:
+        testloc(cidr, **scan_args)
@@ -0,0 +1,110 @@
+""" Persistent inventory of the hosts on a network
+
+Hosts found by the Scanner are kept in the hosts table of the readings
+database with when they were first and last seen, their MAC, hostname and
+latency. Rescans are incremental, the hosts known to be up are checked
+every live_interval seconds and the rest of the network is only swept
+every sweep_interval seconds, so watching a network costs a handful of
+probes most of the time.
+"""
+
+import time
+import sqlite3 as sqlite
+from pimmsnet.scan import Scanner, DEFAULT_CIDR
+from util.sched import Scheduler
+
+LIVE = 'live'
+SWEEP = 'sweep'
+
+class Inventory(object):
+    ''' Keep the hosts table up to date with the hosts on cidr
+
+    >>> inv = Inventory('templog.db', '192.168.1.0/24')
+    >>> inv.sweep()          # everything
+    >>> inv.check_live()     # just the hosts that were up
+    >>> inv.run(on_change)   # forever, on_change(host, up) for changes
+
+    Scanner keyword arguments (timeout, concurrency...) are passed on.
+    '''
+
+    def __init__(self, db, cidr=DEFAULT_CIDR, live_interval=60,
+                 sweep_interval=900, **kwargs):
+        self.db = db
+        self.cidr = cidr
+        self.live_interval = live_interval
+        self.sweep_interval = sweep_interval
+        self._scanner_args = kwargs
+
+    def hosts(self, alive=None):
+        ''' Return the inventory as a list of rows, optionally only those
+        up (alive=True) or down (alive=False)
+        '''
+
+        qry = ("SELECT ip, mac, hostname, first_seen, last_seen, latency, "
+               "alive FROM hosts")
+        args = ()
+        if alive is not None:
+            qry += " WHERE alive = ?"
+            args = (1 if alive else 0,)
+        with sqlite.connect(self.db) as con:
+            return con.execute(qry + " ORDER BY ip;", args).fetchall()
+
+    def sweep(self):
+        ''' Scan the whole network, returns a list of (Host, up) changes '''
+
+        return self._scan(None)
+
+    def check_live(self):
+        ''' Scan the hosts that were up, returns a list of (Host, up) changes'''
+
+        return self._scan([h[0] for h in self.hosts(alive=True)])
+
+    def _scan(self, targets):
+        ''' Scan targets (None for all) and record the results '''
+
+        if targets is not None and not targets: return []
+        scanner = Scanner(self.cidr, **self._scanner_args)
+        now = int(time.time())
+        with sqlite.connect(self.db) as con:
+            before = dict(con.execute("SELECT ip, alive FROM hosts;"))
+        found = list(scanner.scan(targets))
+        changes = []
+        with sqlite.connect(self.db) as con:
+            con.executemany("INSERT OR IGNORE INTO hosts(ip, first_seen, "
+                            "last_seen) VALUES (?, ?, ?);",
+                            [(h.ip, now, now) for h in found])
+            # A MAC or hostname that can not be found now keeps the old one
+            con.executemany("UPDATE hosts SET mac = COALESCE(?, mac), "
+                            "hostname = COALESCE(?, hostname), last_seen = ?, "
+                            "latency = ?, alive = 1 WHERE ip = ?;",
+                            [(h.mac, h.hostname, now, h.latency, h.ip)
+                             for h in found])
+            up = set([h.ip for h in found])
+            checked = (set(targets) if targets is not None else
+                       set([ip for ip, alive in before.iteritems() if alive]))
+            down = [ip for ip in checked - up if before.get(ip)]
+            con.executemany("UPDATE hosts SET alive = 0 WHERE ip = ?;",
+                            [(ip,) for ip in down])
+        for h in found:
+            if not before.get(h.ip): changes.append((h, True))
+        for ip in down:
+            changes.append((ip, False))
+        return changes
+
+    def run(self, on_change=None):
+        ''' Rescan forever, calling on_change(host, up) for every change
+
+        host is a Host when it comes up and its ip when it goes down.
+        '''
+
+        sched = Scheduler()
+        sched.add(SWEEP, self.sweep_interval)
+        sched.add(LIVE, self.live_interval, time.time() + self.live_interval)
+        while True:
+            due = sched.wait()
+            if SWEEP in due: changes = self.sweep()
+            elif LIVE in due: changes = self.check_live()
+            else: continue # woken before a deadline
+            if on_change is not None:
+                for host, up in changes:
+                    on_change(host, up)
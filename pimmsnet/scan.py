@@ -0,0 +1,317 @@
+""" Single process network scanner
+
+Hosts are probed with ICMP echo requests over one socket, an unprivileged
+ping socket where the kernel allows it (net.ipv4.ping_group_range) or a raw
+socket when running as root. If neither is available a non blocking TCP
+connect to a port is used instead, a refused connection still shows the
+host is alive. At most concurrency probes are outstanding at once and each
+has its own timeout, the probes are multiplexed with select so the whole
+scan runs in one thread. Reverse DNS lookups are handed to a few daemon
+threads so a slow resolver never holds up the scan.
+"""
+
+import os, socket, struct, select, time, errno
+from threading import Thread
+from Queue import Queue, Empty
+from collections import namedtuple
+
+DEFAULT_CIDR = '192.168.1.0/24'
+ARP_TABLE = '/proc/net/arp'
+
+Host = namedtuple('Host', 'ip mac hostname latency')
+
+def hosts(cidr):
+    ''' Yield the host addresses of an IPv4 network in a.b.c.d/n form
+
+    The network and broadcast addresses are skipped for networks larger
+    than /31.
+    '''
+
+    addr, sep, bits = cidr.partition('/')
+    bits = int(bits) if sep else 32
+    if not 0 <= bits <= 32:
+        raise ValueError('Invalid network %s' % cidr)
+    mask = (0xffffffff << (32 - bits)) & 0xffffffff
+    net = struct.unpack('!I', socket.inet_aton(addr))[0] & mask
+    size = 1 << (32 - bits)
+    first, last = (0, size) if bits >= 31 else (1, size - 1)
+    for i in xrange(first, last):
+        yield socket.inet_ntoa(struct.pack('!I', net + i))
+
+def neighbours(table=ARP_TABLE):
+    ''' Return {ip: mac} of the complete entries in the kernel ARP table '''
+
+    res = {}
+    try:
+        with open(table, 'r') as f:
+            f.readline() # header
+            for line in f:
+                cols = line.split()
+                # ip, hw type, flags, mac, mask, device, 0x2 is complete
+                if len(cols) >= 4 and int(cols[2], 16) & 0x2:
+                    res[cols[0]] = cols[3]
+    except IOError:
+        pass
+    return res
+
+def checksum(data):
+    ''' Internet checksum of data '''
+
+    if len(data) % 2: data += '\0'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+class Resolver(object):
+    ''' Reverse DNS lookups on a few daemon threads
+
+    submit() queues an address, results() returns the (ip, hostname) pairs
+    finished so far. Threads stuck on a slow lookup are daemons so never
+    keep the process alive, call close() when done.
+    '''
+
+    def __init__(self, workers=4):
+        self._in = Queue()
+        self._out = Queue()
+        self._threads = []
+        for i in range(workers):
+            t = Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        while True:
+            ip = self._in.get()
+            if ip is None: return
+            try:
+                name = socket.gethostbyaddr(ip)[0]
+            except (socket.herror, socket.gaierror, socket.error):
+                name = None
+            self._out.put((ip, name))
+
+    def submit(self, ip):
+        self._in.put(ip)
+
+    def results(self, timeout=0):
+        ''' Return finished lookups, waiting up to timeout for the first '''
+
+        res = []
+        try:
+            res.append(self._out.get(timeout > 0, timeout or None))
+            while True:
+                res.append(self._out.get_nowait())
+        except Empty:
+            pass
+        return res
+
+    def close(self, wait=0.1):
+        ''' Stop the threads, waiting up to wait seconds for idle ones '''
+
+        for t in self._threads:
+            self._in.put(None)
+        deadline = time.time() + wait
+        for t in self._threads:
+            t.join(max(deadline - time.time(), 0))
+
+class Scanner(object):
+    ''' Find the live hosts on a network
+
+    >>> for host in Scanner('192.168.1.0/24').scan():
+    ...     print host.ip, host.mac, host.hostname, host.latency
+
+    scan() is a generator, hosts are yielded as they answer (after their
+    reverse lookup when resolve is True).
+
+    Arguments:
+    cidr -- the network to scan in a.b.c.d/n form
+    concurrency -- the most probes outstanding at once
+    timeout -- seconds to wait for each host to answer
+    resolve -- look up host names, taking at most dns_timeout seconds
+    port -- TCP port probed when ICMP can not be used
+    '''
+
+    ICMP_ECHO = 8
+    ICMP_ECHO_REPLY = 0
+
+    def __init__(self, cidr=DEFAULT_CIDR, concurrency=128, timeout=1.0,
+                 resolve=True, dns_timeout=2.0, port=80):
+        self.cidr = cidr
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.resolve = resolve
+        self.dns_timeout = dns_timeout
+        self.port = port
+        self.method = None # 'ping', 'raw' or 'tcp' once a scan has started
+        self._neighbours = {}
+
+    def scan(self, targets=None):
+        ''' Probe targets (default all hosts in cidr) and yield live Hosts '''
+
+        targets = hosts(self.cidr) if targets is None else iter(targets)
+        sock = self._icmp_socket()
+        if sock is None:
+            probes = self._tcp_probe(targets)
+        else:
+            probes = self._icmp_probe(sock, targets)
+        if not self.resolve:
+            for ip, latency in probes:
+                yield self._host(ip, latency, None)
+            return
+        resolver = Resolver()
+        pending = {}
+        try:
+            for ip, latency in probes:
+                pending[ip] = (latency, time.time())
+                resolver.submit(ip)
+                for ip, name in resolver.results():
+                    yield self._host(ip, pending.pop(ip)[0], name)
+            while pending:
+                wait = min([t for l, t in pending.itervalues()]) + \
+                       self.dns_timeout - time.time()
+                done = resolver.results(max(wait, 0.001))
+                for ip, name in done:
+                    yield self._host(ip, pending.pop(ip)[0], name)
+                if not done:
+                    for ip in [ip for ip, (l, t) in pending.iteritems()
+                               if time.time() - t >= self.dns_timeout]:
+                        yield self._host(ip, pending.pop(ip)[0], None)
+        finally:
+            resolver.close()
+
+    def _host(self, ip, latency, hostname):
+        # The kernel learns the MAC when the host answers, only read the
+        # table again for addresses it did not have last time
+        if ip not in self._neighbours:
+            self._neighbours = neighbours()
+        return Host(ip, self._neighbours.get(ip), hostname, latency)
+
+    def _icmp_socket(self):
+        ''' Return a ping or raw ICMP socket, None if neither is allowed '''
+
+        for kind, method in ((socket.SOCK_DGRAM, 'ping'),
+                             (socket.SOCK_RAW, 'raw')):
+            try:
+                sock = socket.socket(socket.AF_INET, kind,
+                                     socket.getprotobyname('icmp'))
+                sock.setblocking(0)
+                self.method = method
+                return sock
+            except socket.error as e:
+                if e.errno not in (errno.EPERM, errno.EACCES,
+                                   errno.EPROTONOSUPPORT):
+                    raise
+        self.method = 'tcp'
+        return None
+
+    def _echo(self, ident, seq):
+        header = struct.pack('!BBHHH', Scanner.ICMP_ECHO, 0, 0, ident, seq)
+        payload = 'pimmsnet'
+        return struct.pack('!BBHHH', Scanner.ICMP_ECHO, 0,
+                           checksum(header + payload), ident, seq) + payload
+
+    def _icmp_probe(self, sock, targets):
+        ''' Yield (ip, latency) of each target answering an echo request '''
+
+        ident = os.getpid() & 0xffff
+        outstanding = {} # ip -> (seq, time sent)
+        seq = 0
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(outstanding) < self.concurrency:
+                    try:
+                        ip = next(targets)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    seq = (seq + 1) & 0xffff
+                    try:
+                        sock.sendto(self._echo(ident, seq), (ip, 0))
+                    except socket.error:
+                        continue # unreachable, not alive
+                    outstanding[ip] = (seq, time.time())
+                if not outstanding: return
+                oldest = min([t for s, t in outstanding.itervalues()])
+                wait = max(oldest + self.timeout - time.time(), 0)
+                if select.select([sock], [], [], wait)[0]:
+                    reply = self._reply(sock, ident)
+                    if reply is not None and reply[0] in outstanding:
+                        ip, rseq = reply
+                        sent_seq, sent = outstanding[ip]
+                        if rseq == sent_seq:
+                            del outstanding[ip]
+                            yield ip, time.time() - sent
+                now = time.time()
+                for ip in [ip for ip, (s, t) in outstanding.iteritems()
+                           if now - t >= self.timeout]:
+                    del outstanding[ip]
+        finally:
+            sock.close()
+
+    def _reply(self, sock, ident):
+        ''' Read one packet, return (ip, seq) if it is an echo reply for us '''
+
+        try:
+            data, addr = sock.recvfrom(1024)
+        except socket.error:
+            return None
+        if self.method == 'raw':
+            data = data[(ord(data[0]) & 0x0f) * 4:] # skip the IP header
+        if len(data) < 8: return None
+        rtype, code, csum, rident, rseq = struct.unpack('!BBHHH', data[:8])
+        if rtype != Scanner.ICMP_ECHO_REPLY: return None
+        # The kernel sets the ident of ping sockets itself
+        if self.method == 'raw' and rident != ident: return None
+        return addr[0], rseq
+
+    def _tcp_probe(self, targets):
+        ''' Yield (ip, latency) of each target accepting or refusing a TCP
+        connection to self.port
+        '''
+
+        outstanding = {} # socket -> (ip, time sent)
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(outstanding) < self.concurrency:
+                    try:
+                        ip = next(targets)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    s.setblocking(0)
+                    err = s.connect_ex((ip, self.port))
+                    if err in (0, errno.ECONNREFUSED):
+                        s.close()
+                        yield ip, 0.0
+                    elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        outstanding[s] = (ip, time.time())
+                    else:
+                        s.close()
+                if not outstanding: return
+                oldest = min([t for i, t in outstanding.itervalues()])
+                wait = max(oldest + self.timeout - time.time(), 0)
+                ready = select.select([], outstanding.keys(), [], wait)[1]
+                for s in ready:
+                    ip, sent = outstanding.pop(s)
+                    err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    s.close()
+                    if err in (0, errno.ECONNREFUSED):
+                        yield ip, time.time() - sent
+                now = time.time()
+                for s in [s for s, (i, t) in outstanding.iteritems()
+                          if now - t >= self.timeout]:
+                    outstanding.pop(s)
+                    s.close()
+        finally:
+            for s in outstanding:
+                s.close()
+
+def testloc(cidr=DEFAULT_CIDR, **kwargs):
+    ''' Print the ip, mac and hostname of every live host on cidr '''
+
+    for host in Scanner(cidr, **kwargs).scan():
+        print host.ip, host.mac, host.hostname
@@ -1,6 +1,10 @@
 import os
 from string import Template
 
-W1_LOC = '/sys/bus/w1/devices/'
-W1_THERM = Template(''.join([W1_LOC, '$dev/w1_slave']))
-W1_UEVENT = Template(''.join([W1_LOC, '$dev/uevent']))
+# The 1 wire devices directory, PIMMS_W1 in the environment replaces it,
+# e.g. with a sensors.fakebus tree
+W1_LOC = os.environ.get('PIMMS_W1', '/sys/bus/w1/devices/')
+W1_THERM = Template(os.path.join(W1_LOC, '$dev/w1_slave'))
+W1_UEVENT = Template(os.path.join(W1_LOC, '$dev/uevent'))
+# Glob of the bulk conversion triggers of each bus master, kernel 5.10 on
+W1_BULK = os.path.join(W1_LOC, 'w1_bus_master*', 'therm_bulk_read')
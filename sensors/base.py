@@ -1,26 +1,69 @@
 from string import Template
 from sensors.reading import Reading
+from sensors.history import History
 from sensors import W1_UEVENT
 
 class Sensor(object):
 
+    # Number of recent readings kept in the history of each sensor
+    HISTORY = 512
+
     def __init__(self, sensor_id, family=None):
         self._device = sensor_id
         self._family = family
         self._current = Reading()
         self._last = Reading()
-        self._variance = Variance()
         self._factor = 1.0
         self.adj = 0
+        self.history = History(Sensor.HISTORY)
+        self.filters = []
+        self.rejected = 0
+
+    def add_filter(self, f):
+        ''' Add a sensors.filters.Filter to those run on each new value '''
+
+        self.filters.append(f)
+
+    def _filter(self, val, t):
+        ''' Run a new raw value through the filters and return its status
+
+        Every filter sees every value even once one has rejected it, the
+        filters are only told the value was accepted if none rejected it.
+        '''
+
+        real = val / self.factor
+        ok = True
+        for f in self.filters:
+            ok = f.check(real, t) and ok
+        if not ok:
+            self.rejected += 1
+            return Reading.VARIANCE_ERROR
+        for f in self.filters:
+            f.accepted(real, t)
+        return Reading.VALID
+
+    def close(self):
+        ''' Release anything held open for reading the device '''
+
+        pass
+
+    @property
+    def rejections(self):
+        ''' Return {filter name: number of values rejected} '''
+
+        return dict([(f.name, f.rejected) for f in self.filters])
 
-    def _check_variance(self, reading):
-        ''' Check variance is permitted between this reading and the last.'''
+    def _accept(self, val, t, status):
+        ''' Record a reading in the history and make it current if valid
 
-        if self.last.status == Reading.VALID:
-            return self._variance.check_vals(self.last.real_val,
-                                            self.current.real_val,
-                                            self.current.time - self.last.time)
-        return True
+        The current and last Reading objects are swapped and reused so no
+        new objects are created on each read.
+        '''
+
+        self.history.append(t, val, status)
+        if status == Reading.VALID:
+            self._last, self._current = self._current, self._last
+            self._current.update(val, t, status)
     @property
     def device(self):
         '''Returns the device id a s a string.'''
@@ -65,23 +108,6 @@ class Sensor(object):
 
         return self._last
 
-    def variance(self, value, period):
-        ''' Set the permitted variance parameters for this sensor.
-
-        >>> s = Sensor('somesensorid')
-        >>> s.variance(0.5, 1)
-        will produce a Variance that allows a 0.5C difference of a 1 second
-        period,a 1C difference over 2 second and 1.5C  difference over 3
-        seconds... etc.
-
-        Same functionallity as:
-        obj.variance.value = 1
-        obj.variance.period = 1
-        '''
-
-        self._variance.value = value
-        self._variance.period = period
-
     def _detect_family(self):
         ''' Discover what sensor family this device belongs is '''
 
@@ -90,12 +116,6 @@ class Sensor(object):
             family = lines[1].split('=')[1].upper().strip()
             self.family = family
 
-    @property
-    def variance(self):
-        ''' Return the Variance object for this sensor.'''
-
-        return self._variance
-
     @property
     def factor(self):
         return self._factor
@@ -103,53 +123,3 @@ class Sensor(object):
     @factor.setter
     def factor(self, factor):
         self._factor = float(factor)
-
-class Variance(object):
-    ''' Define an allowable variance between to values over a period
-
-    Arguments:
-    val -- the allowed variance as a numeric type
-    period -- The period over which that variance applies as a numeric type
-
-    example:
-    >>> v = Variance(val = 1, period = 1)
-    will produce a Variance object that allows a value 1 difference of a
-    1 second period,a 2 value difference over 2 second and 3 value difference
-    over 3 seconds... etc.
-    '''
-
-    def __init__(self, **kwargs):
-        self.period = 0
-        self.value = 0
-        for k in kwargs:
-            if 'val' in k.lower():
-                self.value = kwargs[k]
-                next
-            if 'per' in k.lower():
-                self.period = kwargs[k]
-                next
-
-    def check_vals(self, val1, val2, timediff):
-        ''' Check the variance between 2 readings in a period meet the
-        variance requirements
-
-        Returns True if the variance meets the requirements of the object
-        otherwise False.
-
-        Example:
-        >>> v = Variance(val = 1, period = 1)
-        >>> valid = v.check_vals(1, 1.5, 1)
-        >>> # valid == True
-        >>>
-        >>> v = Variance(val = 1, period = 1)
-        >>> valid = v.check_vals(1, 3, 1)
-        >>> # valid == False
-        >>>
-        >>> v = Variance(val = 1, period = 1)
-        >>> valid = v.check_vals(1, 2, 3)
-        >>> # valid == True
-        '''
-        if self.period == 0 and self.value == 0: return True
-        diff = val1 - val2 if val1 > val2 else val2 - val1
-        assert diff >= 0
-        return diff <= (self.value * self.period) * timediff
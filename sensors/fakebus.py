@@ -0,0 +1,269 @@
+""" A simulated 1 wire bus for running without hardware
+
+FakeBus builds a directory laid out like /sys/bus/w1/devices with a bus
+master and a number of DS18B20 style thermometers. Point PIMMS_W1 at the
+directory before the sensors package is imported and everything reads it
+as it would the real bus.
+
+With no latency each w1_slave is a plain file holding the next reading,
+rewritten by step(). With a latency each w1_slave is a FIFO fed by a thread
+per device, every open gets a fresh reading after latency seconds as the
+kernel driver would after a conversion, so CRC failures and glitches
+happen per read. Dropouts remove a device for a while as if its wiring
+came loose, hotplug adds and removes devices at random.
+
+With bulk the bus master has a therm_bulk_read file, watched by a thread
+that answers 'trigger' as the kernel does: -1 for latency seconds, then 1,
+and each device's next read is answered at once.
+"""
+
+import os, shutil, random, threading, time, errno
+
+BUS_MASTER = 'w1_bus_master1'
+BULK_READ = 'therm_bulk_read'
+POWER_ON_RESET = 85000 # the DS18B20 value read before a conversion
+
+def crc8(data):
+    ''' Dallas/Maxim 1 wire CRC8 of a list of byte values '''
+
+    crc = 0
+    for byte in data:
+        for i in range(8):
+            mix = (crc ^ byte) & 0x01
+            crc >>= 1
+            if mix: crc ^= 0x8C
+            byte >>= 1
+    return crc
+
+def w1_slave(temp, crc_ok=True):
+    ''' Return the w1_slave text of a DS18B20 reading temp milli degrees '''
+
+    raw = int(round(temp * 16 / 1000.0)) & 0xffff
+    data = [raw & 0xff, raw >> 8, 0x4b, 0x46, 0x7f, 0xff, 0x0c, 0x10]
+    crc = crc8(data)
+    if not crc_ok: crc ^= 0x5a
+    scratch = ' '.join(['%02x' % b for b in data + [crc]])
+    temp = raw - 0x10000 if raw & 0x8000 else raw
+    return '%s : crc=%02x %s\n%s t=%d\n' % (scratch, crc,
+                                           'YES' if crc_ok else 'NO',
+                                           scratch, temp * 1000 // 16)
+
+class FakeBus(object):
+    ''' A directory of simulated DS18B20 sensors
+
+    >>> bus = FakeBus('/tmp/w1', devices=8, latency=0.75, crc_fail=0.01)
+    >>> os.environ['PIMMS_W1'] = bus.path
+    >>> bus.step()    # plain files only, next reading and random events
+    >>> bus.close()
+
+    Arguments:
+    path -- directory to build the bus in, created if needed
+    devices -- number of sensors on the bus to start with
+    latency -- seconds each read takes
+    crc_fail -- probability a read fails its CRC
+    glitch -- probability a read is the 85C power on reset value
+    dropout -- probability a sensor disappears at each step
+    dropout_time -- seconds a sensor stays away
+    hotplug -- probability a sensor is added or removed at each step
+    bulk -- provide therm_bulk_read on the bus master
+    '''
+
+    FAMILY = '28'
+
+    def __init__(self, path, devices=4, latency=0.0, crc_fail=0.0,
+                 glitch=0.0, dropout=0.0, dropout_time=10.0, hotplug=0.0,
+                 bulk=False, seed=None):
+        self.path = path
+        self.latency = latency
+        self.crc_fail = crc_fail
+        self.glitch = glitch
+        self.dropout = dropout
+        self.dropout_time = dropout_time
+        self.hotplug = hotplug
+        self.random = random.Random(seed)
+        self.reads = 0
+        self._temps = {}    # device -> current temperature, milli degrees
+        self._away = {}     # device -> time a dropped out device returns
+        self._feeders = {}  # device -> feeding thread
+        self._converted = set() # devices with a bulk conversion to read
+        self._next = 1
+        self._lock = threading.Lock()
+        self._bulk = None
+        self._closing = threading.Event()
+        if not os.path.isdir(os.path.join(path, BUS_MASTER)):
+            os.makedirs(os.path.join(path, BUS_MASTER))
+        for i in range(devices):
+            self.add_device()
+        if bulk:
+            self._set_bulk(0)
+            self._bulk = threading.Thread(target=self._watch_bulk)
+            self._bulk.daemon = True
+            self._bulk.start()
+
+    @property
+    def devices(self):
+        ''' The ids of the devices on the bus now '''
+
+        return sorted([d for d in self._temps if d not in self._away])
+
+    def add_device(self, dev=None):
+        ''' Add a sensor to the bus and return its id '''
+
+        if dev is None:
+            dev = '%s-%012x' % (FakeBus.FAMILY, self._next)
+            self._next += 1
+        self._temps[dev] = self.random.uniform(15000, 25000)
+        self._plug(dev)
+        return dev
+
+    def remove_device(self, dev):
+        ''' Remove a sensor from the bus '''
+
+        self._unplug(dev)
+        self._temps.pop(dev, None)
+        self._away.pop(dev, None)
+
+    def _plug(self, dev):
+        d = os.path.join(self.path, dev)
+        os.mkdir(d)
+        with open(os.path.join(d, 'uevent'), 'w') as f:
+            f.write('DRIVER=w1_slave_driver\nW1_FID=%s\nW1_SLAVE_ID=%d\n' %
+                    (dev.partition('-')[0], int(dev.partition('-')[2], 16)))
+        slave = os.path.join(d, 'w1_slave')
+        if self.latency > 0:
+            os.mkfifo(slave)
+            t = threading.Thread(target=self._feed, args=(dev, slave))
+            t.daemon = True
+            self._feeders[dev] = t
+            t.start()
+        else:
+            self._write(dev)
+
+    def _unplug(self, dev):
+        d = os.path.join(self.path, dev)
+        feeder = self._feeders.pop(dev, None)
+        if feeder is not None:
+            self._release(os.path.join(d, 'w1_slave'))
+            feeder.join()
+        shutil.rmtree(d, ignore_errors=True)
+
+    def _release(self, fifo):
+        ''' Wake a feeder waiting for a reader to open fifo '''
+
+        try:
+            os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+        except OSError:
+            pass
+
+    def reading(self, dev):
+        ''' Return the w1_slave text of the next reading of dev '''
+
+        with self._lock:
+            self.reads += 1
+            temp = self._temps[dev] + self.random.gauss(0, 50)
+            self._temps[dev] = temp
+            if self.random.random() < self.glitch: temp = POWER_ON_RESET
+            crc_ok = self.random.random() >= self.crc_fail
+        return w1_slave(temp, crc_ok)
+
+    def _set_bulk(self, status):
+        f = os.path.join(self.path, BUS_MASTER, BULK_READ)
+        with open(f + '.new', 'w') as new:
+            new.write('%d\n' % status)
+        os.rename(f + '.new', f)
+
+    def _watch_bulk(self):
+        ''' Convert every device when 'trigger' is written to therm_bulk_read '''
+
+        f = os.path.join(self.path, BUS_MASTER, BULK_READ)
+        while not self._closing.is_set():
+            try:
+                with open(f) as status:
+                    triggered = status.read().strip() == 'trigger'
+            except IOError:
+                triggered = False
+            if not triggered:
+                time.sleep(0.005)
+                continue
+            self._set_bulk(-1)
+            time.sleep(self.latency)
+            with self._lock:
+                self._converted.update(self.devices)
+            self._set_bulk(1)
+
+    def _write(self, dev):
+        with open(os.path.join(self.path, dev, 'w1_slave'), 'w') as f:
+            f.write(self.reading(dev))
+
+    def _feed(self, dev, fifo):
+        ''' Answer each open of fifo with a reading after latency seconds
+
+        Once a reader has opened the fifo it is replaced by a new one, the
+        reader sees the end of its reading when this end is closed and the
+        next reader waits on the new fifo, as reads of a device wait on
+        the bus.
+        '''
+
+        me = threading.current_thread()
+        while self._feeders.get(dev) is me:
+            try:
+                f = open(fifo, 'w') # waits for a reader
+            except IOError as e:
+                if e.errno == errno.ENOENT: return
+                raise
+            try:
+                if self._feeders.get(dev) is not me: return
+                os.mkfifo(fifo + '.new')
+                os.rename(fifo + '.new', fifo)
+                with self._lock:
+                    converted = dev in self._converted
+                    self._converted.discard(dev)
+                if not converted: time.sleep(self.latency)
+                f.write(self.reading(dev))
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EPIPE, errno.ENOENT): raise
+            finally:
+                try:
+                    f.close()
+                except IOError:
+                    pass
+
+    def step(self, now=None):
+        ''' Move the bus on, new readings in plain files, dropouts and
+        hotplug events. Returns the (added, removed) device ids.
+        '''
+
+        now = time.time() if now is None else now
+        added, removed = [], []
+        for dev, back in self._away.items():
+            if back <= now:
+                del self._away[dev]
+                self._plug(dev)
+                added.append(dev)
+        for dev in [d for d in self._temps if d not in self._away]:
+            if self.random.random() < self.dropout:
+                self._unplug(dev)
+                self._away[dev] = now + self.dropout_time
+                removed.append(dev)
+            elif self.latency <= 0:
+                self._write(dev)
+        if self.random.random() < self.hotplug:
+            present = [d for d in self._temps if d not in self._away]
+            if present and self.random.random() < 0.5:
+                dev = self.random.choice(present)
+                self.remove_device(dev)
+                removed.append(dev)
+            else:
+                added.append(self.add_device())
+        return added, removed
+
+    def close(self, remove=True):
+        ''' Stop feeding reads and remove the bus directory if remove '''
+
+        self._closing.set()
+        if self._bulk is not None:
+            self._bulk.join()
+            self._bulk = None
+        for dev in self._feeders.keys():
+            self._unplug(dev)
+        if remove: shutil.rmtree(self.path, ignore_errors=True)
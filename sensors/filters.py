@@ -0,0 +1,141 @@
+from bisect import bisect_left, insort
+from collections import deque
+
+class Filter(object):
+    ''' Base of the outlier filters run on each new sensor value
+
+    check() is given every measured value with its time and returns False
+    to reject it, accepted() is then called on every filter of the sensor
+    if no filter rejected the value. Values are real values, e.g. degrees
+    not the implied decimal int. Filters count the values they have checked
+    and rejected.
+    '''
+
+    name = 'filter'
+
+    def __init__(self):
+        self.checked = 0
+        self.rejected = 0
+
+    def _count(self, ok):
+        self.checked += 1
+        if not ok: self.rejected += 1
+        return ok
+
+    def check(self, val, t):
+        raise NotImplementedError
+
+    def accepted(self, val, t):
+        pass
+
+    def reset(self):
+        self.checked = 0
+        self.rejected = 0
+
+class Hampel(Filter):
+    ''' Reject values far from the median of the recent values
+
+    A value is rejected when it is more than k scaled median absolute
+    deviations (MAD) from the median of the last window values measured,
+    rejected ones included so a real step change is followed once it fills
+    half the window. A single bad value moves neither the median nor the
+    MAD much so it does not affect the checks after it. min_dev is the
+    smallest deviation ever rejected, a steady sensor has a MAD of 0.
+
+    The window is kept sorted as values arrive so each check is a bisect
+    and a walk of half the window, a fixed cost however many samples have
+    been taken.
+
+    >>> f = Hampel(window=15, k=3.0, min_dev=0.5)
+    >>> ok = f.check(21.375, time.time())
+    '''
+
+    name = 'hampel'
+    SCALE = 1.4826 # MAD to standard deviation for normal data
+
+    def __init__(self, window=15, k=3.0, min_dev=0.0, min_samples=5):
+        super(Hampel, self).__init__()
+        assert window > 0
+        self.window = window
+        self.k = k
+        self.min_dev = min_dev
+        self.min_samples = min(min_samples, window)
+        self._order = deque()
+        self._sorted = []
+
+    def median_mad(self):
+        ''' Return (median, MAD) of the window, None if it is empty '''
+
+        s = self._sorted
+        n = len(s)
+        if not n: return None
+        half = n // 2
+        med = s[half] if n % 2 else (s[half - 1] + s[half]) / 2.0
+        # Deviations below and above the median are each already sorted,
+        # merge them as far as the middle one
+        i, j = half - 1, half
+        devs = []
+        while len(devs) <= half:
+            if j >= n or (i >= 0 and med - s[i] <= s[j] - med):
+                devs.append(med - s[i])
+                i -= 1
+            else:
+                devs.append(s[j] - med)
+                j += 1
+        mad = devs[half] if n % 2 else (devs[half - 1] + devs[half]) / 2.0
+        return med, mad
+
+    def check(self, val, t):
+        ok = True
+        if len(self._sorted) >= self.min_samples:
+            med, mad = self.median_mad()
+            ok = abs(val - med) <= max(self.k * Hampel.SCALE * mad,
+                                       self.min_dev)
+        self._push(val)
+        return self._count(ok)
+
+    def _push(self, val):
+        if len(self._order) == self.window:
+            old = self._order.popleft()
+            del self._sorted[bisect_left(self._sorted, old)]
+        self._order.append(val)
+        insort(self._sorted, val)
+
+    def reset(self):
+        super(Hampel, self).reset()
+        self._order.clear()
+        self._sorted = []
+
+class RateOfChange(Filter):
+    ''' Reject values changing faster than rate per second
+
+    The change is measured from the last accepted value so a rejected
+    value is never compared against. As the allowed change grows with the
+    time since that value a real step change is accepted in the end.
+    min_dev is a change always allowed, whatever the time between values.
+
+    >>> f = RateOfChange(rate=1.0)  # 1 degree a second
+    '''
+
+    name = 'rate'
+
+    def __init__(self, rate=1.0, min_dev=0.0):
+        super(RateOfChange, self).__init__()
+        self.rate = rate
+        self.min_dev = min_dev
+        self._val = None
+        self._time = None
+
+    def check(self, val, t):
+        ok = (self._val is None or
+              abs(val - self._val) <= max(self.rate * (t - self._time),
+                                          self.min_dev))
+        return self._count(ok)
+
+    def accepted(self, val, t):
+        self._val, self._time = val, t
+
+    def reset(self):
+        super(RateOfChange, self).reset()
+        self._val = None
+        self._time = None
@@ -0,0 +1,84 @@
+from array import array
+
+class History(object):
+    ''' Fixed capacity ring buffer of the recent readings of one sensor
+
+    Timestamps, raw int values and Reading status codes are held in three
+    preallocated arrays so appending a reading allocates nothing and the
+    oldest reading is overwritten once capacity is reached.
+
+    >>> h = History(4)
+    >>> h.append(time.time(), 21375, Reading.VALID)
+    >>> times, vals, status = h.view(10)   # up to the 10 most recent
+    >>> h.since(time.time() - 60)          # how many in the last minute
+    '''
+
+    __slots__ = ('capacity', '_times', '_vals', '_status', '_next', '_count')
+
+    def __init__(self, capacity=256):
+        assert capacity > 0
+        self.capacity = capacity
+        self._times = array('d', [0.0]) * capacity
+        self._vals = array('i', [0]) * capacity
+        self._status = array('B', [0]) * capacity
+        self._next = 0   # index the next reading is written to
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, time, val, status):
+        ''' Add a reading, overwriting the oldest when full '''
+
+        i = self._next
+        self._times[i] = time
+        self._vals[i] = val
+        self._status[i] = status
+        self._next = i + 1 if i + 1 < self.capacity else 0
+        if self._count < self.capacity: self._count += 1
+
+    def latest(self):
+        ''' Return the most recent (time, val, status) or None if empty '''
+
+        if not self._count: return None
+        i = self._next - 1
+        return self._times[i], self._vals[i], self._status[i]
+
+    def _slice(self, arr, n):
+        ''' The n most recent entries of arr oldest first, as a new array '''
+
+        start = self._next - n
+        if start >= 0:
+            return arr[start:self._next]
+        return arr[start:] + arr[:self._next]
+
+    def view(self, n=None):
+        ''' Return (times, vals, status) arrays of the n most recent readings
+        (all by default), oldest first
+        '''
+
+        n = self._count if n is None else min(n, self._count)
+        return (self._slice(self._times, n), self._slice(self._vals, n),
+                self._slice(self._status, n))
+
+    def since(self, time):
+        ''' Return the number of readings taken at or after time '''
+
+        n = 0
+        i = self._next
+        while n < self._count:
+            i = i - 1 if i > 0 else self.capacity - 1
+            if self._times[i] < time: break
+            n += 1
+        return n
+
+    def window(self, seconds, now):
+        ''' Return (times, vals, status) of the readings in the last seconds
+        before now
+        '''
+
+        return self.view(self.since(now - seconds))
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
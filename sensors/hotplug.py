@@ -0,0 +1,144 @@
+""" Discovery of devices added to and removed from the 1 wire bus
+
+sysfs does not raise inotify events when a device directory appears, the
+kernel announces it with a uevent on the kobject netlink socket instead
+(the one udev listens on). Hotplug listens there and only lists the bus
+directory when a w1 uevent arrives, so checking for changes costs one non
+blocking recv while nothing happens. Where the netlink socket can not be
+opened the directory is listed every poll seconds instead.
+"""
+
+import os, socket, time, errno
+from sensors import W1_LOC, W1_UEVENT
+
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUP = 1 # kernel uevents, udev rebroadcasts on group 2
+
+NETLINK = 'netlink'
+POLL = 'poll'
+
+_families = {}
+
+def family(dev):
+    ''' Return the family code of a device id, e.g. '28' for a DS18B20
+
+    Read from the device uevent once and cached, the id prefix is used if
+    the uevent can not be read.
+    '''
+
+    code = _families.get(dev)
+    if code is None:
+        try:
+            with open(W1_UEVENT.substitute(dev=dev), 'r') as f:
+                for line in f:
+                    key, sep, val = line.partition('=')
+                    if key == 'W1_FID':
+                        code = val.upper().strip()
+                        break
+        except IOError:
+            pass
+        if code is None:
+            code = dev.partition('-')[0].upper()
+        _families[dev] = code
+    return code
+
+def bus_devices(path=W1_LOC):
+    ''' Return the set of device ids on the bus, bus masters excluded '''
+
+    try:
+        return set([x for x in os.listdir(path) if 'w1' not in x])
+    except OSError:
+        return set()
+
+class Hotplug(object):
+    ''' Report devices added to or removed from the 1 wire bus
+
+    >>> hp = Hotplug(on_add=wire.add, on_remove=wire.remove)
+    >>> added, removed = hp.check()   # call every second or so
+
+    The devices on the bus when it is created are in devices and are not
+    reported as added. check() calls on_add(device id) and
+    on_remove(device id) for each change and returns the sets of ids
+    added and removed since the last check.
+
+    Arguments:
+    path -- the bus devices directory
+    poll -- seconds between listings of path without netlink
+    '''
+
+    def __init__(self, path=W1_LOC, on_add=None, on_remove=None, poll=10.0,
+                 clock=time.time):
+        self.path = path
+        self.on_add = on_add
+        self.on_remove = on_remove
+        self.poll = poll
+        self._clock = clock
+        self._sock = self._netlink()
+        self.method = POLL if self._sock is None else NETLINK
+        self.devices = bus_devices(path)
+        self._listed = clock()
+
+    def _netlink(self):
+        ''' Return a non blocking kernel uevent socket or None '''
+
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                 NETLINK_KOBJECT_UEVENT)
+        except (AttributeError, socket.error):
+            return None
+        try:
+            sock.bind((0, UEVENT_GROUP))
+            sock.setblocking(0)
+        except socket.error:
+            sock.close()
+            return None
+        return sock
+
+    def fileno(self):
+        ''' The netlink socket descriptor, for select, or None '''
+
+        return None if self._sock is None else self._sock.fileno()
+
+    def _w1_events(self):
+        ''' Drain the socket, return True if any uevent was for the w1 bus '''
+
+        changed = False
+        while True:
+            try:
+                msg = self._sock.recv(8192)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return changed
+                if e.errno == errno.ENOBUFS: # events were lost, relist
+                    changed = True
+                    continue
+                raise
+            if not changed:
+                fields = msg.split('\0')
+                changed = ('SUBSYSTEM=w1' in fields or
+                           '/w1_bus_master' in fields[0])
+
+    def check(self):
+        ''' Return (added, removed) sets of device ids since the last check'''
+
+        if self._sock is not None:
+            if not self._w1_events():
+                return set(), set()
+        elif self._clock() - self._listed < self.poll:
+            return set(), set()
+        self._listed = self._clock()
+        current = bus_devices(self.path)
+        added = current - self.devices
+        removed = self.devices - current
+        self.devices = current
+        for dev in removed:
+            _families.pop(dev, None)
+            if self.on_remove is not None: self.on_remove(dev)
+        for dev in added:
+            if self.on_add is not None: self.on_add(dev)
+        return added, removed
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
@@ -1,4 +1,4 @@
-import time
+import time, datetime
 from collections import namedtuple
 class Reading(object):
     ''' Storage for sensor readings with reading status
@@ -25,6 +25,10 @@ class Reading(object):
     LOST_SENSOR = 0x5
     UNKNOWN = 0xf6
     last_valid_type = namedtuple('last_valid_type', 'val time')
+    # Status code names used in logs and metrics
+    NAMES = {VALID: 'valid', CRC_ERROR: 'crc_error',
+             VARIANCE_ERROR: 'variance_error', NO_READING: 'no_reading',
+             LOST_SENSOR: 'lost_sensor', UNKNOWN: 'unknown'}
 
     def __init__(self, **kwargs):
         self._time = time.time()
@@ -43,7 +47,7 @@ class Reading(object):
         if 'status' in kwargs:
             self._status = kwargs['status']
 
-        self._last_valid = Reading.last_valid_type(self.val, self.time)
+        self._lv_val, self._lv_time = self.val, self.time # last valid
 
     @property
     def time(self):
@@ -103,15 +107,23 @@ class Reading(object):
         automatically be set to Reading.UNKNOWN
         '''
         assert isinstance(value, int)
-        if self.status == Reading.VALID:
-            self._last_valid = Reading.last_valid_type(self.val, self.time)
-        self._val = value
-        self._time = time.time()
-        self.status = Reading.UNKNOWN
+        self.update(value, time.time(), Reading.UNKNOWN)
+
+    def update(self, val, t, status):
+        ''' Set the value, time and status together
+
+        Used by sensors to reuse a Reading on every read rather than
+        creating a new one, nothing is validated.
+        '''
+        if self._status == Reading.VALID:
+            self._lv_val, self._lv_time = self._val, self._time
+        self._val = val
+        self._time = t
+        self._status = status
 
     @property
     def last_valid(self):
-        return self._last_valid
+        return Reading.last_valid_type(self._lv_val, self._lv_time)
 
     @property
     def real_val(self):
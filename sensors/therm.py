@@ -1,8 +1,10 @@
-import time
+import os, stat, time
 from string import Template
-from sensors.base import Sensor, Variance
+from sensors.base import Sensor
 from sensors.reading import Reading
+from sensors.filters import Hampel, RateOfChange
 from sensors import W1_THERM
+from util.profiling import STAGE_SECONDS
 
 class Thermal(Sensor):
     ''' Represents a 1 wire digital temperature sensor
@@ -14,78 +16,128 @@ class Thermal(Sensor):
     property. This is the preferred way of creating w1 objects.
 
     The class provides methods for reading the values and status of the
-    sensor data. A Variance object is used with a default value
-    of 1 degree variance over 1 second to filter out erroneous readings.
-    set this to 0 to disbale it with the variance property
-    >>> obj.variance(0,0)
+    sensor data. Readings are run through the filters set for the sensor
+    family in FILTERS to reject erroneous readings, by default a Hampel
+    filter over the last 15 readings and a limit of 1 degree change a
+    second. Clear the filters property to disable them
+    >>> obj.filters = []
 
     Thermal sensors create DecimalReading objects for both current and last
     reading properties. The val property of Thermal sensors returns an int
     while the real_val returns the floating point value of the reading as
     does the temperature property.
 
+    The w1_slave file is opened once and read again from the start for
+    each reading, sysfs produces a new reading every time. Call close() to
+    release it.
+
     TODO Test with DS18S20, DS1822, DS1825, DS28EA00
     '''
 
+    # Bytes read from w1_slave, a reading is about 75
+    READ_SIZE = 256
+
     # Families that are valid Thermal Sensors
     FAMILIES = {'10': 'DS18S20', '22': 'DS1822', '28': 'DS18B20',
                 '3B': 'DS1825', '42': 'DS28EA00'}
     FACTORS = {'DEFAULT': 1000.0, 'DS18B20': 1000.0}
+    # (filter class, keyword arguments) for each family, values in degrees
+    FILTERS = {'DEFAULT': ((Hampel, {'window': 15, 'k': 3.0, 'min_dev': 0.5}),
+                           (RateOfChange, {'rate': 1.0, 'min_dev': 0.5}))}
 
     def __init__(self, sensor_id, family=None):
         super(Thermal, self).__init__(sensor_id, family)
+        self._fd = None
         self.factor = Thermal.FACTORS[self.family] if self.family in Thermal.FACTORS else Thermal.FACTORS['DEFAULT']
-        self._current = Reading()
-        self._last = Reading()
-        self._variance = Variance(value=1.0, period=1.0)
+        self._current = Reading(factor=self.factor)
+        self._last = Reading(factor=self.factor)
+        filters = Thermal.FILTERS.get(self.family, Thermal.FILTERS['DEFAULT'])
+        for cls, kwargs in filters:
+            self.add_filter(cls(**kwargs))
         self.read()
 
     def read(self):
         ''' Read the device file from /sys/bus/w1/devices and validate the data
 
-        Read will check the CRC status of the reading and compliance with
-        the objects variance property. The current Readind property will
+        Read will check the CRC status of the reading and run it through
+        the sensor filters. The current Readind property will
         be updated with the status set to one of the status codes defined
         in the Reading class.
 
         Does not return any value, use the object properties to access
-        the read data.
+        the read data. Every read, valid or not, is added to the sensor
+        history.
         '''
 
         t = time.time()
         try:
-            with open(W1_THERM.substitute(dev=self.device),'r') as f:
-                self._last = self.current
-                lines = [l for l in f]
-                reading = self.__check_valid(self.__read_temp(lines[1]),
-                                             lines[0])
-                if reading.status == Reading.VALID: self._current = reading
-        except IOError as e:
+            data = self.__read_file()
+        except EnvironmentError as e:
+            self.close() # the device may come back as a new file
+            self.history.append(t, 0, Reading.LOST_SENSOR)
             self._current.status = Reading.LOST_SENSOR
             print 'File Error {dev}'.format(dev=self._device)
+            return
+        read = time.time()
+        STAGE_SECONDS.observe(read - t, stage='sysfs')
+        crc_ok, val = Thermal.parse(data)
+        self._accept(val, t, self.__check_valid(val, t, crc_ok))
+        STAGE_SECONDS.observe(time.time() - read, stage='validate')
+
+    def __read_file(self):
+        ''' Return the text of the w1_slave file
+
+        The descriptor of a sysfs file is kept and read again from the
+        start. Anything else, such as a sensors.fakebus FIFO, is opened for
+        each read.
+        '''
 
-    def __check_valid(self, check_rdg, crc_line):
-        ''' Check for a valid reading and return the reading with status set'''
+        if self._fd is not None:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            return os.read(self._fd, Thermal.READ_SIZE)
+        fd = os.open(W1_THERM.substitute(dev=self.device), os.O_RDONLY)
+        if stat.S_ISREG(os.fstat(fd).st_mode):
+            self._fd = fd
+            return os.read(fd, Thermal.READ_SIZE)
+        try:
+            chunks = []
+            while True:
+                chunk = os.read(fd, Thermal.READ_SIZE)
+                if not chunk: return ''.join(chunks)
+                chunks.append(chunk)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def parse(data):
+        ''' Return (crc ok, value) from the text of a w1_slave file
+
+        The CRC status ends the first line and the value follows the last
+        t=, found without splitting the text. Text that is neither is a
+        failed CRC.
+        '''
 
-        if not self.__check_crc(crc_line):
-            check_rdg.status = Reading.CRC_ERROR
-        elif (self._current.status != Reading.NO_READING and not 
-              self._check_variance(check_rdg)):
-            check_rdg.status = Sensor.VARIANCE_ERROR
-        else:
-            check_rdg.status = Reading.VALID
-        return check_rdg
+        eol = data.find('\n')
+        start = data.rfind('t=')
+        if eol < 3 or start < eol: return False, 0
+        try:
+            return data[eol - 3:eol] == 'YES', int(data[start + 2:])
+        except ValueError:
+            return False, 0
 
-    def __check_crc(self, line):
-        ''' Check the CRC status provided by the sensor '''
+    def __check_valid(self, val, t, crc_ok):
+        ''' Check for a valid reading and return its status code'''
 
-        return True if line[-4:-1] == 'YES' else False
+        if not crc_ok:
+            return Reading.CRC_ERROR
+        return self._filter(val, t)
 
-    def __read_temp(self, line):
-        ''' Get the temperature reading from the sensor and return as int'''
+    def close(self):
+        ''' Close the w1_slave file, the next read opens it again '''
 
-        return Reading(val = int(line.split(" ")[9][2:]),
-                       factor = self.factor)
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
 
 
     @property
@@ -1,7 +1,22 @@
-import os
+import os, time
+from glob import glob
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 from sensors.reading import Reading
 from sensors.therm import Thermal
-from sensors import W1_LOC, W1_UEVENT
+from sensors.hotplug import bus_devices, family
+from sensors import W1_BULK
+from util import metrics
+
+READ_SECONDS = metrics.histogram('pimms_sensor_read_seconds',
+                                 'Time taken to read a sensor', ('sensor',))
+READS = metrics.counter('pimms_sensor_reads_total',
+                        'Sensor reads by Reading status', ('sensor', 'status'))
+CONVERT_SECONDS = metrics.histogram('pimms_bulk_convert_seconds',
+                                    'Time taken by a bulk conversion')
+
+BULK_POLL = 0.02    # seconds between checks of a bulk conversion
+BULK_TIMEOUT = 2.0  # a 12 bit conversion takes 750 ms
 
 class Wire(object):
     ''' Represent devices on the 1 wire bus
@@ -13,9 +28,24 @@ class Wire(object):
 
     Calling wire.detect_devices() will repopulate the wire.devices set with
     any new devices. Devices that were already in existince on the wire
-    will be retained, any that are no longer there will be removed.
+    will be retained, any that are no longer there will be removed. To
+    follow single changes, such as those reported by sensors.hotplug, use
+    wire.add(device id) and wire.remove(device id).
+
+    wire.read() reads a number of devices at once, with a concurrency greater
+    than 1 the reads are made from a pool of worker threads so the conversion
+    time of each sensor overlaps. Keep concurrency at 1 for bus masters that
+    hold the bus for the whole conversion, there is nothing to gain.
+
+    With bulk set and a kernel that has therm_bulk_read, a read of every
+    device on the wire starts one conversion on all of them at once and
+    then reads each result, the whole bus takes about one conversion time.
+    Reads of fewer devices, and reads on older kernels, convert each device
+    in turn.
     '''
 
+    ReadResult = namedtuple('ReadResult', 'status val elapsed')
+
     #Families supported by the kernel driver
     #THERMAL = {'10': 'DS18S20',
     #           '22': 'DS1822',
@@ -32,10 +62,117 @@ class Wire(object):
     #SWITCH = {'29': 'DS2408',
     #          '3A': 'DS2413'}
 
-    def __init__(self):
+    def __init__(self, concurrency=1, bulk=True):
         self.devices = set()
+        self._pool = None
+        self._bulk = sorted(glob(W1_BULK)) if bulk else []
+        self.concurrency = concurrency
         self.devices = self.detect_devices()
 
+    @property
+    def concurrency(self):
+        return self._concurrency
+
+    @concurrency.setter
+    def concurrency(self, concurrency):
+        ''' Set the maximum number of devices read at the same time '''
+
+        concurrency = int(concurrency)
+        assert concurrency > 0
+        self.close()
+        self._concurrency = concurrency
+
+    @property
+    def bulk(self):
+        ''' True if reads of the whole wire use a bulk conversion '''
+
+        return bool(self._bulk)
+
+    def close(self):
+        ''' Stop the worker threads, they are restarted by the next read '''
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def read(self, devices=None):
+        ''' Read devices (default all on the wire) and return their results
+
+        Returns a dict of {device id: Wire.ReadResult} where status is the
+        Reading status code of this read, val the current value and elapsed
+        the time in seconds the read took.
+        '''
+
+        devices = list(self.devices if devices is None else devices)
+        # Devices left out of a bulk conversion would later read its result
+        bulk = (len(devices) > 1 and self.devices.issubset(devices) and
+                self._convert())
+        if bulk or self.concurrency == 1 or len(devices) < 2:
+            results = [Wire._read_device(d) for d in devices]
+        else:
+            if self._pool is None:
+                self._pool = ThreadPool(self.concurrency)
+            results = self._pool.map(Wire._read_device, devices)
+        return dict(zip([d.device for d in devices], results))
+
+    def _convert(self):
+        ''' Start a conversion on every device of each bus master and wait
+        for it to finish
+
+        Returns False if the devices must be converted one at a time, bulk
+        reads are turned off for good if the kernel refuses them.
+        '''
+
+        if not self._bulk: return False
+        t = time.time()
+        try:
+            for trigger in self._bulk:
+                fd = os.open(trigger, os.O_WRONLY)
+                try:
+                    os.write(fd, 'trigger\n')
+                finally:
+                    os.close(fd)
+            pending = self._bulk
+            while True:
+                # -1 while any device is converting
+                pending = [p for p in pending if Wire._bulk_status(p) == -1]
+                if not pending: break
+                if time.time() - t > BULK_TIMEOUT: return False
+                time.sleep(BULK_POLL)
+        except EnvironmentError as e:
+            print 'Bulk conversion unavailable, reading devices in turn: ' \
+                '{err}'.format(err=e)
+            self._bulk = []
+            return False
+        CONVERT_SECONDS.observe(time.time() - t)
+        return True
+
+    @staticmethod
+    def _bulk_status(trigger):
+        fd = os.open(trigger, os.O_RDONLY)
+        try:
+            return int(os.read(fd, 16))
+        except ValueError:
+            return -1
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _read_device(dev):
+        ''' Read a single device and time it '''
+
+        t = time.time()
+        dev.read()
+        elapsed = time.time() - t
+        # The current reading is only replaced by a valid one, the status of
+        # this read is the latest in the history
+        latest = dev.history.latest()
+        status = dev.isvalid if latest is None else latest[2]
+        READ_SECONDS.observe(elapsed, sensor=dev.device)
+        READS.inc(sensor=dev.device, status=Reading.NAMES.get(status, 'unknown'))
+        return Wire.ReadResult(status, dev.current.val, elapsed)
+
     def detect_devices(self, old_dev=set()):
         ''' Return all sensors in /sys/bus/w1/devices
 
@@ -43,10 +180,28 @@ class Wire(object):
         provided in arg old_sensors will be returned if it still exists
         '''
 
-        new_dev = set([x for x in os.listdir(W1_LOC) if 'w1' not in x])
-        self.devices = self.__compare_devices(new_dev)
+        self.devices = self.__compare_devices(bus_devices())
         return self.devices
 
+    def add(self, device):
+        ''' Add the device with id device to the wire
+
+        Returns the new Sensor object or None if the device is already on
+        the wire or is not of a supported family.
+        '''
+
+        if device in [d.device for d in self.devices]: return None
+        created = self.__create_devices([device])
+        self.devices |= created
+        return created.pop() if created else None
+
+    def remove(self, device):
+        ''' Remove the device with id device from the wire '''
+
+        for d in self.devices:
+            if d.device == device: d.close()
+        self.devices = set([d for d in self.devices if d.device != device])
+
     def __compare_devices(self, new):
         ''' Return a set of sensor objects that contain only 'live' sensors
 
@@ -56,10 +211,12 @@ class Wire(object):
         '''
 
         active = set([s for s in self.devices if s.device in new])
+        for s in self.devices - active:
+            s.close()
         active_ids = [s.device for s in active]
         new_dev = self.__create_devices([s for s in new if s not in active_ids])
         all_dev = active | new_dev
-        assert len(all_dev) == len(new)
+        assert len(all_dev) <= len(new)
 
         return all_dev
 
@@ -72,10 +229,7 @@ class Wire(object):
 
         created_devices = []
         for d in devices:
-            family = ''
-            with open(W1_UEVENT.substitute(dev=d), 'r') as f:
-                lines = [l for l in f]
-                family = lines[1].split('=')[1].upper().strip()
-            if family in Thermal.FAMILIES:
-                created_devices.append(Thermal(d, family))
+            code = family(d)
+            if code in Thermal.FAMILIES:
+                created_devices.append(Thermal(d, code))
         return set(created_devices)
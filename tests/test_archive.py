@@ -0,0 +1,128 @@
+""" Round trips of the readings archive, run with
+python -m unittest discover -s tests -t .
+"""
+
+import os, shutil, tempfile, unittest
+import sqlite3 as sqlite
+from db.schema import DB, sensor_id
+from db import archive
+
+DAY = archive.DAY
+START = 1388534400 # 2014-01-01 UTC
+
+class CodecTest(unittest.TestCase):
+
+    def roundtrip(self, rows):
+        block = archive.encode(rows)
+        self.assertEqual(archive.decode(block), rows)
+        self.assertEqual(archive.decode_count(block), len(rows))
+        return block
+
+    def test_empty(self):
+        self.roundtrip([])
+
+    def test_single(self):
+        self.roundtrip([(START, 21375)])
+
+    def test_regular(self):
+        block = self.roundtrip([(START + i * 60, 20000 + i % 7)
+                                for i in xrange(1440)])
+        self.assertTrue(len(block) < 3 * 1440)
+
+    def test_negative_deltas(self):
+        # Falling and below zero values, shrinking intervals
+        self.roundtrip([(START, 5000), (START + 100, -250),
+                        (START + 150, -20000), (START + 151, 125000),
+                        (START + 152, -55000)])
+
+    def test_irregular(self):
+        self.roundtrip([(START, 1), (START + 1, 2), (START + 3601, 3),
+                        (START + 3602, 4), (START + 86399, -5)])
+
+    def test_before_epoch(self):
+        self.roundtrip([(-86400, 1), (0, 2), (1, 3)])
+
+class MoveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='pimms-test-')
+        self.db = os.path.join(self.dir, 'templog.db')
+        self.environ = os.environ.get('PIMMS_DB')
+        DB(db=self.db)
+        self.con = sqlite.connect(self.db)
+        self.store = archive.Archive(archive.directory(self.db))
+
+    def tearDown(self):
+        self.con.close()
+        shutil.rmtree(self.dir)
+        if self.environ is None: os.environ.pop('PIMMS_DB', None)
+        else: os.environ['PIMMS_DB'] = self.environ
+
+    def insert(self, rows, sensor=DB.AVG_SENSOR):
+        with self.con:
+            self.con.executemany("INSERT INTO readings(sensor_id, timestamp, "
+                                 "reading) VALUES (?, ?, ?);",
+                                 [(sensor, t, v) for t, v in rows])
+
+    def held(self, sensor=DB.AVG_SENSOR):
+        return self.con.execute("SELECT timestamp, reading FROM readings "
+                                "WHERE sensor_id = ? ORDER BY timestamp;",
+                                (sensor,)).fetchall()
+
+    def test_move(self):
+        # 20 days over a month end, two sensors, irregular and negative
+        rows = [(START + 20 * DAY + i * 977, (i * 37) % 900 - 450)
+                for i in xrange(20 * DAY // 977)]
+        other = sensor_id(self.con, '28-000004a3b1c2')
+        self.insert(rows)
+        self.insert([(t, -v) for t, v in rows], other)
+        before = START + 60 * DAY
+        moved = self.store.move(self.con, before, pause=0)
+        self.assertEqual(moved, 2 * len(rows))
+        self.assertEqual(self.held(), [])
+        self.assertEqual(self.store.months(), [(2014, 1), (2014, 2)])
+        self.assertEqual(self.store.read(DB.AVG_SENSOR, 0, before), rows)
+        self.assertEqual(self.store.read(other, 0, before),
+                         [(t, -v) for t, v in rows])
+        # Part of a day
+        start, end = START + 30 * DAY + 3600, START + 31 * DAY + 7200
+        self.assertEqual(self.store.read(DB.AVG_SENSOR, start, end),
+                         [r for r in rows if start <= r[0] <= end])
+
+    def test_merge(self):
+        early = [(START + i * 600, i) for i in xrange(0, 144, 2)]
+        late = [(START + i * 600, -i) for i in xrange(1, 144, 2)]
+        self.insert(early)
+        self.store.move(self.con, START + 2 * DAY, pause=0)
+        # Readings of an archived day written late, one taking its time
+        self.insert(late + [(START + DAY + 5, 99)])
+        self.insert([(START + 3 * DAY, 1)]) # not due yet
+        self.assertEqual(self.store.move(self.con, START + 2 * DAY, pause=0),
+                         len(late) + 1)
+        self.assertEqual(self.store.read(DB.AVG_SENSOR, 0, START + 10 * DAY),
+                         sorted(early + late + [(START + DAY + 5, 99)]))
+        self.assertEqual(self.held(), [(START + 3 * DAY, 1)])
+
+    def test_day_at_a_time(self):
+        # Days apart, each moved and committed before the next
+        days = [0, 1, 40]
+        self.insert([(START + d * DAY + i * 3600, d) for d in days
+                     for i in xrange(24)])
+        held = []
+        sleep = lambda pause: held.append(len(self.held()))
+        self.assertEqual(self.store.move(self.con, START + 50 * DAY,
+                                         pause=0, sleep=sleep), 72)
+        self.assertEqual(held, [48, 24, 0])
+
+    def test_nothing_to_move(self):
+        self.assertEqual(self.store.move(self.con, START, pause=0), 0)
+        self.assertEqual(self.store.read(DB.AVG_SENSOR, 0, START), [])
+
+    def test_prune(self):
+        self.insert([(START + i * DAY, i) for i in xrange(70)])
+        self.store.move(self.con, START + 70 * DAY, pause=0)
+        self.assertEqual(self.store.prune(START + 40 * DAY), 1)
+        self.assertEqual(self.store.months(), [(2014, 2), (2014, 3)])
+
+if __name__ == '__main__':
+    unittest.main()
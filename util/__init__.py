@@ -1,3 +1,4 @@
+import os
 from hashlib import sha256
 from random import choice
 from string import ascii_letters, digits
@@ -30,3 +31,14 @@ def check_file(filename):
             print 'Cannot find file %s'%filename
             raise e
 
+
+def atomic_write(filename, data):
+    ''' Replace filename with data so readers never see a partial file
+
+    The data is written to a temporary file in the same directory which is
+    then renamed over filename.
+    '''
+    tmp = '%s.tmp%d' % (filename, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(data)
+    os.rename(tmp, filename)
@@ -0,0 +1,217 @@
+""" Counters, gauges and histograms exposed in the Prometheus text format
+
+Metrics are created once at module level from the registry and updated in
+the hot paths, an update is a dict lookup and an add under a lock so they
+are cheap enough to leave on everywhere.
+
+>>> READS = metrics.counter('pimms_sensor_reads_total', 'Sensor reads',
+...                         ('sensor', 'status'))
+>>> READS.inc(sensor='28-000004a3b1c2', status='valid')
+>>> with metrics.histogram('pimms_x_seconds', 'x').time():
+...     x()
+>>> metrics.REGISTRY.expose()   # the text for a /metrics page
+
+The monitor serves its metrics with serve(), the web app from /metrics.
+"""
+
+import time, threading
+from bisect import bisect_left
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(val):
+    return (str(val).replace('\\', r'\\').replace('\n', r'\n')
+            .replace('"', r'\"'))
+
+def _labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs: return ''
+    return '{%s}' % ','.join(['%s="%s"' % (n, _escape(v)) for n, v in pairs])
+
+def _float(val):
+    if val == float('inf'): return '+Inf'
+    return repr(float(val))
+
+class Metric(object):
+    ''' A named metric holding a value for each set of label values '''
+
+    TYPE = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError('%s needs labels %s' % (self.name,
+                                                     ', '.join(self.labelnames)))
+        return tuple([labels[n] for n in self.labelnames])
+
+    def expose(self):
+        ''' Return the metric in the text format as a list of lines '''
+
+        lines = ['# HELP %s %s' % (self.name, self.help.replace('\n', ' ')),
+                 '# TYPE %s %s' % (self.name, self.TYPE)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, val in items:
+            lines.extend(self._samples(key, val))
+        return lines
+
+    def _samples(self, key, val):
+        return ['%s%s %s' % (self.name, _labels(self.labelnames, key),
+                             _float(val))]
+
+class Counter(Metric):
+    ''' A count that only goes up '''
+
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+class Gauge(Metric):
+    ''' A value that can go up and down '''
+
+    TYPE = 'gauge'
+
+    def set(self, val, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = val
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.time() - self._start, **self._labels)
+
+class Histogram(Metric):
+    ''' Counts of observations falling in each of a set of buckets
+
+    Each label set keeps a count per bucket, the sum and the number of
+    observations, an observation is a bisect of the bucket bounds.
+    '''
+
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, val, **labels):
+        key = self._key(labels)
+        i = bisect_left(self.buckets, val)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one per bucket, +Inf, sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += val
+
+    def time(self, **labels):
+        ''' Context manager observing the seconds taken by its block '''
+
+        return _Timer(self, labels)
+
+    def count(self, **labels):
+        counts = self._values.get(self._key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def _samples(self, key, counts):
+        lines = []
+        total = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts[:-1]):
+            total += n
+            lines.append('%s_bucket%s %d' % (self.name, _labels(
+                self.labelnames, key, [('le', _float(bound))]), total))
+        labels = _labels(self.labelnames, key)
+        lines.append('%s_sum%s %s' % (self.name, labels, _float(counts[-1])))
+        lines.append('%s_count%s %d' % (self.name, labels, total))
+        return lines
+
+class Registry(object):
+    ''' The metrics of a process, get or create them by name '''
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError('%s is already a %s' % (name, metric.TYPE))
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def expose(self):
+        ''' Return all metrics in the Prometheus text format '''
+
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].expose())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.expose()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve(port, host='127.0.0.1', registry=REGISTRY):
+    ''' Serve registry at http://host:port/metrics from a daemon thread
+
+    Returns the server, call its shutdown() to stop it.
+    '''
+
+    server = HTTPServer((host, port), _Handler)
+    server.registry = registry
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
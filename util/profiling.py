@@ -0,0 +1,198 @@
+""" Stage timing and on demand profiling for long running loops
+
+Stages times the named stages of each pass of a loop into the
+pimms_stage_seconds histogram and reports a pass that takes longer than
+its budget with the time each stage took, two clock reads and a histogram
+update per stage so it is left on all the time.
+
+Profiler runs cProfile or a statistical sampler between start() and
+stop(), install() toggles it with a signal so a running process can be
+profiled without restarting it:
+
+>>> profiler = Profiler('/tmp/monitor.prof', SAMPLE)
+>>> profiler.install()     # kill -USR1 <pid> to start, again to stop
+
+cProfile output is a pstats file (python -m pstats file), the sampler
+writes one 'outer;inner;function count' line per stack as used by
+flamegraph tools. Both see the main thread and the threads that call
+follow() on each pass of their loop, a cProfile of such a thread is
+written beside the main one with the thread name appended.
+"""
+
+import sys, time, signal, threading, cProfile
+from collections import defaultdict
+from util import metrics
+
+STAGE_SECONDS = metrics.histogram('pimms_stage_seconds',
+                                  'Time taken by each stage of a loop pass',
+                                  ('stage',))
+LOOP_OVERRUNS = metrics.counter('pimms_loop_overruns_total',
+                                'Loop passes taking longer than their budget')
+
+CPROFILE = 'cprofile'
+SAMPLE = 'sample'
+MODES = (CPROFILE, SAMPLE)
+
+def _print_overrun(total, budget, stages):
+    print 'Loop overrun {t:.3f}s > {b:.3f}s: {s}'.format(
+        t=total, b=budget, s=', '.join(['{0} {1:.3f}s'.format(n, t)
+                                        for n, t in stages]))
+
+class _Stage(object):
+    def __init__(self, stages, name):
+        self._stages = stages
+        self.name = name
+
+    def __enter__(self):
+        self._start = self._stages._clock()
+        return self
+
+    def __exit__(self, *exc):
+        self._stages.record(self.name, self._stages._clock() - self._start)
+
+class Stages(object):
+    ''' Time the stages of each pass of a loop
+
+    >>> stages = Stages(budget=5.0)
+    >>> while True:
+    ...     stages.begin()
+    ...     with stages.stage('read'):
+    ...         read()
+    ...     stages.end()   # reports the pass if it took over 5 seconds
+
+    report(total, budget, [(stage, seconds)]) is called for an overrun,
+    by default it prints them.
+    '''
+
+    def __init__(self, budget=None, report=_print_overrun, clock=time.time):
+        self.budget = budget
+        self.report = report
+        self._clock = clock
+        self._stage = {}
+        self._times = []
+        self._start = None
+
+    def stage(self, name):
+        ''' Context manager timing its block as stage name '''
+
+        stage = self._stage.get(name)
+        if stage is None: stage = self._stage[name] = _Stage(self, name)
+        return stage
+
+    def record(self, name, seconds):
+        STAGE_SECONDS.observe(seconds, stage=name)
+        self._times.append((name, seconds))
+
+    def begin(self):
+        self._start = self._clock()
+        self._times = []
+
+    def end(self):
+        ''' End the pass, returns the seconds it took '''
+
+        total = self._clock() - self._start
+        if self.budget is not None and total > self.budget:
+            LOOP_OVERRUNS.inc()
+            if self.report is not None:
+                self.report(total, self.budget, self._times)
+        return total
+
+class Profiler(object):
+    ''' Profile the process between start() and stop()
+
+    Arguments:
+    filename -- written by stop()
+    mode -- CPROFILE or SAMPLE
+    interval -- seconds of CPU time between samples
+    '''
+
+    def __init__(self, filename, mode=CPROFILE, interval=0.005):
+        assert mode in MODES
+        self.filename = filename
+        self.mode = mode
+        self.interval = interval
+        self._profile = None
+        self._samples = None
+        self._threads = {}  # thread ident -> cProfile.Profile of follow()
+        self._followed = {} # thread ident -> name sampled by the sampler
+
+    @property
+    def running(self):
+        return self._profile is not None or self._samples is not None
+
+    def start(self):
+        if self.running: return
+        if self.mode == CPROFILE:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._samples = defaultdict(int)
+            signal.signal(signal.SIGPROF, self._sample)
+            # Restart system calls rather than fail them with EINTR
+            signal.siginterrupt(signal.SIGPROF, False)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def follow(self):
+        ''' Profile the calling thread as well while the profiler runs,
+        call it on each pass of the thread's loop and as the thread ends
+        '''
+
+        thread = threading.current_thread()
+        if self.mode == SAMPLE:
+            self._followed[thread.ident] = thread.name
+            return
+        # A Profile only sees the thread that enabled it
+        profile = self._threads.get(thread.ident)
+        if self._profile is not None and profile is None:
+            profile = self._threads[thread.ident] = cProfile.Profile()
+            profile.enable()
+        elif self._profile is None and profile is not None:
+            del self._threads[thread.ident]
+            profile.disable()
+            filename = '%s.%s' % (self.filename, thread.name)
+            profile.dump_stats(filename)
+            print 'Profile of {t} written to {f}'.format(t=thread.name,
+                                                          f=filename)
+
+    def _sample(self, signum, frame):
+        self._record(frame)
+        frames = sys._current_frames()
+        for ident, name in self._followed.items():
+            if ident in frames: self._record(frames[ident], name)
+
+    def _record(self, frame, thread=None):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s:%s' % (code.co_filename, code.co_name))
+            frame = frame.f_back
+        if thread is not None: stack.append('thread:%s' % thread)
+        self._samples[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        ''' Stop profiling and write the results to filename '''
+
+        if not self.running: return
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile.dump_stats(self.filename)
+            self._profile = None
+        else:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            # SIGPROF terminates the process by default, one may be pending
+            signal.signal(signal.SIGPROF, signal.SIG_IGN)
+            with open(self.filename, 'w') as f:
+                for stack, n in sorted(self._samples.iteritems()):
+                    f.write('%s %d\n' % (stack, n))
+            self._samples = None
+        print 'Profile written to %s' % self.filename
+
+    def toggle(self, *args):
+        if self.running: self.stop()
+        else: self.start()
+
+    def install(self, signum=signal.SIGUSR1):
+        ''' Toggle profiling whenever the process receives signum '''
+
+        signal.signal(signum, self.toggle)
+        signal.siginterrupt(signum, False)
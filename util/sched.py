@@ -0,0 +1,126 @@
+import time
+from heapq import heappush, heappop
+
+class Stats(object):
+    ''' Timing statistics kept by the Scheduler for each task
+
+    runs -- number of times the task has been due
+    overruns -- number of deadlines missed because the previous run was late
+    jitter -- total lateness in seconds over all runs
+    max_jitter -- the worst lateness seen
+    '''
+
+    __slots__ = ('runs', 'overruns', 'jitter', 'max_jitter')
+
+    def __init__(self):
+        self.runs = 0
+        self.overruns = 0
+        self.jitter = 0.0
+        self.max_jitter = 0.0
+
+    @property
+    def mean_jitter(self):
+        return self.jitter / self.runs if self.runs else 0.0
+
+    def __repr__(self):
+        return ('Stats(runs={s.runs}, overruns={s.overruns}, '
+                'mean_jitter={s.mean_jitter:.4f}, '
+                'max_jitter={s.max_jitter:.4f})'.format(s=self))
+
+class Scheduler(object):
+    ''' Run periodic tasks on fixed deadlines instead of spinning
+
+    Each task is identified by a hashable key and has its own period in
+    seconds. wait() sleeps until the earliest deadline and returns the keys
+    of all tasks that are due. Deadlines advance by whole periods from the
+    time a task was added so the cadence does not drift when a run is late,
+    a task that misses one or more complete periods is counted as an overrun
+    and is rescheduled to its next deadline in the future.
+
+    >>> s = Scheduler()
+    >>> s.add('sample', 1.0)
+    >>> s.add('log', 60)
+    >>> while True:
+    ...     for key in s.wait():
+    ...         do_something(key)
+
+    clock and sleep can be replaced, mostly to allow simulated time.
+    '''
+
+    def __init__(self, clock=time.time, sleep=time.sleep):
+        self._clock = clock
+        self._sleep = sleep
+        self._queue = []     # heap of (deadline, key)
+        self._periods = {}
+        self._deadlines = {}
+        self.stats = {}
+
+    def add(self, key, period, start=None):
+        ''' Schedule key every period seconds, first due at start (now)'''
+
+        assert period > 0
+        deadline = self._clock() if start is None else start
+        self._periods[key] = float(period)
+        self._deadlines[key] = deadline
+        self.stats.setdefault(key, Stats())
+        heappush(self._queue, (deadline, key))
+
+    def remove(self, key):
+        ''' Stop scheduling key, unknown keys are ignored '''
+
+        self._periods.pop(key, None)
+        self._deadlines.pop(key, None)
+        self.stats.pop(key, None)
+
+    def period(self, key):
+        return self._periods[key]
+
+    def __contains__(self, key):
+        return key in self._periods
+
+    def next_deadline(self):
+        ''' Return the time the next task is due or None if there are none'''
+
+        self._discard_stale()
+        return self._queue[0][0] if self._queue else None
+
+    def wait(self):
+        ''' Sleep until the next deadline and return a list of due keys '''
+
+        deadline = self.next_deadline()
+        if deadline is None: return []
+        delay = deadline - self._clock()
+        if delay > 0: self._sleep(delay)
+        return self.due()
+
+    def due(self):
+        ''' Return a list of keys whose deadline has passed without sleeping
+
+        Every key returned is rescheduled for its next deadline.
+        '''
+
+        now = self._clock()
+        keys = []
+        while self._queue and self._queue[0][0] <= now:
+            deadline, key = heappop(self._queue)
+            if self._deadlines.get(key) != deadline: continue # removed
+            period = self._periods[key]
+            late = now - deadline
+            missed = int(late / period)
+            stats = self.stats[key]
+            stats.runs += 1
+            stats.overruns += missed
+            stats.jitter += late
+            stats.max_jitter = max(stats.max_jitter, late)
+            nxt = deadline + (missed + 1) * period
+            self._deadlines[key] = nxt
+            heappush(self._queue, (nxt, key))
+            keys.append(key)
+        return keys
+
+    def _discard_stale(self):
+        ''' Drop heap entries for keys that have been removed or re-added '''
+
+        while (self._queue and
+               self._deadlines.get(self._queue[0][1]) != self._queue[0][0]):
+            heappop(self._queue)
@@ -0,0 +1,137 @@
+""" The latest reading of each sensor shared through a memory mapped file
+
+The monitor publishes the current value, status and times of every sensor
+into a small fixed layout file, normally in /dev/shm so it never reaches
+the SD card, and the web workers map the same file and read it without a
+system call. A seqlock guards the table: the writer makes the sequence
+number odd, writes, then makes it even again, a reader copies the table
+and starts over if the sequence was odd or changed while it copied.
+
+>>> publisher = Publisher(DEFAULT)
+>>> publisher.publish([('28-000004a3b1c2', 21.375, Reading.VALID,
+...                     read time, value time)])
+>>> Reader(DEFAULT).read()
+Snapshot(published=..., sensors=[Current(device='28-000004a3b1c2', ...)])
+
+The file keeps its inode across monitor restarts so readers that have it
+mapped see the new monitor's values.
+"""
+
+import os, mmap, struct, tempfile, threading, time
+from collections import namedtuple
+
+MAGIC = 'PIMS'
+LAYOUT = 1
+SLOTS = 64      # sensors the table holds
+RETRIES = 100   # copies a reader makes before giving up on a busy writer
+
+# magic, layout, count, sequence, published time
+HEADER = struct.Struct('<4sHHQd')
+# The header is written in parts around the sequence, pack_into zeroes
+# what it writes to first so everything is packed then copied in
+PREFIX = struct.Struct('<4sHH')
+SEQ = struct.Struct('<Q')
+STAMP = struct.Struct('<d')
+SEQ_OFFSET = PREFIX.size
+STAMP_OFFSET = SEQ_OFFSET + SEQ.size
+# device id, status, value, time of the last read, time of the value
+SLOT = struct.Struct('<16sB7xddd')
+
+DEFAULT = os.path.join('/dev/shm' if os.path.isdir('/dev/shm')
+                       else tempfile.gettempdir(), 'pimms-current')
+
+Current = namedtuple('Current', 'device val status read time')
+Snapshot = namedtuple('Snapshot', 'published sensors')
+
+def size(slots=SLOTS):
+    return HEADER.size + slots * SLOT.size
+
+class Publisher(object):
+    ''' Write the sensor table, there must be only one per file '''
+
+    def __init__(self, path=DEFAULT, slots=SLOTS):
+        self.path = path
+        self.slots = slots
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            if os.fstat(fd).st_size != size(slots):
+                os.ftruncate(fd, size(slots))
+            self._map = mmap.mmap(fd, size(slots))
+        finally:
+            os.close(fd)
+        magic, layout, count, seq, published = HEADER.unpack_from(self._map)
+        if magic != MAGIC or layout != LAYOUT: seq = 0
+        # Carry on from an earlier monitor's sequence so a reader part way
+        # through a copy still sees the change
+        self._seq = seq + (seq & 1)
+        self.publish([], 0.0)
+
+    def _set_seq(self, seq):
+        self._seq = seq
+        self._map[SEQ_OFFSET:SEQ_OFFSET + SEQ.size] = SEQ.pack(seq)
+
+    def publish(self, sensors, now=None):
+        ''' Replace the table with (device, val, status, read, time) for
+        each sensor, those past the number of slots are left out
+        '''
+
+        sensors = sensors[:self.slots]
+        now = time.time() if now is None else now
+        table = ''.join([SLOT.pack(device, status, val, read, t)
+                         for device, val, status, read, t in sensors])
+        self._set_seq(self._seq + 1)
+        self._map[HEADER.size:HEADER.size + len(table)] = table
+        self._map[:PREFIX.size] = PREFIX.pack(MAGIC, LAYOUT, len(sensors))
+        self._map[STAMP_OFFSET:STAMP_OFFSET + STAMP.size] = STAMP.pack(now)
+        self._set_seq(self._seq + 1)
+
+    def close(self):
+        self._map.close()
+
+class Reader(object):
+    ''' Read the sensor table published by a Publisher
+
+    The file is mapped on the first read that finds it, read() returns None
+    until then.
+    '''
+
+    def __init__(self, path=DEFAULT):
+        self.path = path
+        self._map = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        with self._lock:
+            if self._map is not None: return self._map
+            try:
+                fd = os.open(self.path, os.O_RDONLY)
+            except OSError:
+                return None
+            try:
+                if os.fstat(fd).st_size < HEADER.size: return None
+                self._map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            finally:
+                os.close(fd)
+            return self._map
+
+    def read(self):
+        ''' Return a Snapshot of the table, None if there is no table or
+        the writer kept it busy for RETRIES copies
+        '''
+
+        m = self._map if self._map is not None else self._open()
+        if m is None: return None
+        for i in xrange(RETRIES):
+            data = m[:]
+            magic, layout, count, seq, published = HEADER.unpack_from(data)
+            if magic != MAGIC or layout != LAYOUT: return None
+            if seq & 1 or SEQ.unpack_from(m, SEQ_OFFSET)[0] != seq: continue
+            count = min(count, (len(data) - HEADER.size) // SLOT.size)
+            sensors = []
+            for offset in xrange(HEADER.size, HEADER.size + count * SLOT.size,
+                                 SLOT.size):
+                device, status, val, read, t = SLOT.unpack_from(data, offset)
+                sensors.append(Current(device.rstrip('\0'), val, status,
+                                       read, t))
+            return Snapshot(published, sensors)
+        return None
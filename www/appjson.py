@@ -1,72 +1,105 @@
-import os, json
+import os, json, glob, datetime
 import sqlite3 as sqlite
 import datefuncs.dt as dt
-from util import check_file
+from db.schema import DB
+from util import check_file, atomic_write, metrics
+
+WRITE_SECONDS = metrics.histogram('pimms_json_write_seconds',
+                                  "Time taken to add a value to today's json",
+                                  ('mode',))
 
 class JSONTemps(object):
-    
-    def __init__(self, filename, db=None):
+    ''' Maintain the json file of today's readings used by the today page
+
+    In JSONTemps.FULL mode the whole day is rewritten to the file for every
+    value added. In JSONTemps.DELTA mode the file is a snapshot written once
+    at the start of the day (or when the monitor starts) naming a delta file
+    in its 'delta' key, each value added is then appended to the delta file
+    as a single '[time, value]' line so the cost of adding a value does not
+    grow through the day. Lines given per sensor values are
+    '[time, value, {device: value}]', in full mode the latest per sensor
+    values are kept in the 'sensors' key. The snapshot is always replaced atomically, the
+    delta file is named by date so a snapshot never refers to lines from
+    another day.
+    '''
+
+    FULL = 'full'
+    DELTA = 'delta'
+    MODES = (FULL, DELTA)
+
+    def __init__(self, filename, db=None, mode=FULL):
+        assert mode in JSONTemps.MODES
         self._curjson = None
         self._empty()
         self.db = db
+        self.mode = mode
+        self._day = None  # start timestamp of the day held in the file
         self._filename = None
         # Property will raise an exception if theres a problem here
         self.filename = filename
-        with open(self.filename, 'r') as f:
-            try:
-                self._curjson = json.loads(f.read())
-            except ValueError:
-                self._curjson = []
 
     def _empty(self):
         self._curjson = {'plotdata':[]}
-        
-    def add_val(self, time, val):
+
+    def add_val(self, time, val, sensors=None):
         ''' Add a value to the json file
 
         Arguments:
         time should be a timestamp of the reading, same form as time.time()
         val is the value of the reading to be added
+        sensors is an optional dict of {device id: value} at time
         '''
 
         # JSON is only for today, if we are tring to add a value for another
         # day discard it
         if not dt.is_today(time):
             return
-        # if We've moved into a new day empty the values
-        if not self._sameday():
-            self._empty()
-        # Get all of todays readings so far if we currently have none
-        if len(self._curjson['plotdata']) == 0:
-            self._curjson = {'plotdata':self._get_today()}
+        point = [int(time * 1000), val]
+        # if We've moved into a new day (or just started) begin a new file
+        # with all of todays readings so far
+        day = dt.timestamp_day(time).start
+        if day != self._day:
+            self._start_day(day, point[0])
         # Now we can finally add the value to the json
-        self._curjson['plotdata'].append([int(time * 1000), val])
-        self.__writejson()
+        with WRITE_SECONDS.time(mode=self.mode):
+            if self.mode == JSONTemps.DELTA:
+                self.__appenddelta(point + [sensors] if sensors else point)
+            else:
+                self._curjson['plotdata'].append(point)
+                if sensors: self._curjson['sensors'] = sensors
+                self.__writejson()
 
-    def _sameday(self):
-        ''' Check if today is the same date as the last reading in the json '''
+    def _start_day(self, day, before):
+        ''' Start the file for a new day with readings from the database
 
-        # No point going any further if the list is empty, lets bail
-        if len(self._curjson) == 0: return
+        Only readings earlier than before (ms) are used, later ones are
+        added to the file as they arrive.
+        '''
 
-        today = dt.utc_now()
-        last = dt.utc(self._curjson['plotdata'][-1][0] / 1000.0)
-        return (today.day == last.day and
-                today.month == last.month and
-                today.year == last.year)
+        self._day = day
+        self._curjson = {'plotdata': [p for p in self._get_today()
+                                      if p[0] < before]}
+        if self.mode == JSONTemps.DELTA:
+            self._curjson['delta'] = os.path.basename(self.deltafile)
+            for old in glob.glob(self._deltaglob()):
+                os.remove(old)
+            open(self.deltafile, 'w').close()
+            self.__writejson()
+            self._empty() # the snapshot on disk is all that is needed
 
     def _get_today(self):
         ''' retrieve all of the readings for today formatted for json file'''
-        
-        if self.db is None: return
+
+        if self.db is None: return []
         res = []
         today = dt.timestamp_day(dt.now())
-        with sqlite.connect(os.environ['PIMMS_DB']) as con:
+        with sqlite.connect(self.db) as con:
             cur = con.cursor()
-            cur.execute("SELECT * FROM readings "
-                        "WHERE timestamp  > {ts} AND timestamp < {te} "
-                        "ORDER BY timestamp ASC;".format(ts = today.start,
-                                                         te = today.end))
+            cur.execute("SELECT timestamp, reading FROM readings "
+                        "WHERE sensor_id = ? AND timestamp BETWEEN ? AND ? "
+                        "ORDER BY timestamp ASC;", (DB.AVG_SENSOR,
+                                                    int(today.start),
+                                                    int(today.end)))
             res = cur.fetchall()
         return JSONTemps.dbval2json(res)
 
@@ -78,11 +111,55 @@ class JSONTemps(object):
         '''
         return [[int(r[0] * 1000), r[1] / 1000.0] for r in res]
 
-    
+    @staticmethod
+    def read(filename):
+        ''' Return the list of points in a json file written by JSONTemps
+
+        Points in the delta file named by a snapshot are appended, a partly
+        written last line is ignored. Points are [time ms, value], any per
+        sensor values are dropped. Returns an empty list if the file is
+        missing or empty.
+        '''
+
+        try:
+            with open(filename, 'r') as f:
+                data = json.loads(f.read())
+        except (IOError, ValueError):
+            return []
+        points = data.get('plotdata', [])
+        if 'delta' in data:
+            delta = os.path.join(os.path.dirname(filename), data['delta'])
+            try:
+                with open(delta, 'r') as f:
+                    lines = f.read().split('\n')
+            except IOError:
+                lines = []
+            points.extend([json.loads(l)[:2] for l in lines[:-1] if l])
+        return points
+
+    def _deltaglob(self):
+        return '%s-*.ndjson' % os.path.splitext(self.filename)[0]
+
+    @property
+    def deltafile(self):
+        ''' The delta file for the current day '''
+
+        day = datetime.date.fromtimestamp(self._day)
+        return '%s-%s.ndjson' % (os.path.splitext(self.filename)[0],
+                                 day.strftime('%Y%m%d'))
+
+    def __appenddelta(self, point):
+        ''' Append a single value to the delta file with one write '''
+
+        fd = os.open(self.deltafile, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, json.dumps(point) + '\n')
+        finally:
+            os.close(fd)
+
     def __writejson(self):
         ''' Write the current json vals to the file '''
-        with open(self.filename, 'w') as f:
-            f.write(json.dumps(self._curjson))
+        atomic_write(self.filename, json.dumps(self._curjson))
 
     @property
     def filename(self):
@@ -0,0 +1,70 @@
+import time, threading
+from hashlib import sha1
+from collections import OrderedDict, namedtuple
+
+Page = namedtuple('Page', 'body etag expires')
+
+class PageCache(object):
+    ''' Least recently used cache of rendered pages bounded by size
+
+    Pages are stored with a strong ETag made from their content and an
+    optional time to live, pages without one are kept until they are
+    evicted. When the total size of the cached bodies goes over maxbytes
+    the least recently used pages are dropped. The cache is shared by the
+    threads of a worker so every change is made holding a lock.
+
+    >>> cache = PageCache(8 * 1024 * 1024)
+    >>> page = cache.get(key)
+    >>> if page is None:
+    ...     page = cache.put(key, render(), ttl=60)
+    '''
+
+    def __init__(self, maxbytes, clock=time.time):
+        self.maxbytes = maxbytes
+        self._clock = clock
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._pages)
+
+    def get(self, key):
+        ''' Return the cached Page for key or None if missing or expired '''
+
+        with self._lock:
+            page = self._pages.pop(key, None)
+            if page is not None and page.expires is not None and \
+               page.expires <= self._clock():
+                self.size -= len(page.body)
+                page = None
+            if page is None:
+                self.misses += 1
+                return None
+            self._pages[key] = page # most recently used goes last
+            self.hits += 1
+            return page
+
+    def put(self, key, body, ttl=None):
+        ''' Cache body for key and return its Page '''
+
+        if isinstance(body, unicode): body = body.encode('utf-8')
+        page = Page(body, sha1(body).hexdigest(),
+                    None if ttl is None else self._clock() + ttl)
+        with self._lock:
+            old = self._pages.pop(key, None)
+            if old is not None: self.size -= len(old.body)
+            if len(body) > self.maxbytes: return page # never fits
+            self._pages[key] = page
+            self.size += len(body)
+            while self.size > self.maxbytes:
+                k, evicted = self._pages.popitem(last=False)
+                self.size -= len(evicted.body)
+        return page
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+            self.size = 0
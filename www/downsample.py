@@ -0,0 +1,97 @@
+""" Reduce a plot series to a bounded number of points
+
+Series are lists of [time, value] pairs in time order, as produced by
+JSONTemps.dbval2json. Every mode keeps the first and last points.
+
+lttb -- Largest triangle three buckets, picks the point in each bucket that
+        forms the largest triangle with its neighbours, keeps the shape of
+        the line.
+minmax -- The lowest and highest points of each bucket in time order, keeps
+          every peak and trough.
+min, max, avg -- One point per bucket at the bucket's mean time.
+"""
+
+LTTB = 'lttb'
+MINMAX = 'minmax'
+MIN = 'min'
+MAX = 'max'
+AVG = 'avg'
+MODES = (LTTB, MINMAX, MIN, MAX, AVG)
+
+def downsample(points, threshold, mode=LTTB):
+    ''' Return points reduced to at most threshold points using mode '''
+
+    if mode not in MODES:
+        raise ValueError('Unknown downsample mode %s' % mode)
+    if threshold >= len(points) or threshold < 3:
+        return points
+    if mode == LTTB:
+        return lttb(points, threshold)
+    return bucket(points, threshold, mode)
+
+def _bounds(n, buckets):
+    ''' Split the n - 2 inner points into buckets, yield (start, end) '''
+
+    every = float(n - 2) / buckets
+    for i in xrange(buckets):
+        yield int(i * every) + 1, int((i + 1) * every) + 1
+
+def lttb(points, threshold):
+    ''' Largest triangle three buckets downsampling to threshold points '''
+
+    n = len(points)
+    if threshold >= n or threshold < 3:
+        return points
+    bounds = list(_bounds(n, threshold - 2))
+    sampled = [points[0]]
+    a = points[0]
+    for i, (start, end) in enumerate(bounds):
+        # Average of the next bucket is the third point of the triangle
+        if i + 1 < len(bounds):
+            nstart, nend = bounds[i + 1]
+        else:
+            nstart, nend = n - 1, n
+        count = nend - nstart
+        avg_t = sum([p[0] for p in points[nstart:nend]]) / float(count)
+        avg_v = sum([p[1] for p in points[nstart:nend]]) / float(count)
+
+        best, best_area = start, -1.0
+        at, av = a[0], a[1]
+        for j in xrange(start, end):
+            p = points[j]
+            area = abs((at - avg_t) * (p[1] - av) - (at - p[0]) * (avg_v - av))
+            if area > best_area:
+                best, best_area = j, area
+        a = points[best]
+        sampled.append(a)
+    sampled.append(points[-1])
+    return sampled
+
+def bucket(points, threshold, mode=AVG):
+    ''' Bucket downsampling, see the module documentation for modes '''
+
+    n = len(points)
+    if threshold >= n or threshold < 3:
+        return points
+    buckets = threshold - 2
+    if mode == MINMAX:
+        buckets = max(1, buckets // 2)
+    sampled = [points[0]]
+    for start, end in _bounds(n, buckets):
+        if start == end: continue
+        group = points[start:end]
+        if mode == MINMAX:
+            lo = min(group, key=lambda p: p[1])
+            hi = max(group, key=lambda p: p[1])
+            sampled.extend(sorted([lo, hi]) if lo is not hi else [lo])
+            continue
+        t = int(sum([p[0] for p in group]) / len(group))
+        if mode == MIN:
+            v = min([p[1] for p in group])
+        elif mode == MAX:
+            v = max([p[1] for p in group])
+        else:
+            v = sum([p[1] for p in group]) / float(len(group))
+        sampled.append([t, v])
+    sampled.append(points[-1])
+    return sampled
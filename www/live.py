@@ -0,0 +1,116 @@
+import os, json, time, threading
+
+# Seconds between checks of the json files for new points
+POLL = 1.0
+# A comment is sent when nothing else has been for KEEPALIVE seconds so
+# dropped connections are noticed and proxies do not time out the stream
+KEEPALIVE = 15.0
+# Streams are closed after MAX_AGE seconds, the browser reconnects after
+# RETRY ms resuming from the last event id so no point is missed
+MAX_AGE = 3600.0
+RETRY = 5000
+# Each open stream holds a worker thread for up to MAX_AGE, so a worker
+# serves at most MAX_STREAMS at once (half the threads pimms gives it) and
+# refuses more, leaving threads for every other request
+MAX_STREAMS = 8
+streams = threading.BoundedSemaphore(MAX_STREAMS)
+
+def _stat(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime, st.st_size
+
+class Tail(object):
+    ''' Follow the points added to a json file written by JSONTemps
+
+    In delta mode only the lines appended to the delta file since the last
+    poll are read, in full mode the file is read again when it changes.
+    Points are [time ms, value] or [time ms, value, {device: value}], only
+    those later than after (ms) are returned, by default the points already
+    in the file when the Tail is created are skipped.
+
+    >>> tail = Tail('www/static/json/today.json', after=last_id)
+    >>> points, newday = tail.poll()
+    '''
+
+    def __init__(self, filename, after=None):
+        self.filename = filename
+        self.after = after
+        self._snapshot = None # _stat of the snapshot when last read
+        self._delta = None
+        self._pos = 0
+        self._rest = '' # a partly written last line
+
+    def poll(self):
+        ''' Return (new points, True if a new day has started) '''
+
+        points, newday = [], False
+        st = _stat(self.filename)
+        if st != self._snapshot:
+            self._snapshot = st
+            try:
+                with open(self.filename, 'r') as f:
+                    data = json.loads(f.read())
+            except (IOError, ValueError):
+                data = {}
+            delta = data.get('delta')
+            if delta is not None:
+                delta = os.path.join(os.path.dirname(self.filename), delta)
+            if delta != self._delta:
+                newday = self._delta is not None
+                self._delta = delta
+                self._pos, self._rest = 0, ''
+                if delta is not None and self.after is None:
+                    self._pos = (_stat(delta) or (0, 0, 0))[2]
+            if delta is None:
+                points = data.get('plotdata', [])
+                if points and data.get('sensors'):
+                    points[-1] = points[-1] + [data['sensors']]
+                if self.after is None and points:
+                    self.after = points[-1][0]
+        if self._delta is not None:
+            points = self._read_delta()
+        if self.after is not None:
+            points = [p for p in points if p[0] > self.after]
+        if points: self.after = points[-1][0]
+        return points, newday
+
+    def _read_delta(self):
+        try:
+            with open(self._delta, 'r') as f:
+                f.seek(self._pos)
+                data = f.read()
+        except IOError:
+            return []
+        self._pos += len(data)
+        lines = (self._rest + data).split('\n')
+        self._rest = lines.pop()
+        return [json.loads(l) for l in lines if l]
+
+def events(tail, clock=time.time, sleep=time.sleep):
+    ''' Generate Server-Sent Events for the points followed by tail
+
+    Each point is a 'reading' event with the point time (ms) as its id and
+    {"point": [time ms, value], "sensors": {device: value}} as data, a
+    'day' event tells the page a new day has started.
+    '''
+
+    yield 'retry: %d\n\n' % RETRY
+    started = sent = clock()
+    while clock() - started < MAX_AGE:
+        points, newday = tail.poll()
+        out = []
+        if newday:
+            out.append('event: day\ndata: {}\n\n')
+        for p in points:
+            data = {'point': p[:2], 'sensors': p[2] if len(p) > 2 else {}}
+            out.append('id: %d\nevent: reading\ndata: %s\n\n' %
+                       (p[0], json.dumps(data)))
+        if not out and clock() - sent >= KEEPALIVE:
+            out.append(': keepalive\n\n')
+        if out:
+            sent = clock()
+            yield ''.join(out)
+        sleep(POLL)
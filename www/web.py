@@ -19,20 +19,103 @@ This file is part of Pi.M.M.S.
 """
 
 import sqlite3 as sqlite
-import datetime, time, os, json
+import datetime, time, os, json, heapq, itertools, math
 from collections import namedtuple
-from flask import Flask, request
+from flask import Flask, Response, request, abort, g
 from jinja2 import Environment, FileSystemLoader
 from www.appjson import JSONTemps
+from db.schema import DB
+from db import rollup, extents, retention, archive, ingest
+from www import downsample
+from www.cache import PageCache
+from www import live
+from util import metrics, shm
+from sensors.reading import Reading
 import datefuncs.dt as dt
 
 templatedir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'templates')
 env = Environment(loader = FileSystemLoader(templatedir))
 
+jsonfile = os.environ.get('PIMMS_JSON', os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'static', 'json',
+        'today.json'))
+
+# Number of points sent for a plot unless the request asks for a number
+# between MIN_POINTS and MAX_POINTS with the points parameter
+DEFAULT_POINTS = 1000
+MIN_POINTS = 10
+MAX_POINTS = 10000
+
+# Plot views, the number of days shown up to the selected date and the
+# x axis tick interval and format
+Viewtype = namedtuple('Viewtype', 'days tick tickformat')
+VIEWS = {'day': Viewtype(1, '1 hour', '%H:%M'),
+         'week': Viewtype(7, '1 day', '%a %d'),
+         'month': Viewtype(31, '2 days', '%d/%m'),
+         'year': Viewtype(365, '1 month', '%b %Y')}
+DEFAULT_VIEW = 'day'
+
+# Rows fetched from the database at a time when streaming a range
+STREAM_CHUNK = 1000
+
+# Seconds the reading extents of a sensor are reused for before being
+# looked up again, they only bound the datepicker so need not be exact
+EXTENTS_TTL = 60
+_extents = {} # sensor -> (time looked up, (earliest, latest))
+
+# Rendered plot pages are kept in an LRU cache of PAGE_CACHE_BYTES per
+# worker. A day is complete SETTLE seconds after it ends, once readings
+# waiting on the monitor's --commit delay and spool have been written.
+# Pages of completed days are reused, and may be cached by browsers, for
+# HISTORY_MAX_AGE so readings shipped late by a node still show up, pages
+# of other days are only reused for TODAY_MAX_AGE.
+PAGE_CACHE_BYTES = 8 * 1024 * 1024
+SETTLE = 900
+HISTORY_MAX_AGE = 3600
+TODAY_MAX_AGE = 60
+pages = PageCache(PAGE_CACHE_BYTES)
+
+# The latest reading of each sensor published by the monitor
+current = shm.Reader(os.environ.get('PIMMS_SHM', shm.DEFAULT))
+
+_archives = {} # database path -> db.archive.Archive of its old readings
+
+# Readings are taken from other nodes at /ingest only when the collector
+# has a key, which they must send
+INGEST_KEY = os.environ.get('PIMMS_INGEST_KEY')
+_ingest_ids = {} # (node, device) -> sensors table id
+
+REQUEST_SECONDS = metrics.histogram('pimms_http_request_seconds',
+                                    'Time taken to answer a request',
+                                    ('endpoint',))
+REQUESTS = metrics.counter('pimms_http_requests_total', 'Requests answered',
+                           ('endpoint', 'status'))
+QUERY_SECONDS = metrics.histogram('pimms_db_query_seconds',
+                                  'Time taken by database queries', ('query',))
+CACHE_PAGES = metrics.gauge('pimms_page_cache', 'Rendered page cache',
+                            ('stat',))
+INGESTED = metrics.counter('pimms_ingest_readings_total',
+                           'Readings received from other nodes', ('result',))
+
 app = Flask(__name__)
 app.config['DEBUG'] = True
 
-def reading_extents_offset():
+def reading_extents(sensor=DB.AVG_SENSOR):
+    """ Get the (earliest, latest) reading timestamps of a sensor
+    The extents kept by the monitor are cached for EXTENTS_TTL seconds
+    @see db.extents
+    """
+
+    n = dt.now()
+    cached = _extents.get(sensor)
+    if cached is None or n - cached[0] > EXTENTS_TTL:
+        with QUERY_SECONDS.time(query='extents'):
+            with sqlite.connect(os.environ['PIMMS_DB']) as con:
+                cached = (n, extents.get(con, sensor))
+        _extents[sensor] = cached
+    return cached[1]
+
+def reading_extents_offset(sensor=DB.AVG_SENSOR):
     """ Get the timedelta from now of the earliest and most recent readings
     returns a namedtuple  with start and end
     start being a timedelta difference from now to the earliest reading
@@ -42,66 +125,388 @@ def reading_extents_offset():
     Deltatype = namedtuple('Deltatype', 'start end')
     n = dt.date_now()
 
-    with sqlite.connect(os.environ['PIMMS_DB']) as con:
-        cur = con.cursor()
-        cur.execute("SELECT MIN(timestamp) FROM readings;")
-        starttime = datetime.date.fromtimestamp(cur.fetchone()[0])
-        cur.execute("SELECT MAX(timestamp) FROM readings;")
-        endtime = datetime.date.fromtimestamp(cur.fetchone()[0])
+    first, last = reading_extents(sensor)
+    if first is None: return Deltatype(n - n, n - n)
+    starttime = datetime.date.fromtimestamp(first)
+    endtime = datetime.date.fromtimestamp(last)
 
     return (Deltatype(n - starttime, n - endtime if endtime < n else n - n))
 
-def get_readings(day):
-    """ Get all readings for the given day
-    @see make_day
+def readings_archive():
+    """ Get the archive of the readings moved out of the database """
+
+    db = os.environ['PIMMS_DB']
+    store = _archives.get(db)
+    if store is None:
+        store = _archives[db] = archive.Archive(archive.directory(db))
+    return store
+
+def archived(sensor, start, end):
+    """ Get the (timestamp, reading) rows of sensor between start and end
+    moved out of the readings table, @see db.archive
+    """
+
+    with QUERY_SECONDS.time(query='archive'):
+        return readings_archive().read(sensor, int(start), int(end))
+
+def merge_rows(old, rows):
+    """ Generate the rows of two time ordered sequences in time order, a
+    reading both hold is given once
+    """
+
+    last = None
+    for r in heapq.merge(old, rows):
+        if r[0] != last: yield r
+        last = r[0]
+
+def get_readings(day, sensor=DB.AVG_SENSOR, resolution=rollup.RAW):
+    """ Get all readings for the given day from one sensor
+    day can be any Daytype span, @see make_day
+    With a resolution other than raw the mean of each rollup period is
+    returned from the rollup tables. A resolution no longer kept for the
+    start of day is swapped for the next coarser one that is. Raw
+    readings moved to the archive are merged with those still in the
+    database.
     """
 
     res = []
     plotdate = (time.mktime(day.start.timetuple()),
                 time.mktime(day.end.timetuple()))
-    with sqlite.connect(os.environ['PIMMS_DB']) as con:
+    with sqlite.connect(os.environ['PIMMS_DB']) as con, \
+         QUERY_SECONDS.time(query=resolution):
+        resolution = retention.available(resolution, plotdate[0],
+                                         retention.applied(con))
+        if resolution != rollup.RAW:
+            return [r[:2] for r in rollup.query(con, sensor, plotdate[0],
+                                                plotdate[1], resolution)]
         cur = con.cursor()
-        cur.execute("SELECT * FROM readings "
-                    "WHERE timestamp > {start:f} AND timestamp < {end:f} " 
-                    "ORDER BY timestamp ASC;".format(start=plotdate[0],
-                                                     end=plotdate[1]))
+        cur.execute("SELECT timestamp, reading FROM readings "
+                    "WHERE sensor_id = ? AND timestamp BETWEEN ? AND ? "
+                    "ORDER BY timestamp ASC;", (sensor, int(plotdate[0]),
+                                                int(plotdate[1])))
         res = cur.fetchall()
+    old = archived(sensor, plotdate[0], plotdate[1])
+    if old: res = list(merge_rows(old, res))
     return res
 
+def view_span(plotdate, view):
+    """ Return a Daytype spanning the days of view ending on plotdate """
+
+    first = plotdate - datetime.timedelta(days=VIEWS[view].days - 1)
+    return dt.Daytype(dt.make_day(first).start, dt.make_day(plotdate).end)
+
+def stream_readings(sensor, start, end, resolution=rollup.RAW):
+    """ Generate the JSON for readings from sensor between start and end
+
+    Rows are fetched STREAM_CHUNK at a time from an open cursor and
+    yielded as they are formatted so memory use does not depend on the
+    size of the range. Raw points are [time ms, value], rollup points
+    are [time ms, mean, min, max]. Archived raw readings are decoded a
+    day at a time as they are merged in.
+    """
+
+    def fetch(cur):
+        while True:
+            rows = cur.fetchmany(STREAM_CHUNK)
+            if not rows: return
+            for r in rows: yield r
+
+    con = sqlite.connect(os.environ['PIMMS_DB'])
+    try:
+        if resolution == rollup.RAW:
+            cur = con.execute("SELECT timestamp, reading FROM readings "
+                              "WHERE sensor_id = ? AND timestamp "
+                              "BETWEEN ? AND ? ORDER BY timestamp ASC;",
+                              (sensor, int(start), int(end)))
+            rows = merge_rows(
+                readings_archive().rows(sensor, int(start), int(end)),
+                fetch(cur))
+        else:
+            rows = fetch(rollup.query(con, sensor, start, end, resolution))
+        yield '{{"sensor": {s}, "resolution": "{r}", "plotdata": ['.format(
+            s=sensor, r=resolution)
+        sep = ''
+        while True:
+            chunk = list(itertools.islice(rows, STREAM_CHUNK))
+            if not chunk: break
+            yield sep + ', '.join([json.dumps([r[0] * 1000] +
+                                              [v / 1000.0 for v in r[1:]])
+                                   for r in chunk])
+            sep = ', '
+        yield ']}'
+    finally:
+        con.close()
+
+def requested_range(request):
+    """ Get the sensor, start, end and resolution of a range request
+    start and end may be timestamps or in dt.DATEFORMAT, sensor a sensor id
+    or device id, of this Pi unless a node is given, resolution one of
+    rollup.RESOLUTIONS or auto.
+    Aborts with 400 for bad parameters and 404 for an unknown sensor.
+    """
+
+    def parse_time(name, default):
+        val = request.values.get(name)
+        if val is None: return default
+        try:
+            t = float(val)
+        except ValueError:
+            try:
+                return dt.web2time(val)
+            except ValueError:
+                abort(400)
+        if math.isnan(t) or math.isinf(t): abort(400)
+        return t
+
+    end = parse_time('end', dt.now())
+    start = parse_time('start', end - 86400)
+    if start > end: abort(400)
+    resolution = request.values.get('resolution', rollup.RAW)
+    if resolution == 'auto':
+        points = requested_points(request)[0]
+        resolution = rollup.resolution_for(end - start, points)
+    elif resolution not in rollup.RESOLUTIONS: abort(400)
+    sensor = request.values.get('sensor', str(DB.AVG_SENSOR))
+    node = request.values.get('node', DB.LOCAL_NODE)
+    with sqlite.connect(os.environ['PIMMS_DB']) as con:
+        row = con.execute("SELECT id FROM sensors WHERE id = ? "
+                          "OR (node = ? AND device = ?);",
+                          (sensor, node, sensor)).fetchone()
+        if request.values.get('resolution') == 'auto':
+            # Coarser still if the range starts before the data kept
+            resolution = retention.available(resolution, start,
+                                             retention.applied(con))
+    if row is None: abort(404)
+    return row[0], start, end, resolution
+
 def render_page(template, template_args):
     template = env.get_template(template)
     return template.render(args=template_args)
 
 def requested_plot(request):
     plotdate = datetime.date.fromtimestamp(dt.now())
-    if (request.method == 'POST' and 'dateselected' in request.form and
-        len(request.form['dateselected'].split('/')) == 3):
-        pdate = time.strptime(request.form['dateselected'], '%m/%d/%Y')
+    if ('dateselected' in request.values and
+        len(request.values['dateselected'].split('/')) == 3):
+        pdate = time.strptime(request.values['dateselected'], '%m/%d/%Y')
         if dt.valid_date(pdate.tm_year, pdate.tm_mon, pdate.tm_mday):
             plotdate = datetime.date.fromtimestamp(time.mktime(pdate))
     return plotdate
 
-def doplot(plotdate):
-    day = dt.make_day(plotdate) # datetime for start and end of day
+def requested_points(request):
+    """ Get the number of plot points and downsample mode requested
+    returns a tuple of (points, mode)
+    """
+
+    points = DEFAULT_POINTS
+    try:
+        points = int(request.values.get('points', DEFAULT_POINTS))
+    except ValueError:
+        pass
+    points = min(max(points, MIN_POINTS), MAX_POINTS)
+    mode = request.values.get('mode', downsample.LTTB)
+    if mode not in downsample.MODES: mode = downsample.LTTB
+    return points, mode
+
+def requested_view(request):
+    view = request.values.get('view', DEFAULT_VIEW)
+    return view if view in VIEWS else DEFAULT_VIEW
+
+def doplot(plotdate, points=DEFAULT_POINTS, mode=downsample.LTTB,
+           view=DEFAULT_VIEW, deltas=None):
+    day = view_span(plotdate, view) # datetime for start and end of the view
     # Time from now to the 1st and last available reading
     # Used to limit the range available in the datepicker
-    deltas = reading_extents_offset()
+    if deltas is None: deltas = reading_extents_offset()
     template_args = {"start": 0 - deltas.start.days,
                      "end": deltas.end.days,
-                     "day": day}
+                     "day": day,
+                     "points": points,
+                     "mode": mode,
+                     "view": view,
+                     "views": sorted(VIEWS, key=lambda v: VIEWS[v].days),
+                     "tick": VIEWS[view].tick,
+                     "tickformat": VIEWS[view].tickformat,
+                     "xmin": int(time.mktime(day.start.timetuple()) * 1000),
+                     "xmax": int(time.mktime(day.end.timetuple()) * 1000)}
     template = 'today.html'
-    if not dt.is_today(plotdate):
+    if view != 'day' or not dt.is_today(plotdate):
         template = 'default.html'
-        temps = JSONTemps.dbval2json(get_readings(day))
+        span = template_args["xmax"] / 1000 - template_args["xmin"] / 1000
+        resolution = rollup.resolution_for(span, points)
+        temps = JSONTemps.dbval2json(get_readings(day, resolution=resolution))
+        temps = downsample.downsample(temps, points, mode)
         template_args["readings"] = json.dumps(temps)
 
     return template, template_args
 
+def cached_plot(plotdate, points, mode, view, sensor=DB.AVG_SENSOR):
+    """ Return the rendered plot page from the page cache, rendering it if
+    needed, and whether the page covers only completed days, those ended
+    SETTLE seconds ago
+    Pages are keyed on (day, view, sensor, points, mode) and the datepicker
+    range, which together decide the template and everything on it.
+    """
+
+    deltas = reading_extents_offset(sensor)
+    end = time.mktime(view_span(plotdate, view).end.timetuple()) + 1
+    complete = dt.now() >= end + SETTLE
+    key = (plotdate, view, sensor, points, mode,
+           deltas.start.days, deltas.end.days)
+    page = pages.get(key)
+    if page is None:
+        template, template_args = doplot(plotdate, points, mode, view, deltas)
+        page = pages.put(key, render_page(template, template_args),
+                         HISTORY_MAX_AGE if complete else TODAY_MAX_AGE)
+    return page, complete
+
+@app.before_request
+def start_timer():
+    g.started = time.time()
+
+@app.after_request
+def record_request(response):
+    """ Time every request by endpoint, streamed responses are timed up to
+    the start of the stream
+    """
+
+    endpoint = request.endpoint or 'none'
+    started = getattr(g, 'started', None)
+    if started is not None:
+        REQUEST_SECONDS.observe(time.time() - started, endpoint=endpoint)
+    REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    return response
+
+@app.route('/metrics')
+def metrics_page():
+    CACHE_PAGES.set(len(pages), stat='pages')
+    CACHE_PAGES.set(pages.size, stat='bytes')
+    CACHE_PAGES.set(pages.hits, stat='hits')
+    CACHE_PAGES.set(pages.misses, stat='misses')
+    return Response(metrics.REGISTRY.expose(),
+                    content_type=metrics.CONTENT_TYPE)
+
 @app.route('/', methods=["GET", "POST"])
 def index():
-    template, template_args = doplot(requested_plot(request))
-    return render_page(template, template_args)
+    points, mode = requested_points(request)
+    page, complete = cached_plot(requested_plot(request), points, mode,
+                                 requested_view(request))
+    response = Response(page.body, mimetype='text/html')
+    if request.method == 'GET':
+        response.set_etag(page.etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = (HISTORY_MAX_AGE if complete
+                                          else TODAY_MAX_AGE)
+        response = response.make_conditional(request)
+    return response
+
+@app.route('/json/today')
+def today_json():
+    points, mode = requested_points(request)
+    temps = downsample.downsample(JSONTemps.read(jsonfile), points, mode)
+    return Response(json.dumps({'plotdata': temps}),
+                    mimetype='application/json')
+
+
+@app.route('/json/range')
+def range_json():
+    sensor, start, end, resolution = requested_range(request)
+    return Response(stream_readings(sensor, start, end, resolution),
+                    mimetype='application/json')
+
+@app.route('/json/sensors')
+def sensors_json():
+    """ Every sensor in the database, this Pi's and those of the nodes it
+    collects from, with the times of its earliest and latest readings
+    """
+
+    with sqlite.connect(os.environ['PIMMS_DB']) as con:
+        rows = con.execute("SELECT id, node, device, family FROM sensors "
+                           "ORDER BY node, id;").fetchall()
+        sensors = [{'id': r[0], 'node': r[1], 'device': r[2],
+                    'family': r[3], 'extents': extents.get(con, r[0])}
+                   for r in rows]
+    return Response(json.dumps({'sensors': sensors}),
+                    mimetype='application/json')
+
+@app.route('/ingest', methods=['POST'])
+def ingest_batch():
+    """ Store a zlib compressed batch of readings shipped by another node,
+    @see db.ingest. 404 unless the collector has an ingest key, 403 if the
+    request does not carry it, 413 and 400 for a batch too large or
+    invalid. Returns the number of readings accepted and duplicates.
+    """
+
+    if not INGEST_KEY: abort(404)
+    if not ingest.authorised(request.headers.get(ingest.KEY_HEADER, ''),
+                             INGEST_KEY):
+        abort(403)
+    if (request.content_length or 0) > ingest.MAX_BATCH: abort(413)
+    # A chunked upload has no length, read no more than a batch may hold
+    data = []
+    size = 0
+    while size <= ingest.MAX_BATCH:
+        chunk = request.stream.read(ingest.MAX_BATCH + 1 - size)
+        if not chunk: break
+        data.append(chunk)
+        size += len(chunk)
+    if size > ingest.MAX_BATCH: abort(413)
+    try:
+        node, sensors = ingest.decode(''.join(data))
+    except ingest.BatchError:
+        abort(400)
+    con = sqlite.connect(os.environ['PIMMS_DB'], timeout=30)
+    try:
+        with QUERY_SECONDS.time(query='ingest'):
+            accepted, duplicates = ingest.store(con, node, sensors,
+                                                _ingest_ids,
+                                                readings_archive())
+    finally:
+        con.close()
+    INGESTED.inc(accepted, result='accepted')
+    INGESTED.inc(duplicates, result='duplicate')
+    return Response(json.dumps({'accepted': accepted,
+                                'duplicates': duplicates}),
+                    mimetype='application/json')
+
+@app.route('/current')
+def current_json():
+    """ The latest reading of each sensor from the monitor's shared memory
+    value is the last valid reading taken at time, status is that of the
+    last read at read. 503 if the monitor has not published any.
+    """
+
+    snapshot = current.read()
+    if snapshot is None: abort(503)
+    response = Response(json.dumps({
+        'published': snapshot.published,
+        'sensors': [{'device': c.device, 'value': c.val,
+                     'status': Reading.NAMES.get(c.status, 'unknown'),
+                     'read': c.read, 'time': c.time}
+                    for c in snapshot.sensors]}), mimetype='application/json')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/stream')
+def stream():
+    """ Server-Sent Events of the points added to today's json
+    Resumes after the Last-Event-ID header sent by a reconnecting browser
+    or the after parameter (ms), otherwise only points added from now on
+    are sent. 503 when the worker already has live.MAX_STREAMS open.
+    """
 
+    after = request.headers.get('Last-Event-ID', request.values.get('after'))
+    try:
+        after = int(after)
+    except (TypeError, ValueError):
+        after = None
+    if not live.streams.acquire(False): abort(503)
+    response = Response(live.events(live.Tail(jsonfile, after)),
+                        mimetype='text/event-stream')
+    # Released when the response is closed, even if never iterated
+    response.call_on_close(live.streams.release)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # not buffered by nginx
+    return response
 
 if __name__ == '__main__':
-    app.run()
+    app.run(threaded=True)